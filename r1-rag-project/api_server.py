@@ -0,0 +1,29 @@
+import sys
+# 禁用Python生成.pyc文件，避免缓存文件的生成
+sys.dont_write_bytecode = True
+
+from config.config import settings
+from utils.logger import logger
+import uvicorn
+
+
+def main():
+    """
+    启动无界面的HTTP API服务
+
+    以 API_WORKERS 个工作进程运行，各进程共享 VECTOR_DB_PATH 中的索引，
+    写操作通过向量库目录下的文件锁串行执行。
+    """
+    logger.info(f"启动API服务: http://{settings.HOST}:{settings.API_PORT}，工作进程数 {settings.API_WORKERS}")
+    uvicorn.run(
+        "fronted.api:create_app",
+        factory=True,
+        host=settings.HOST,
+        port=settings.API_PORT,
+        workers=max(1, settings.API_WORKERS),
+        log_level=settings.LOG_LEVEL.lower(),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -9,27 +9,138 @@ class Settings(BaseSettings):
     HOST: str = os.getenv("HOST", "0.0.0.0")  # 服务监听地址
     PORT: int = int(os.getenv("PORT", "8804"))  # 服务端口
     WORKERS: int = int(os.getenv("WORKERS", "4"))  # 工作进程数
+
+    # HTTP API配置
+    API_PORT: int = int(os.getenv("API_PORT", "8805"))  # 无界面API服务端口
+    API_WORKERS: int = int(os.getenv("API_WORKERS", "2"))  # API工作进程数，各进程共享同一个向量库目录
+    API_MAX_BATCH: int = int(os.getenv("API_MAX_BATCH", "64"))  # 批量问答接口单次最多的问题数
+    API_UPLOAD_DIR: str = os.getenv("API_UPLOAD_DIR", "./uploads")  # 上传文件的临时目录，入库完成后删除
     
     # Ollama配置
     OLLAMA_MODEL: str = os.getenv("OLLAMA_MODEL", "deepseek-r1:7b")
+    LLM_STREAMING: bool = os.getenv("LLM_STREAMING", "true").lower() == "true"  # 是否流式输出回答
+    OLLAMA_TIMEOUT: float = float(os.getenv("OLLAMA_TIMEOUT", "300"))  # 请求超时(秒)
+    OLLAMA_MAX_CONNECTIONS: int = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "64"))  # 共享连接池的最大连接数
+    OLLAMA_KEEPALIVE_EXPIRY: float = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "60"))  # 空闲长连接的保留时间(秒)
+    OLLAMA_MODEL_KEEP_ALIVE: str = os.getenv("OLLAMA_MODEL_KEEP_ALIVE", "30m")  # 模型在Ollama中空闲后保持加载的时长
+    
+    # 自适应并发配置
+    LLM_CONCURRENCY_MAX: int = int(os.getenv("LLM_CONCURRENCY_MAX", "32"))  # 生成请求并发上限的最大值，初始值为WORKERS
+    EMBED_CONCURRENCY_INITIAL: int = int(os.getenv("EMBED_CONCURRENCY_INITIAL", "4"))  # 向量化请求的初始并发上限
+    EMBED_CONCURRENCY_MAX: int = int(os.getenv("EMBED_CONCURRENCY_MAX", "32"))  # 向量化请求并发上限的最大值
+    LIMITER_LATENCY_TOLERANCE: float = float(os.getenv("LIMITER_LATENCY_TOLERANCE", "1.5"))  # 延迟超过基线该倍数时收缩并发上限
+    LIMITER_BACKOFF: float = float(os.getenv("LIMITER_BACKOFF", "0.7"))  # 请求失败时并发上限的乘数
+    LLM_QUEUE_DEADLINE: float = float(os.getenv("LLM_QUEUE_DEADLINE", "120"))  # 生成请求排队等待的最长秒数，预计等待超过该值时直接拒绝，0表示不限
+    
+    # 答案缓存配置
+    ANSWER_CACHE_ENABLED: bool = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"  # 是否启用语义答案缓存
+    ANSWER_CACHE_MAX_ENTRIES: int = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))  # 最大缓存条目数
+    ANSWER_CACHE_TTL: int = int(os.getenv("ANSWER_CACHE_TTL", "3600"))  # 缓存有效期(秒)
+    ANSWER_CACHE_SIMILARITY: float = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))  # 语义命中的最小余弦相似度
 
     # embed配置
     EMBED_MODEL : str = os.getenv("EMBED_MODEL", "nomic-embed-text:latest")
     
     # 向量存储配置
     VECTOR_DB_PATH: str = os.getenv("VECTOR_DB_PATH", "./vector_db")  # 向量数据库
+    SEGMENT_SMALL_VECTORS: int = int(os.getenv("SEGMENT_SMALL_VECTORS", "20000"))  # 向量数低于该值的分段视为小分段
+    SEGMENT_MERGE_MIN_SEGMENTS: int = int(os.getenv("SEGMENT_MERGE_MIN_SEGMENTS", "4"))  # 小分段达到该数量时后台合并
+    SEGMENT_MAX_DELETED_RATIO: float = float(os.getenv("SEGMENT_MAX_DELETED_RATIO", "0.3"))  # 已删除分块比例超过该值的分段参与合并
+    RETRIEVAL_K: int = int(os.getenv("RETRIEVAL_K", "2"))  # 检索时返回的最相似文档数量
+    HYBRID_SEARCH_ENABLED: bool = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"  # 是否融合BM25与向量检索结果
+    HYBRID_FETCH_FACTOR: int = int(os.getenv("HYBRID_FETCH_FACTOR", "5"))  # 混合检索时每一路取 k*该值 个候选
+    RRF_K: int = int(os.getenv("RRF_K", "60"))  # 倒数排名融合的平滑常数
+    INDEX_MMAP: bool = os.getenv("INDEX_MMAP", "true").lower() == "true"  # 是否以只读内存映射方式加载分段索引
+    INDEX_REFRESH_INTERVAL: float = float(os.getenv("INDEX_REFRESH_INTERVAL", "1.0"))  # 检查其他进程是否更新了索引的间隔(秒)，负数表示不检查
+    RETRIEVAL_BATCH_ENABLED: bool = os.getenv("RETRIEVAL_BATCH_ENABLED", "true").lower() == "true"  # 是否合并并发的问题向量化和检索请求
+    RETRIEVAL_BATCH_MAX_SIZE: int = int(os.getenv("RETRIEVAL_BATCH_MAX_SIZE", "16"))  # 每批最多合并的请求数
+    RETRIEVAL_BATCH_MAX_WAIT_MS: float = float(os.getenv("RETRIEVAL_BATCH_MAX_WAIT_MS", "5"))  # 攒批最长等待时间(毫秒)，限制额外增加的延迟
+    
+    # 上下文组装配置
+    CONTEXT_MAX_TOKENS: int = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))  # 拼入提示词的上下文token上限
+    CONTEXT_TOKENIZER: str = os.getenv("CONTEXT_TOKENIZER", "")  # 统计token数的分词器(本地目录或已缓存的HuggingFace模型名，不会联网下载)，为空或无法加载时按字符估算
+    CONTEXT_ADJACENT_GAP: int = int(os.getenv("CONTEXT_ADJACENT_GAP", "4"))  # 同页分块间隔不超过该字符数时视为相邻并合并
+    CONTEXT_MIN_OVERLAP: int = int(os.getenv("CONTEXT_MIN_OVERLAP", "20"))  # 无位置信息时，首尾重合达到该字符数才合并
+    CONTEXT_MIN_PASSAGE_TOKENS: int = int(os.getenv("CONTEXT_MIN_PASSAGE_TOKENS", "64"))  # 剩余预算低于该值时不再截断追加段落
+    HISTORY_MAX_TOKENS: int = int(os.getenv("HISTORY_MAX_TOKENS", "1024"))  # 带入提示词的历史对话token上限，超出时较早的对话压缩为摘要，0表示不带历史
+    HISTORY_COMPACT_TURNS: int = int(os.getenv("HISTORY_COMPACT_TURNS", "4"))  # 每次移入摘要的对话轮数，两次压缩之间提示词前缀不变
+    HISTORY_SUMMARY_TOKENS: int = int(os.getenv("HISTORY_SUMMARY_TOKENS", "256"))  # 对话摘要的token上限
+    HISTORY_SUMMARY_LLM: bool = os.getenv("HISTORY_SUMMARY_LLM", "true").lower() == "true"  # 是否由模型生成对话摘要，否则只保留较早的问题
+    
+    # 近似检索索引配置
+    INDEX_TYPE: str = os.getenv("INDEX_TYPE", "auto")  # 索引类型: auto/flat/ivfflat/hnsw/ivfpq
+    VECTOR_STORAGE: str = os.getenv("VECTOR_STORAGE", "float32")  # 索引中向量的存储精度: float32/fp16/int8，全精度向量保留在磁盘上用于重排
+    RESCORE_FACTOR: int = int(os.getenv("RESCORE_FACTOR", "4"))  # 压缩索引多取候选的倍数，候选用全精度向量精确重排
+    ANN_AUTO_FLAT_MAX: int = int(os.getenv("ANN_AUTO_FLAT_MAX", "50000"))  # auto模式下向量数低于该值使用flat
+    ANN_AUTO_HNSW_MAX: int = int(os.getenv("ANN_AUTO_HNSW_MAX", "1000000"))  # auto模式下向量数低于该值使用hnsw，否则使用ivfpq
+    ANN_TRAIN_SAMPLE: int = int(os.getenv("ANN_TRAIN_SAMPLE", "100000"))  # IVF训练样本数上限
+    IVF_NLIST: int = int(os.getenv("IVF_NLIST", "0"))  # IVF聚类中心数，0表示按向量数自动计算
+    IVF_NPROBE: int = int(os.getenv("IVF_NPROBE", "16"))  # IVF检索时探测的聚类数
+    PQ_M: int = int(os.getenv("PQ_M", "64"))  # PQ子空间数，需能整除向量维度
+    HNSW_M: int = int(os.getenv("HNSW_M", "32"))  # HNSW每个节点的邻居数
+    HNSW_EF_CONSTRUCTION: int = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))  # HNSW构建时的搜索宽度
+    HNSW_EF_SEARCH: int = int(os.getenv("HNSW_EF_SEARCH", "64"))  # HNSW检索时的搜索宽度
+    SEARCH_THREADS: int = int(os.getenv("SEARCH_THREADS", "0"))  # 并行检索各分段的线程数，0表示按CPU核数自动设置(最多8)
+    FAISS_OMP_THREADS: int = int(os.getenv("FAISS_OMP_THREADS", "0"))  # 每个检索线程内FAISS使用的OpenMP线程数，0表示CPU核数除以检索线程数
+    
+    # embedding缓存配置
+    EMBED_CACHE_ENABLED: bool = os.getenv("EMBED_CACHE_ENABLED", "true").lower() == "true"  # 是否启用embedding缓存
+    EMBED_CACHE_PATH: str = os.getenv("EMBED_CACHE_PATH", os.path.join(os.getenv("VECTOR_DB_PATH", "./vector_db"), "embedding_cache.sqlite"))  # 缓存文件路径
+    EMBED_CACHE_MAX_ENTRIES: int = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "500000"))  # 缓存最大条目数
+    EMBED_BATCH_SIZE: int = int(os.getenv("EMBED_BATCH_SIZE", "64"))  # 未命中分块每批请求embedding模型的数量
+    
+    # 近似重复过滤配置
+    NEAR_DUP_ENABLED: bool = os.getenv("NEAR_DUP_ENABLED", "true").lower() == "true"  # 入库时是否跳过与已有分块近似重复的分块
+    NEAR_DUP_THRESHOLD: float = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9"))  # 视为重复的最低Jaccard相似度
+    NEAR_DUP_NUM_PERM: int = int(os.getenv("NEAR_DUP_NUM_PERM", "128"))  # MinHash签名长度
+    NEAR_DUP_BANDS: int = int(os.getenv("NEAR_DUP_BANDS", "16"))  # LSH分段数，需整除签名长度
+    NEAR_DUP_SHINGLE_SIZE: int = int(os.getenv("NEAR_DUP_SHINGLE_SIZE", "5"))  # 字符n-gram的长度
     
     # 存储路径
-    CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", "500"))  # 文档分块大小
-    CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "100"))  # 分块重叠大小
+    CHUNKER: str = os.getenv("CHUNKER", "token").lower()  # 文本分割器: token(按token预算、句子边界分割) 或 recursive(按字符数分割)
+    CHUNK_TOKENS: int = int(os.getenv("CHUNK_TOKENS", "320"))  # token分割器每个分块的token上限
+    CHUNK_OVERLAP_TOKENS: int = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))  # token分割器相邻分块重叠的token数
+    CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", "500"))  # recursive分割器的分块字符数
+    CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "100"))  # recursive分割器的分块重叠字符数
     VECTOR_DIMENSIONS: int = 4096  # 向量维度，根据实际使用的模型调整
     
+    # PDF解析配置
+    PDF_PROCESS_POOL_ENABLED: bool = os.getenv("PDF_PROCESS_POOL_ENABLED", "true").lower() == "true"  # 大文件是否使用进程池分片解析
+    PDF_PROCESS_POOL_MIN_PAGES: int = int(os.getenv("PDF_PROCESS_POOL_MIN_PAGES", "100"))  # 页数达到该值才使用进程池
+    PDF_PAGES_PER_SHARD: int = int(os.getenv("PDF_PAGES_PER_SHARD", "20"))  # 每个分片包含的页数
+    
+    # 入库流水线配置
+    INGEST_PIPELINE_ENABLED: bool = os.getenv("INGEST_PIPELINE_ENABLED", "true").lower() == "true"  # 是否使用流式入库流水线
+    INGEST_QUEUE_SIZE: int = int(os.getenv("INGEST_QUEUE_SIZE", "8"))  # 流水线各阶段之间队列的容量
+    INGEST_EMBED_CONCURRENCY: int = int(os.getenv("INGEST_EMBED_CONCURRENCY", "2"))  # 并发向量化的批次数
+    INGEST_MAX_JOBS: int = int(os.getenv("INGEST_MAX_JOBS", "2"))  # 同时执行的后台入库任务数
+    INGEST_JOB_HISTORY: int = int(os.getenv("INGEST_JOB_HISTORY", "100"))  # 保留的已结束入库任务数
+    INGEST_STATUS_INTERVAL: float = float(os.getenv("INGEST_STATUS_INTERVAL", "1.0"))  # 界面刷新入库进度的间隔(秒)
+    
+    # 启动配置
+    STARTUP_PRELOAD_INDEX: bool = os.getenv("STARTUP_PRELOAD_INDEX", "true").lower() == "true"  # 启动时预加载索引文件到页缓存
+    STARTUP_WARMUP_ENABLED: bool = os.getenv("STARTUP_WARMUP_ENABLED", "true").lower() == "true"  # 启动时预热生成和embedding模型
+    STARTUP_WARMUP_TIMEOUT: float = float(os.getenv("STARTUP_WARMUP_TIMEOUT", "120"))  # 等待Ollama就绪并完成预热的最长时间(秒)
+
+    # 监控指标配置
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"  # 是否采集各阶段耗时等指标
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9464"))  # Prometheus指标和 /ready 就绪端点的端口，0表示不启动
+    OTLP_ENDPOINT: str = os.getenv("OTLP_ENDPOINT", "")  # OTLP(gRPC)导出地址，为空时不导出
+    OTLP_SERVICE_NAME: str = os.getenv("OTLP_SERVICE_NAME", "ragchat")  # 导出时的服务名
+    
     # 日志配置
     LOG_DIR: str = os.path.join(os.path.dirname(os.path.dirname(__file__)), "logs")  # 日志目录
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")  # 日志级别
     LOG_FORMAT: str = "[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s"  # 日志格式
     LOG_DATE_FORMAT: str = "%Y-%m-%d %H:%M:%S"  # 日期格式
     LOG_MAX_BYTES: int = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 单个日志文件最大大小
+    LOG_BACKUP_COUNT: int = int(os.getenv("LOG_BACKUP_COUNT", "10"))  # 每天按大小轮转保留的文件数
+    LOG_JSON: bool = os.getenv("LOG_JSON", "true").lower() == "true"  # 日志文件是否使用JSON格式
+    LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 后台写入队列容量，队列满时丢弃日志
+    LOG_MAX_MESSAGE_CHARS: int = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "2000"))  # 单条日志消息的最大字符数
+    LOG_MAX_FIELD_CHARS: int = int(os.getenv("LOG_MAX_FIELD_CHARS", "500"))  # 结构化字段的最大字符数
+    LOG_CONTENT_FIELDS: str = os.getenv("LOG_CONTENT_FIELDS", "question,answer,context,prompt")  # 按采样率记录的大段内容字段
+    LOG_CONTENT_SAMPLE_RATE: float = float(os.getenv("LOG_CONTENT_SAMPLE_RATE", "1.0"))  # 大段内容字段的采样率，未采中时只记录长度
     
     class Config:
         env_file = ".env"
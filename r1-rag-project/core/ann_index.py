@@ -0,0 +1,329 @@
+from config.config import settings
+from utils.logger import logger
+import numpy as np
+import faiss
+import math
+import time
+import os
+
+# 支持的索引类型
+INDEX_TYPES = ("flat", "ivfflat", "hnsw", "ivfpq")
+# 索引中向量的存储精度
+VECTOR_STORAGE_TYPES = ("float32", "fp16", "int8")
+
+
+def select_index_type(num_vectors: int) -> str:
+    """
+    确定索引类型
+
+    INDEX_TYPE 为 auto 时按向量数选择：
+    - 少于 ANN_AUTO_FLAT_MAX：精确检索(flat)，暴力扫描足够快
+    - 少于 ANN_AUTO_HNSW_MAX：HNSW，召回率高、延迟低
+    - 更多：IVF-PQ，压缩向量以控制内存
+    """
+    index_type = settings.INDEX_TYPE.lower()
+    if index_type != "auto":
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"不支持的索引类型: {settings.INDEX_TYPE}")
+        return index_type
+    if num_vectors < settings.ANN_AUTO_FLAT_MAX:
+        return "flat"
+    if num_vectors < settings.ANN_AUTO_HNSW_MAX:
+        return "hnsw"
+    return "ivfpq"
+
+
+def _scalar_quantizer(storage: str):
+    """存储精度对应的FAISS标量量化类型，float32不量化时返回None"""
+    storage = storage.lower()
+    if storage not in VECTOR_STORAGE_TYPES:
+        raise ValueError(f"不支持的向量存储精度: {storage}")
+    if storage == "fp16":
+        return faiss.ScalarQuantizer.QT_fp16
+    if storage == "int8":
+        return faiss.ScalarQuantizer.QT_8bit
+    return None
+
+
+def _ivf_nlist(num_vectors: int) -> int:
+    """IVF聚类中心数：默认取 4*sqrt(n)，并保证每个中心至少有39个训练样本"""
+    nlist = settings.IVF_NLIST or int(4 * math.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // 39))
+
+
+def _training_sample(vectors: np.ndarray) -> np.ndarray:
+    """从向量中无放回随机抽取训练样本"""
+    if len(vectors) <= settings.ANN_TRAIN_SAMPLE:
+        return vectors
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(vectors), settings.ANN_TRAIN_SAMPLE, replace=False)
+    return vectors[np.sort(rows)]
+
+
+def build_index(vectors, index_type: str = None, storage: str = None):
+    """
+    按索引类型构建FAISS索引，需要训练的索引先在样本上训练
+
+    storage 为 fp16/int8 时，flat、hnsw、ivfflat 索引中的向量以标量量化形式保存，
+    内存占用分别降为 float32 的 1/2、1/4；ivfpq 本身已压缩，不受影响。
+
+    Args:
+        vectors: 向量矩阵 (n, dim)
+        index_type: 索引类型，缺省时按 select_index_type 选择
+        storage: 向量存储精度，缺省为 VECTOR_STORAGE
+
+    Returns:
+        faiss.Index: 已添加全部向量的索引
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    num_vectors, dim = vectors.shape
+    index_type = index_type or select_index_type(num_vectors)
+    qtype = _scalar_quantizer(storage or settings.VECTOR_STORAGE)
+
+    if index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dim, settings.HNSW_M)
+        else:
+            index = faiss.IndexHNSWSQ(dim, qtype, settings.HNSW_M)
+        index.hnsw.efConstruction = settings.HNSW_EF_CONSTRUCTION
+        # 标量量化需要训练各维度的取值范围
+        index.train(_training_sample(vectors))
+    elif index_type in ("ivfflat", "ivfpq"):
+        nlist = _ivf_nlist(num_vectors)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivfpq":
+            # PQ每个子空间需要256个中心，样本不足或维度不能整除时退化为IVFFlat
+            if num_vectors < 256 * 39 or dim % settings.PQ_M != 0:
+                logger.warning(f"向量数({num_vectors})或维度({dim})不满足IVF-PQ要求，改用IVFFlat")
+                index_type = "ivfflat"
+            else:
+                index = faiss.IndexIVFPQ(quantizer, dim, nlist, settings.PQ_M, 8)
+        if index_type == "ivfflat":
+            if qtype is None:
+                index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+            else:
+                index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype)
+        index.train(_training_sample(vectors))
+    elif qtype is not None:
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        index.train(_training_sample(vectors))
+    else:
+        index = faiss.IndexFlatL2(dim)
+
+    index.add(vectors)
+    apply_search_params(index)
+    return index
+
+
+def apply_search_params(index):
+    """设置检索参数：IVF的nprobe、HNSW的efSearch"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = settings.IVF_NPROBE
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = settings.HNSW_EF_SEARCH
+
+
+def restricted_search_params(index, positions):
+    """
+    只在给定向量位置中检索的参数，检索时由FAISS在索引内部跳过其他向量
+
+    IVF和HNSW沿用索引上已设置的 nprobe/efSearch。
+    """
+    index = faiss.downcast_index(index)
+    selector = faiss.IDSelectorBatch(np.ascontiguousarray(positions, dtype="int64"))
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_thread_limits() -> tuple:
+    """
+    检索线程数和每个线程内FAISS的OpenMP线程数
+
+    分段在线程池中并行检索，单次 index.search 内部还会启动OpenMP线程；
+    两者的乘积不超过CPU核数，避免线程过量争抢。
+    """
+    cpus = os.cpu_count() or 1
+    threads = settings.SEARCH_THREADS or min(cpus, 8)
+    omp_threads = settings.FAISS_OMP_THREADS or max(1, cpus // threads)
+    return max(1, threads), omp_threads
+
+
+def index_type_of(index) -> str:
+    """返回索引对应的类型名"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, (faiss.IndexIVFFlat, faiss.IndexIVFScalarQuantizer)):
+        return "ivfflat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def storage_of(index) -> str:
+    """返回索引中向量的存储精度：float32/fp16/int8，PQ压缩的索引为pq"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        qtype = index.sq.qtype
+        return "fp16" if qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return "float32"
+
+
+def is_compressed(index) -> bool:
+    """索引中的向量是否有损压缩，压缩索引的候选需要用原始向量重新计算距离"""
+    return storage_of(index) != "float32"
+
+
+def rescore(queries, positions, full_vectors, k: int):
+    """
+    用全精度向量精确重排压缩索引返回的候选
+
+    Args:
+        queries: 查询向量 (q, dim)
+        positions: 压缩索引返回的候选位置 (q, n)，-1 表示空位
+        full_vectors: 全精度向量，通常是 vectors.npy 的内存映射，只读取候选所在的行
+        k: 每个查询保留的结果数
+
+    Returns:
+        tuple: (距离, 位置)，形状均为 (q, k)，不足k个时以 inf/-1 填充
+    """
+    distances = np.full((len(queries), k), np.inf, dtype="float32")
+    result = np.full((len(queries), k), -1, dtype="int64")
+    for row, (query, candidates) in enumerate(zip(queries, positions)):
+        candidates = np.unique(candidates[candidates >= 0])
+        if not len(candidates):
+            continue
+        # 按位置顺序读取，内存映射文件上接近顺序访问
+        exact = np.asarray(full_vectors[candidates], dtype="float32")
+        scores = ((exact - query) ** 2).sum(axis=1)
+        top = np.argsort(scores)[:k]
+        distances[row, :len(top)] = scores[top]
+        result[row, :len(top)] = candidates[top]
+    return distances, result
+
+
+def index_bytes(index) -> int:
+    """索引序列化后的字节数，近似为加载到内存后的占用"""
+    return int(faiss.serialize_index(index).size)
+
+
+def evaluate_index_types(vectors, queries, k: int = 10, index_types=INDEX_TYPES) -> list:
+    """
+    对比各索引类型相对精确检索的 recall@k 和延迟
+
+    Args:
+        vectors: 语料向量 (n, dim)
+        queries: 查询向量 (q, dim)
+        k: 召回数量
+        index_types: 需要对比的索引类型
+
+    Returns:
+        list: 每种索引类型一条报告
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for index_type in index_types:
+        started = time.perf_counter()
+        index = build_index(vectors, index_type)
+        build_seconds = time.perf_counter() - started
+
+        # 逐条查询计时，得到单次查询的延迟分布
+        latencies, found = [], []
+        for query in queries:
+            started = time.perf_counter()
+            _, ids = index.search(query.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - started)
+            found.append(ids[0])
+
+        hits = sum(
+            len(set(row[row >= 0]) & set(expected))
+            for row, expected in zip(found, truth)
+        )
+        latencies = np.array(latencies) * 1000
+        report.append({
+            "index_type": index_type_of(index),
+            "requested": index_type,
+            "recall_at_k": round(hits / (len(queries) * k), 4),
+            "latency_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+            "latency_ms_p99": round(float(np.percentile(latencies, 99)), 3),
+            "build_seconds": round(build_seconds, 2),
+        })
+    return report
+
+
+def evaluate_storage_modes(vectors, queries, k: int = 10, index_type: str = "flat",
+                           storages=VECTOR_STORAGE_TYPES, rescore_factor: int = None) -> list:
+    """
+    对比各存储精度相对 float32 精确检索的内存占用、recall@k 和延迟
+
+    压缩索引分别报告直接检索和多取 rescore_factor 倍候选后用全精度向量重排的召回率。
+
+    Args:
+        vectors: 语料向量 (n, dim)
+        queries: 查询向量 (q, dim)
+        k: 召回数量
+        index_type: 索引类型
+        storages: 需要对比的存储精度
+        rescore_factor: 重排时多取候选的倍数，缺省为 RESCORE_FACTOR
+
+    Returns:
+        list: 每种存储精度一条报告
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    rescore_factor = rescore_factor or settings.RESCORE_FACTOR
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+    baseline_bytes = index_bytes(exact)
+
+    def recall(found) -> float:
+        hits = sum(len(set(row[row >= 0]) & set(expected)) for row, expected in zip(found, truth))
+        return round(hits / (len(queries) * k), 4)
+
+    report = []
+    for storage in storages:
+        index = build_index(vectors, index_type, storage)
+        size = index_bytes(index)
+        entry = {
+            "index_type": index_type_of(index),
+            "storage": storage_of(index),
+            "index_mb": round(size / 1024 / 1024, 2),
+            "bytes_per_vector": round(size / len(vectors), 1),
+            "memory_ratio": round(size / baseline_bytes, 3),
+        }
+
+        latencies, found = [], []
+        for query in queries:
+            started = time.perf_counter()
+            _, ids = index.search(query.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - started)
+            found.append(ids[0])
+        entry["recall_at_k"] = recall(found)
+        entry["latency_ms_p50"] = round(float(np.percentile(np.array(latencies) * 1000, 50)), 3)
+
+        if is_compressed(index):
+            latencies, found = [], []
+            for query in queries:
+                started = time.perf_counter()
+                _, ids = index.search(query.reshape(1, -1), k * rescore_factor)
+                _, ids = rescore(query.reshape(1, -1), ids, vectors, k)
+                latencies.append(time.perf_counter() - started)
+                found.append(ids[0])
+            entry["rescored_recall_at_k"] = recall(found)
+            entry["rescored_latency_ms_p50"] = round(float(np.percentile(np.array(latencies) * 1000, 50)), 3)
+        report.append(entry)
+    return report
@@ -0,0 +1,168 @@
+from core.embedding_cache import normalize_text
+from utils.logger import logger
+from collections import OrderedDict
+import numpy as np
+import faiss
+import threading
+import time
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题文本：统一Unicode和空白、忽略大小写及句末标点"""
+    return normalize_text(question).lower().rstrip("?？。.!！~～ ")
+
+
+class AnswerCache:
+    """
+    语义答案缓存
+
+    先按规范化问题精确匹配，再在已缓存问题的向量上做相似度检索，
+    相似度超过阈值时直接返回已有答案。缓存项绑定语料版本，
+    索引内容变化后全部失效；同时按TTL过期、按LRU淘汰。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        """
+        Args:
+            max_entries: 最大缓存条目数
+            ttl: 缓存项有效期(秒)
+            threshold: 语义命中所需的最小余弦相似度
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # 条目ID -> 缓存项，按访问顺序排列，用于LRU淘汰
+        self._entries = OrderedDict()
+        # (作用域, 规范化问题) -> 条目ID
+        self._exact = {}
+        # 问题向量的内积索引，条目ID作为向量ID，便于删除
+        self._index = None
+        self._next_id = 0
+        self._version = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def _check_version(self, corpus_version):
+        """语料版本变化时清空缓存"""
+        if corpus_version != self._version:
+            if self._entries:
+                logger.info(f"语料版本变化({self._version} -> {corpus_version})，清空答案缓存")
+            self._entries.clear()
+            self._exact.clear()
+            self._index = None
+            self._version = corpus_version
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._exact.pop((entry["scope"], entry["question"]), None)
+        if self._index is not None:
+            self._index.remove_ids(np.array([entry_id], dtype="int64"))
+
+    def _expire(self):
+        """删除过期条目；条目按访问顺序排列，但TTL按写入时间计算，因此需要全量检查"""
+        now = time.time()
+        expired = [
+            entry_id for entry_id, entry in self._entries.items()
+            if now - entry["created_at"] > self.ttl
+        ]
+        for entry_id in expired:
+            self._remove(entry_id)
+
+    @staticmethod
+    def _normalize_vector(vector):
+        vector = np.asarray(vector, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup_exact(self, question: str, scope: str, corpus_version):
+        """按规范化问题精确查找，返回答案或None"""
+        with self._lock:
+            self._check_version(corpus_version)
+            self._expire()
+            entry_id = self._exact.get((scope, normalize_question(question)))
+            if entry_id is None:
+                return None
+            return self._hit(entry_id, "exact")
+
+    def lookup_similar(self, vector, scope: str, corpus_version):
+        """在已缓存问题的向量上查找最相似的问题，相似度达到阈值时返回答案"""
+        with self._lock:
+            self._check_version(corpus_version)
+            if self._index is None or self._index.ntotal == 0:
+                self.misses += 1
+                return None
+            query = self._normalize_vector(vector)
+            scores, ids = self._index.search(query, min(8, self._index.ntotal))
+            for score, entry_id in zip(scores[0], ids[0]):
+                if entry_id < 0 or score < self.threshold:
+                    break
+                entry = self._entries.get(int(entry_id))
+                if entry is not None and entry["scope"] == scope:
+                    return self._hit(int(entry_id), "semantic")
+            self.misses += 1
+            return None
+
+    def _hit(self, entry_id, kind: str):
+        entry = self._entries[entry_id]
+        self._entries.move_to_end(entry_id)
+        if kind == "exact":
+            self.exact_hits += 1
+        else:
+            self.semantic_hits += 1
+        self.saved_seconds += entry["latency"]
+        logger.info(f"答案缓存命中({kind})，节省约 {entry['latency']:.2f} 秒，统计: {self._stats_locked()}")
+        return entry["answer"]
+
+    def store(self, question: str, vector, answer: str, scope: str, corpus_version, latency: float):
+        """
+        写入缓存
+
+        Args:
+            question: 用户问题
+            vector: 问题向量，为None时只支持精确匹配
+            answer: 生成的回答
+            scope: 作用域，区分普通对话和文档问答
+            corpus_version: 生成回答时的语料版本
+            latency: 生成该回答的耗时(秒)，用于统计节省的时间
+        """
+        with self._lock:
+            self._check_version(corpus_version)
+            key = (scope, normalize_question(question))
+            if key in self._exact:
+                self._remove(self._exact[key])
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "scope": scope,
+                "question": key[1],
+                "answer": answer,
+                "latency": latency,
+                "created_at": time.time(),
+            }
+            self._exact[key] = entry_id
+            if vector is not None:
+                query = self._normalize_vector(vector)
+                if self._index is None:
+                    self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(query.shape[1]))
+                self._index.add_with_ids(query, np.array([entry_id], dtype="int64"))
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _stats_locked(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 2),
+        }
+
+    def stats(self) -> dict:
+        """返回命中率和节省的时间"""
+        with self._lock:
+            return self._stats_locked()
@@ -0,0 +1,123 @@
+from utils.token_counter import get_token_counter
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+
+
+class ContextBuilder:
+    """
+    上下文组装
+
+    检索到的分块在拼入提示词之前：
+    - 同一页中重叠或相邻的分块合并为一段，去掉因 CHUNK_OVERLAP 重复的文本
+    - 删除与已选内容重复或被其包含的段落
+    - 按检索排名把段落装入 CONTEXT_MAX_TOKENS 的token预算，最后一段按剩余预算截断
+    """
+
+    def __init__(self, max_tokens: int = None, token_counter=None):
+        self.max_tokens = max_tokens or settings.CONTEXT_MAX_TOKENS
+        self.token_counter = token_counter or get_token_counter()
+
+    @staticmethod
+    def _page_key(doc):
+        return doc.metadata.get("source"), doc.metadata.get("page")
+
+    @staticmethod
+    def _text_overlap(left: str, right: str) -> int:
+        """left 的后缀与 right 的前缀重合的最大长度"""
+        limit = min(len(left), len(right), settings.CHUNK_OVERLAP * 2)
+        for size in range(limit, 0, -1):
+            if left.endswith(right[:size]):
+                return size
+        return 0
+
+    def _merge_page(self, docs: list) -> list:
+        """
+        合并同一页的分块
+
+        有 start_index 时按位置排序，重叠或间隔很小的分块拼接为一段；
+        没有位置信息的旧分块按文本首尾重合判断是否相连。
+        """
+        if all("start_index" in doc.metadata for doc in docs):
+            docs = sorted(docs, key=lambda doc: doc.metadata["start_index"])
+            passages = []
+            end = None
+            text = ""
+            for doc in docs:
+                doc_start = doc.metadata["start_index"]
+                doc_end = doc_start + len(doc.page_content)
+                # 分割时丢弃的分隔符只有几个字符，间隔不超过该值即视为相邻
+                if end is not None and doc_start <= end + settings.CONTEXT_ADJACENT_GAP:
+                    if doc_end > end:
+                        overlap = max(0, end - doc_start)
+                        text += ("" if overlap else "\n") + doc.page_content[overlap:]
+                        end = doc_end
+                else:
+                    if end is not None:
+                        passages.append(text)
+                    end, text = doc_end, doc.page_content
+            passages.append(text)
+            return passages
+
+        passages = []
+        for doc in docs:
+            text = doc.page_content
+            for i, passage in enumerate(passages):
+                if self._text_overlap(passage, text) >= settings.CONTEXT_MIN_OVERLAP:
+                    passages[i] = passage + text[self._text_overlap(passage, text):]
+                    break
+                if self._text_overlap(text, passage) >= settings.CONTEXT_MIN_OVERLAP:
+                    passages[i] = text + passage[self._text_overlap(text, passage):]
+                    break
+            else:
+                passages.append(text)
+        return passages
+
+    @metrics.timed("context_build")
+    def build(self, docs: list) -> str:
+        """
+        把检索结果组装为上下文
+
+        Args:
+            docs: 按相关性排序的分块
+
+        Returns:
+            str: 不超过token预算的上下文
+        """
+        # 按页分组，分组的顺序取组内排名最靠前的分块
+        groups = {}
+        for doc in docs:
+            groups.setdefault(self._page_key(doc), []).append(doc)
+
+        passages = []
+        for page_docs in groups.values():
+            passages.extend(self._merge_page(page_docs))
+
+        selected, used = [], 0
+        for passage in passages:
+            passage = passage.strip()
+            # 去掉与已选内容重复或被其包含的段落
+            if not passage or any(passage in chosen for chosen in selected):
+                continue
+            kept = [chosen for chosen in selected if chosen not in passage]
+            if len(kept) != len(selected):
+                selected = kept
+                used = sum(self.token_counter.count(chosen) for chosen in selected)
+
+            tokens = self.token_counter.count(passage)
+            remaining = self.max_tokens - used
+            if tokens > remaining:
+                # 剩余预算过小时不再截断追加，避免只剩半句话
+                if remaining >= settings.CONTEXT_MIN_PASSAGE_TOKENS:
+                    selected.append(self.token_counter.truncate(passage, remaining))
+                    used = self.max_tokens
+                break
+            selected.append(passage)
+            used += tokens
+
+        context = "\n\n".join(selected)
+        logger.info(
+            f"上下文组装: {len(docs)} 个分块合并为 {len(passages)} 段，"
+            f"选用 {len(selected)} 段，约 {used}/{self.max_tokens} tokens"
+        )
+        return context
@@ -0,0 +1,231 @@
+from langchain_core.embeddings import Embeddings
+from utils.logger import logger
+# array 用于把向量紧凑地序列化为 float32 字节串
+from array import array
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+import re
+import os
+
+
+def normalize_text(text: str) -> str:
+    """规范化分块文本：统一Unicode形式并折叠空白，使仅有空白差异的分块命中同一缓存项"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    基于SQLite的持久化向量缓存
+
+    以 (embedding模型, 规范化文本哈希) 作为内容寻址的键，
+    按最近访问时间做容量受限的LRU淘汰，并统计命中/未命中次数。
+    """
+
+    def __init__(self, path: str, model: str, max_entries: int):
+        """
+        Args:
+            path: 缓存数据库文件路径
+            model: embedding模型名称，参与键计算，切换模型不会命中旧向量
+            max_entries: 缓存最大条目数，超出后淘汰最久未访问的条目
+        """
+        self.path = path
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # FAISS.from_documents 运行在工作线程中，连接需跨线程共享并加锁
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+
+    def make_key(self, text: str) -> str:
+        """计算分块文本的缓存键"""
+        digest = hashlib.sha256()
+        digest.update(self.model.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(normalize_text(text).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """批量查询缓存，返回 {key: 向量}，并刷新命中条目的访问时间"""
+        found = {}
+        if not keys:
+            return found
+        with self._lock:
+            # SQLite 单条语句的参数个数有限，分批查询
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: dict):
+        """批量写入缓存 {key: 向量}，写入后按容量淘汰"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector, last_access) VALUES (?, ?, ?, ?)",
+                [
+                    (key, len(vector), array("f", vector).tobytes(), now)
+                    for key, vector in items.items()
+                ],
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self):
+        """超出容量时淘汰最久未访问的条目，一次淘汰到容量的90%以减少频繁淘汰"""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        target = int(self.max_entries * 0.9)
+        removed = count - target
+        self._conn.execute(
+            """DELETE FROM embeddings WHERE key IN (
+                SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?
+            )""",
+            (removed,),
+        )
+        self.evictions += removed
+        logger.info(f"embedding缓存淘汰 {removed} 条，剩余 {target} 条")
+
+    def record(self, hits: int, misses: int):
+        """累计命中/未命中次数"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self) -> dict:
+        """返回缓存统计信息"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": size,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带持久化缓存的embedding包装器
+
+    文档分块先查缓存，只有未命中的分块按批次发送给底层模型（如OllamaEmbeddings）。
+    查询向量直接透传，不进入缓存。
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, batch_size: int):
+        """
+        Args:
+            embeddings: 底层embedding模型
+            cache: 持久化向量缓存
+            batch_size: 未命中分块每批发送给模型的数量
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+        self.batch_size = max(1, batch_size)
+
+    def _lookup(self, texts: list):
+        """查询缓存，返回 (键列表, 已命中的向量, 未命中的 {键: 文本})"""
+        keys = [self.cache.make_key(text) for text in texts]
+        vectors = self.cache.get_many(list(set(keys)))
+
+        # 同一批次内重复的分块只请求一次
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+
+        hits = sum(1 for key in keys if key in vectors)
+        self.cache.record(hits, len(keys) - hits)
+        return keys, vectors, missing
+
+    def embed_documents(self, texts: list) -> list:
+        """批量计算文档向量，优先使用缓存"""
+        keys, vectors, missing = self._lookup(texts)
+
+        if missing:
+            missing_keys = list(missing)
+            for start in range(0, len(missing_keys), self.batch_size):
+                batch_keys = missing_keys[start:start + self.batch_size]
+                batch_vectors = self.embeddings.embed_documents(
+                    [missing[key] for key in batch_keys]
+                )
+                computed = dict(zip(batch_keys, batch_vectors))
+                # 每批完成后立即落盘，中途失败时已完成的批次不会丢失
+                self.cache.put_many(computed)
+                vectors.update(computed)
+
+        logger.debug(
+            f"embedding缓存: 共 {len(keys)} 个分块，"
+            f"请求模型 {len(missing)}，累计统计 {self.cache.stats()}"
+        )
+        return [vectors[key] for key in keys]
+
+    async def aembed_documents(self, texts: list) -> list:
+        """异步批量计算文档向量，未命中的批次并发请求，由底层模型的限流器控制并发"""
+        keys, vectors, missing = await asyncio.to_thread(self._lookup, texts)
+
+        async def embed_batch(batch_keys):
+            batch_vectors = await self.embeddings.aembed_documents(
+                [missing[key] for key in batch_keys]
+            )
+            computed = dict(zip(batch_keys, batch_vectors))
+            await asyncio.to_thread(self.cache.put_many, computed)
+            vectors.update(computed)
+
+        missing_keys = list(missing)
+        await asyncio.gather(*(
+            embed_batch(missing_keys[start:start + self.batch_size])
+            for start in range(0, len(missing_keys), self.batch_size)
+        ))
+        logger.debug(f"embedding缓存: 共 {len(keys)} 个分块，请求模型 {len(missing)}")
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        """计算查询向量（不缓存）"""
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list:
+        return await self.embeddings.aembed_query(text)
+
+    async def aembed_queries(self, texts: list) -> list:
+        return await self.embeddings.aembed_queries(texts)
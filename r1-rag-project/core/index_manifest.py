@@ -0,0 +1,173 @@
+from utils.logger import logger
+import json
+import os
+import time
+
+
+class IndexManifest:
+    """
+    向量索引清单
+
+    记录分段索引的全部元数据，以JSON形式保存在向量库目录下：
+    - version: 索引版本号，每次保存清单（增删文档、合并分段）后递增
+    - corpus_version: 语料版本号，只在增删文档后递增；合并分段不改变可检索的内容，不递增，
+      答案缓存按它失效
+    - segments: 分段ID -> 分段信息（向量数、已删除分块）
+    - documents: 文档ID(文件内容哈希) -> 文档信息（来源、所在分段、分块ID、向量区间）；
+      文档删除后仍被其他文档引用的代表分块保留在 shared 条目中
+    - retired: 已被合并、等待删除的分段ID；其他进程可能仍在检索它们，下一次合并时才删除目录
+    """
+
+    FILE_NAME = "manifest.json"
+
+    def __init__(self, db_path: str):
+        self.path = os.path.join(db_path, self.FILE_NAME)
+        self.version = 0
+        self.corpus_version = 0
+        # 自上次保存以来是否增删过文档
+        self._corpus_changed = False
+        self.next_segment = 1
+        self.segments = {}
+        self.documents = {}
+        self.retired = []
+        # 最近一次读写时清单文件的状态，用于发现其他进程的修改
+        self._stamp = None
+
+    def _disk_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        # 每次保存都通过改名替换文件，inode随之变化
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def changed_on_disk(self) -> bool:
+        """清单文件是否已被其他进程修改"""
+        return self._disk_stamp() != self._stamp
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self):
+        """从磁盘加载清单"""
+        stamp = self._disk_stamp()
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self._stamp = stamp
+        self.version = data.get("version", 0)
+        # 旧版清单没有语料版本，沿用索引版本号
+        self.corpus_version = data.get("corpus_version", self.version)
+        self._corpus_changed = False
+        self.next_segment = data.get("next_segment", 1)
+        self.segments = data.get("segments", {})
+        self.documents = data.get("documents", {})
+        self.retired = data.get("retired", [])
+        logger.info(
+            f"已加载索引清单: 版本 {self.version}，"
+            f"{len(self.segments)} 个分段，{len(self.documents)} 个文档"
+        )
+
+    def save(self):
+        """原子地写入清单：先写临时文件再替换，避免崩溃时留下半个文件"""
+        self.version += 1
+        if self._corpus_changed:
+            self.corpus_version += 1
+            self._corpus_changed = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": self.version,
+                    "corpus_version": self.corpus_version,
+                    "next_segment": self.next_segment,
+                    "segments": self.segments,
+                    "documents": self.documents,
+                    "retired": self.retired,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._stamp = self._disk_stamp()
+
+    def new_segment_id(self) -> str:
+        """分配新的分段ID"""
+        segment_id = f"seg-{self.next_segment:06d}"
+        self.next_segment += 1
+        return segment_id
+
+    def add_segment(self, segment_id: str, num_vectors: int):
+        self.segments[segment_id] = {
+            "num_vectors": num_vectors,
+            "deleted": [],
+            "created_at": time.time(),
+        }
+
+    def add_document(self, doc_id: str, source: str, segment_id: str, chunk_ids: list, vector_range: tuple):
+        self._corpus_changed = True
+        self.documents[doc_id] = {
+            "source": source,
+            "file_hash": doc_id,
+            "segment": segment_id,
+            "chunk_ids": chunk_ids,
+            "vector_range": list(vector_range),
+            "added_at": time.time(),
+        }
+
+    def find_by_source(self, source: str):
+        """按文件名查找已索引的文档ID，共享条目不参与"""
+        for doc_id, doc in self.documents.items():
+            if doc["source"] == source and not doc.get("shared"):
+                return doc_id
+        return None
+
+    def remove_document(self, doc_id: str) -> dict:
+        """移除文档记录，并把它的分块记为所在分段的已删除分块"""
+        doc = self.documents.pop(doc_id)
+        self._corpus_changed = True
+        segment = self.segments.get(doc["segment"])
+        if segment is not None:
+            segment["deleted"].extend(doc["chunk_ids"])
+        return doc
+
+    def keep_shared(self, owner: str, doc: dict, chunk_ids: list):
+        """已移除文档中仍被其他文档引用的分块不删除，转入共享条目 owner"""
+        keep = set(chunk_ids)
+        segment = self.segments.get(doc["segment"])
+        if segment is not None:
+            segment["deleted"] = [chunk_id for chunk_id in segment["deleted"] if chunk_id not in keep]
+        self.documents[owner] = {
+            "source": doc["source"],
+            "file_hash": doc["file_hash"],
+            "segment": doc["segment"],
+            "chunk_ids": [chunk_id for chunk_id in doc["chunk_ids"] if chunk_id in keep],
+            "vector_range": doc["vector_range"],
+            "added_at": doc["added_at"],
+            "shared": True,
+        }
+
+    def release_shared(self, chunk_ids: list):
+        """把共享条目中不再被引用的分块记为已删除，条目为空时移除"""
+        released = set(chunk_ids)
+        if not released:
+            return
+        for doc_id in [doc_id for doc_id, doc in self.documents.items() if doc.get("shared")]:
+            doc = self.documents[doc_id]
+            gone = [chunk_id for chunk_id in doc["chunk_ids"] if chunk_id in released]
+            if not gone:
+                continue
+            self.segments[doc["segment"]]["deleted"].extend(gone)
+            self._corpus_changed = True
+            doc["chunk_ids"] = [chunk_id for chunk_id in doc["chunk_ids"] if chunk_id not in released]
+            if not doc["chunk_ids"]:
+                del self.documents[doc_id]
+
+    def deleted_ids(self, segment_id: str) -> set:
+        return set(self.segments[segment_id]["deleted"])
+
+    def live_vectors(self, segment_id: str) -> int:
+        segment = self.segments[segment_id]
+        return segment["num_vectors"] - len(segment["deleted"])
@@ -0,0 +1,344 @@
+from core.segmented_store import file_hash
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+from collections import OrderedDict
+import threading
+import asyncio
+import sqlite3
+import json
+import time
+import os
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# 界面上显示的状态和阶段名称
+_STATUS_LABELS = {
+    QUEUED: "排队中",
+    RUNNING: "处理中",
+    DONE: "已完成",
+    FAILED: "失败",
+    CANCELLED: "已取消",
+}
+_STAGE_LABELS = {
+    "queued": "等待空闲的入库线程",
+    "parse": "解析与分割",
+    "embed": "解析、向量化并写入",
+    "index": "写入索引",
+    "commit": "提交索引",
+    "reused": "复用已有索引",
+}
+
+JOBS_BY_STATUS = metrics.gauge("rag_ingest_jobs", "各状态的入库任务数", labels=("status",))
+
+
+class IngestJob:
+    """一个文件的入库任务，以文件内容哈希为ID"""
+
+    def __init__(self, job_id: str, pdf_path: str):
+        self.job_id = job_id
+        self.pdf_path = pdf_path
+        self.source = os.path.basename(pdf_path)
+        self.status = QUEUED
+        self.stage = "queued"
+        self.progress = {}
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "IngestJob":
+        """由其他工作进程保存的任务状态还原，只用于查询"""
+        job = cls(data["job_id"], data["source"])
+        for key in ("status", "stage", "progress", "error", "created_at", "started_at", "finished_at"):
+            setattr(job, key, data.get(key))
+        job.progress = job.progress or {}
+        return job
+
+    def as_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "source": self.source,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def describe(self) -> str:
+        """界面上显示的一行进度说明"""
+        text = f"**{self.source}**：{_STATUS_LABELS[self.status]}"
+        if self.status == RUNNING:
+            text += f" · {_STAGE_LABELS.get(self.stage, self.stage)}"
+        pages, total_pages = self.progress.get("pages", 0), self.progress.get("total_pages")
+        if pages or total_pages:
+            text += f" · 已解析 {pages}" + (f"/{total_pages}" if total_pages else "") + " 页"
+        if self.progress.get("chunks"):
+            text += f" · 已索引 {self.progress['chunks']} 个分块"
+        if self.progress.get("duplicates"):
+            text += f" · 跳过 {self.progress['duplicates']} 个重复分块"
+        if self.stage == "reused":
+            text += " · 文档已在索引中"
+        elif self.finished:
+            text += f" · 耗时 {self.finished_at - self.started_at:.1f} 秒"
+        if self.error:
+            text += f" · {self.error}"
+        return text
+
+
+class JobRegistry:
+    """
+    入库任务状态表
+
+    保存在向量库目录下的SQLite中，同一向量库的多个工作进程共享：
+    - 执行任务的进程定期写入任务状态，同时作为心跳；心跳中断的未结束任务视为执行进程已退出
+    - 其他进程收到的查询按表中的状态返回，取消请求记为标记，由执行任务的进程在下一次心跳时取消
+    """
+
+    FILE_NAME = "ingest_jobs.sqlite"
+    # 连续多少次心跳没有写入时，认为执行任务的进程已退出
+    HEARTBEAT_MISSES = 10
+
+    def __init__(self, db_path: str, history: int, interval: float):
+        self.path = os.path.join(db_path, self.FILE_NAME)
+        self.history = history
+        self.stale_after = max(10.0, interval * self.HEARTBEAT_MISSES)
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    heartbeat REAL NOT NULL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def register(self, job: IngestJob):
+        """登记新任务，覆盖同一文件此前失败或取消的任务"""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, status, data, heartbeat) VALUES (?, ?, ?, ?)",
+                (job.job_id, job.status, json.dumps(job.as_dict(), ensure_ascii=False), time.time()),
+            )
+            if job.finished:
+                self._trim(conn)
+
+    def save(self, job: IngestJob) -> bool:
+        """写入任务的最新状态并刷新心跳，返回是否有其他进程请求取消该任务"""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, data = ?, heartbeat = ? WHERE job_id = ?",
+                (job.status, json.dumps(job.as_dict(), ensure_ascii=False), time.time(), job.job_id),
+            )
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job.job_id,)).fetchone()
+            if job.finished:
+                self._trim(conn)
+        return bool(row and row[0])
+
+    def _trim(self, conn):
+        """只保留最近的已结束任务"""
+        conn.execute(
+            """DELETE FROM jobs WHERE job_id IN (
+                SELECT job_id FROM jobs WHERE status IN (?, ?, ?) ORDER BY heartbeat DESC LIMIT -1 OFFSET ?
+            )""",
+            (DONE, FAILED, CANCELLED, self.history),
+        )
+
+    def load(self, job_id: str):
+        """读取任务状态，不存在时返回None；心跳中断的未结束任务标记为失败"""
+        row = self._conn().execute("SELECT data, heartbeat FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = IngestJob.from_dict(json.loads(row[0]))
+        if not job.finished and time.time() - row[1] > self.stale_after:
+            job.status, job.error = FAILED, "执行任务的工作进程已退出"
+            job.finished_at = row[1]
+            job.started_at = job.started_at or job.finished_at
+        return job
+
+    def request_cancel(self, job_id: str) -> bool:
+        """请求取消其他进程中未结束的任务"""
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status IN (?, ?) AND heartbeat >= ?",
+                (job_id, QUEUED, RUNNING, time.time() - self.stale_after),
+            )
+        return cursor.rowcount > 0
+
+
+class IngestJobManager:
+    """
+    后台入库任务管理
+
+    上传的文件按内容哈希登记为任务后立即返回，任务在后台以最多 INGEST_MAX_JOBS 个并发执行：
+    - 同一文件重复上传时复用进行中的任务，已索引过的文件直接标记为完成
+    - 任务的阶段和页数、分块数进度可随时查询，界面定时刷新显示
+    - 任务可以取消，流水线各阶段随之停止，未提交的分块不会写入索引
+    - 任务状态同时写入向量库目录下的任务状态表，多个工作进程共享同一向量库时，
+      任一进程都能查询和取消其他进程执行中的任务
+    """
+
+    def __init__(self, pdf_processor, vector_store, ingest_pipeline, max_jobs: int = None, history: int = None):
+        """
+        Args:
+            pdf_processor: PDF处理器
+            vector_store: 向量存储
+            ingest_pipeline: 流式入库流水线
+            max_jobs: 同时执行的任务数
+            history: 保留的已结束任务数
+        """
+        self.pdf_processor = pdf_processor
+        self.vector_store = vector_store
+        self.ingest_pipeline = ingest_pipeline
+        self.max_jobs = max(1, max_jobs or settings.INGEST_MAX_JOBS)
+        self.history = history or settings.INGEST_JOB_HISTORY
+        self.jobs = OrderedDict()
+        self.registry = JobRegistry(vector_store.store.db_path, self.history, settings.INGEST_STATUS_INTERVAL)
+        self._slots = None
+        for status in _STATUS_LABELS:
+            JOBS_BY_STATUS.set_function(
+                lambda status=status: sum(job.status == status for job in list(self.jobs.values())),
+                status=status
+            )
+
+    async def submit(self, pdf_path: str) -> IngestJob:
+        """
+        登记入库任务并立即返回
+
+        内容相同的文件复用本进程或其他工作进程中进行中、已完成的任务；失败或取消的任务重新执行。
+        """
+        job_id = await asyncio.to_thread(file_hash, pdf_path)
+        job = self.jobs.get(job_id) or await asyncio.to_thread(self.registry.load, job_id)
+        if job is not None and job.status not in (FAILED, CANCELLED):
+            logger.info(f"复用已有入库任务: {job.source} ({job.status})")
+            return job
+
+        job = IngestJob(job_id, pdf_path)
+        self.jobs[job_id] = job
+        self.jobs.move_to_end(job_id)
+        self._trim()
+
+        store = self.vector_store.store
+        await asyncio.to_thread(store.load)
+        # 其他工作进程可能已经索引过该文件
+        await asyncio.to_thread(store.refresh)
+        if store.has_document(job_id):
+            job.status, job.stage = DONE, "reused"
+            job.started_at = job.finished_at = time.time()
+            await asyncio.to_thread(self.registry.register, job)
+            logger.info(f"文档已在索引中，复用已有索引: {job.source}")
+            return job
+
+        await asyncio.to_thread(self.registry.register, job)
+        job.task = asyncio.create_task(self._run(job))
+        logger.info(f"已登记入库任务: {job.source}")
+        return job
+
+    def get(self, job_id: str) -> IngestJob:
+        """查询任务，本进程中没有时读取其他工作进程保存的状态"""
+        return self.jobs.get(job_id) or self.registry.load(job_id)
+
+    def list_jobs(self) -> list:
+        return list(self.jobs.values())
+
+    def cancel(self, job_id: str) -> bool:
+        """取消排队中或进行中的任务；任务由其他工作进程执行时，在其下一次心跳时取消"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return self.registry.request_cancel(job_id)
+        if job.finished or job.task is None:
+            return False
+        job.task.cancel()
+        return True
+
+    async def wait(self, job_id: str) -> IngestJob:
+        """等待任务结束"""
+        job = self.jobs[job_id]
+        if job.task is not None:
+            await asyncio.wait([job.task])
+        return job
+
+    def _trim(self):
+        """只保留最近的已结束任务"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    async def _watch(self, job: IngestJob):
+        """定期保存任务状态作为心跳；其他工作进程请求取消时取消任务"""
+        while True:
+            await asyncio.sleep(settings.INGEST_STATUS_INTERVAL)
+            if await asyncio.to_thread(self.registry.save, job):
+                logger.info(f"其他工作进程请求取消入库任务: {job.source}")
+                job.task.cancel()
+                return
+
+    async def _run(self, job: IngestJob):
+        # 信号量在事件循环中创建
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_jobs)
+        watcher = asyncio.create_task(self._watch(job))
+        try:
+            async with self._slots:
+                job.status, job.started_at = RUNNING, time.time()
+                await self._ingest(job)
+            status = DONE
+        except asyncio.CancelledError:
+            status = CANCELLED
+        except Exception as e:
+            status, job.error = FAILED, str(e)
+            logger.error(f"入库任务失败: {job.source}: {str(e)}", exc_info=True)
+        watcher.cancel()
+        job.finished_at = time.time()
+        job.started_at = job.started_at or job.finished_at
+        job.status = status
+        try:
+            await asyncio.to_thread(self.registry.save, job)
+        except Exception as e:
+            logger.warning(f"保存入库任务状态失败: {job.source}: {str(e)}")
+        logger.info(f"入库任务结束: {job.describe()}")
+
+    async def _ingest(self, job: IngestJob):
+        if settings.INGEST_PIPELINE_ENABLED:
+            # 流式入库：逐页解析、分割、向量化并写入索引
+            job.stage = "embed"
+
+            def on_progress(stats):
+                job.progress = stats
+                job.stage = stats.get("stage", job.stage)
+
+            job.progress = await self.ingest_pipeline.run(job.pdf_path, on_progress, doc_id=job.job_id)
+        else:
+            job.stage = "parse"
+            chunks = await self.pdf_processor.process_pdf(job.pdf_path)
+            job.stage = "index"
+            job.progress = {"chunks": len(chunks)}
+            await self.vector_store.get_vectorstore(chunks, job.pdf_path)
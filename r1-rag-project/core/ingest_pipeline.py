@@ -0,0 +1,202 @@
+from core.segmented_store import file_hash, make_chunk_id
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+import asyncio
+import threading
+import time
+import os
+
+# 各阶段之间传递的结束标记
+_DONE = object()
+
+
+class IngestPipeline:
+    """
+    流式入库流水线
+
+    解析 -> 分割 -> 向量化 -> 写入索引 四个阶段并发运行，阶段之间用有界队列连接：
+    - 解析阶段逐页读取PDF，下游处理不过来时在队列上阻塞（背压）
+    - 分割后的分块先过滤与已有分块近似重复的分块，再按 EMBED_BATCH_SIZE 组成微批次
+    - 多个向量化协程并发请求embedding模型
+    - 写入阶段按批次顺序把向量追加到分段构建器中
+
+    内存中只保留队列中的少量页面和批次，总耗时接近最慢阶段的耗时。
+    """
+
+    def __init__(self, pdf_processor, vector_store):
+        """
+        Args:
+            pdf_processor: PDF处理器，提供逐页读取和分割
+            vector_store: 向量存储，提供embedding模型和分段存储
+        """
+        self.pdf_processor = pdf_processor
+        self.vector_store = vector_store
+        self.queue_size = settings.INGEST_QUEUE_SIZE
+        self.batch_size = settings.EMBED_BATCH_SIZE
+        self.embed_workers = max(1, settings.INGEST_EMBED_CONCURRENCY)
+
+    async def run(self, pdf_path: str, progress=None, doc_id: str = None) -> dict:
+        """
+        把一个PDF文件流式写入向量存储
+
+        Args:
+            pdf_path: PDF文件路径
+            progress: 可选回调，每写入一个批次后及提交索引前以统计信息字典调用
+            doc_id: 文档ID，调用方已计算文件哈希时传入，避免重复读取文件
+
+        Returns:
+            dict: 页数、分块数、耗时和吞吐量
+        """
+        store = self.vector_store.store
+        await asyncio.to_thread(store.load)
+        source = os.path.basename(pdf_path)
+        doc_id = doc_id or await asyncio.to_thread(file_hash, pdf_path)
+        stats = {
+            "source": source, "stage": "embed", "pages": 0, "total_pages": None,
+            "chunks": 0, "duplicates": 0, "batches": 0, "skipped": False
+        }
+
+        # 内容已索引过的文件不再解析
+        if store.has_document(doc_id):
+            logger.info(f"文档已在索引中，跳过入库: {source}")
+            stats["skipped"] = True
+            return stats
+
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        page_queue = asyncio.Queue(self.queue_size)
+        batch_queue = asyncio.Queue(self.queue_size)
+        vector_queue = asyncio.Queue(self.queue_size)
+        builder = store.begin_document(doc_id)
+        dedup = store.dedup_session()
+
+        tasks = [
+            asyncio.create_task(asyncio.to_thread(
+                self._read_pages, pdf_path, page_queue, loop, stop, stats
+            )),
+            asyncio.create_task(self._split(page_queue, batch_queue, stats, doc_id, source, dedup)),
+            *[
+                asyncio.create_task(self._embed(batch_queue, vector_queue))
+                for _ in range(self.embed_workers)
+            ],
+            asyncio.create_task(self._index(vector_queue, builder, stats, progress)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # 任一阶段失败或被取消时停止其余阶段，包括阻塞在队列上的解析线程
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            # 取消协程不会中断 to_thread 中正在执行的追加；discard 等该追加完成后才删除构建目录，
+            # 放到线程中等待，不阻塞事件循环
+            await asyncio.shield(asyncio.to_thread(builder.discard))
+            raise
+
+        stats["stage"] = "commit"
+        if progress is not None:
+            progress(dict(stats))
+        await asyncio.to_thread(store.commit_document, builder, source, dedup)
+        self.vector_store.schedule_compaction()
+
+        elapsed = time.perf_counter() - started
+        metrics.observe_stage("ingest", elapsed)
+        metrics.counter("rag_ingested_pages_total", "已入库的页数").inc(stats["pages"])
+        metrics.counter("rag_ingested_chunks_total", "已入库的分块数").inc(stats["chunks"])
+        stats["elapsed"] = round(elapsed, 3)
+        stats["pages_per_second"] = round(stats["pages"] / elapsed, 2) if elapsed else None
+        stats["chunks_per_second"] = round(stats["chunks"] / elapsed, 2) if elapsed else None
+        logger.info(f"流式入库完成: {stats}")
+        return stats
+
+    def _read_pages(self, pdf_path, page_queue, loop, stop, stats):
+        """解析阶段（工作线程）：逐页读取并放入队列；大文件由进程池分片解析并分割"""
+        total_pages = self.pdf_processor.page_count(pdf_path)
+        stats["total_pages"] = total_pages
+        if self.pdf_processor.use_process_pool(total_pages):
+            for start, end, chunks in self.pdf_processor.iter_sharded_chunks(pdf_path, total_pages):
+                self._put_threadsafe(page_queue, chunks, loop, stop)
+                stats["pages"] += end - start
+        else:
+            for page in self.pdf_processor.iter_pages(pdf_path):
+                self._put_threadsafe(page_queue, page, loop, stop)
+                stats["pages"] += 1
+        self._put_threadsafe(page_queue, _DONE, loop, stop)
+
+    @staticmethod
+    def _put_threadsafe(queue, item, loop, stop):
+        """从工作线程向事件循环中的有界队列放入元素，队列满时阻塞"""
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    raise RuntimeError("入库流水线已停止")
+
+    async def _split(self, page_queue, batch_queue, stats, doc_id, source, dedup):
+        """分割阶段：把页面分割为分块，过滤近似重复的分块，并组成微批次"""
+        batch, sequence, position = [], 0, 0
+        while True:
+            page = await page_queue.get()
+            if page is _DONE:
+                break
+            if isinstance(page, list):
+                # 进程池已完成分割的分片
+                chunks = page
+            else:
+                chunks = await asyncio.to_thread(self.pdf_processor.split_page, page)
+            # 分块ID按分割顺序分配，被过滤掉的分块不占用后续分块的ID
+            ids = [make_chunk_id(doc_id, position + i) for i in range(len(chunks))]
+            position += len(chunks)
+            if dedup is not None:
+                kept, ids = await asyncio.to_thread(dedup.filter, doc_id, source, chunks, ids)
+                stats["duplicates"] += len(chunks) - len(kept)
+                chunks = kept
+            batch.extend(zip(chunks, ids))
+            while len(batch) >= self.batch_size:
+                await batch_queue.put((sequence, batch[:self.batch_size]))
+                batch = batch[self.batch_size:]
+                sequence += 1
+        if batch:
+            await batch_queue.put((sequence, batch))
+        # 每个向量化协程各收到一个结束标记
+        for _ in range(self.embed_workers):
+            await batch_queue.put(_DONE)
+
+    async def _embed(self, batch_queue, vector_queue):
+        """向量化阶段：计算一个批次的向量"""
+        embeddings = self.vector_store.embeddings
+        while True:
+            item = await batch_queue.get()
+            if item is _DONE:
+                await vector_queue.put(_DONE)
+                return
+            sequence, chunks = item
+            texts = [chunk.page_content for chunk, _ in chunks]
+            vectors = await embeddings.aembed_documents(texts)
+            await vector_queue.put((
+                sequence, texts, vectors, [chunk.metadata for chunk, _ in chunks], [chunk_id for _, chunk_id in chunks]
+            ))
+
+    async def _index(self, vector_queue, builder, stats, progress):
+        """写入阶段：按批次顺序把向量追加到分段构建器"""
+        pending, next_sequence, finished = {}, 0, 0
+        while finished < self.embed_workers:
+            item = await vector_queue.get()
+            if item is _DONE:
+                finished += 1
+                continue
+            pending[item[0]] = item[1:]
+            # 多个向量化协程可能乱序完成，按序号写入以保持分块顺序
+            while next_sequence in pending:
+                texts, vectors, metadatas, ids = pending.pop(next_sequence)
+                await asyncio.to_thread(builder.add, texts, vectors, metadatas, ids)
+                stats["chunks"] += len(texts)
+                stats["batches"] += 1
+                next_sequence += 1
+                if progress is not None:
+                    progress(dict(stats))
@@ -0,0 +1,292 @@
+from collections import Counter
+import numpy as np
+import unicodedata
+import threading
+import sqlite3
+import json
+import os
+import re
+
+# 英文/数字标识符（保留 A-123、3.2.1、ERR_404 之类的整体），以及连续的CJK字符
+_TOKEN_RE = re.compile(
+    r"[a-z0-9]+(?:[-_./:#][a-z0-9]+)*"
+    r"|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]+"
+)
+_SEPARATOR_RE = re.compile(r"[-_./:#]")
+
+# BM25参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list:
+    """
+    面向中英文混排文本的分词
+
+    - CJK连续字符切分为相邻二元组（单字词保留单字），无需词典
+    - 英文和数字标识符保留整体，带分隔符的再额外拆出各部分，
+      使 "GB/T-7714" 既能整体匹配，也能按 "7714" 匹配
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group()
+        if token[0].isascii():
+            tokens.append(token)
+            parts = [part for part in _SEPARATOR_RE.split(token) if part]
+            if len(parts) > 1:
+                tokens.extend(parts)
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+class LexicalSegment:
+    """
+    单个分段的倒排索引
+
+    与向量分段一一对应、写入后不可变；词项的倒排列表以numpy数组保存，
+    检索时按词项向量化累加BM25得分。落盘为SQLite文件，倒排列表存为原始数组字节，加载时不反序列化对象。
+    """
+
+    FILE_NAME = "lexical.sqlite"
+
+    def __init__(self, ids: list, postings: dict, doc_lens):
+        """
+        Args:
+            ids: 按向量位置排列的分块ID
+            postings: 词项 -> (位置数组, 词频数组)
+            doc_lens: 每个分块的词项数
+        """
+        self.ids = ids
+        self.postings = postings
+        self.doc_lens = np.asarray(doc_lens, dtype="float32")
+
+    @classmethod
+    def build(cls, ids: list, texts: list):
+        """对分块文本分词并建立倒排列表"""
+        positions, frequencies, doc_lens = {}, {}, []
+        for position, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lens.append(sum(counts.values()))
+            for term, tf in counts.items():
+                positions.setdefault(term, []).append(position)
+                frequencies.setdefault(term, []).append(tf)
+        postings = {
+            term: (np.asarray(positions[term], dtype="int32"), np.asarray(frequencies[term], dtype="float32"))
+            for term in positions
+        }
+        return cls(ids, postings, doc_lens)
+
+    def save(self, path: str):
+        """写入临时文件再改名，其他进程不会读到不完整的文件"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+            conn.execute(
+                "CREATE TABLE postings (term TEXT PRIMARY KEY, positions BLOB NOT NULL, frequencies BLOB NOT NULL)"
+            )
+            conn.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?)",
+                [("ids", json.dumps(self.ids)), ("doc_lens", self.doc_lens.astype("float32").tobytes())],
+            )
+            conn.executemany(
+                "INSERT INTO postings (term, positions, frequencies) VALUES (?, ?, ?)",
+                (
+                    (term, positions.astype("int32").tobytes(), frequencies.astype("float32").tobytes())
+                    for term, (positions, frequencies) in self.postings.items()
+                ),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            postings = {
+                term: (np.frombuffer(positions, dtype="int32"), np.frombuffer(frequencies, dtype="float32"))
+                for term, positions, frequencies in conn.execute("SELECT term, positions, frequencies FROM postings")
+            }
+        finally:
+            conn.close()
+        return cls(json.loads(meta["ids"]), postings, np.frombuffer(meta["doc_lens"], dtype="float32"))
+
+    def statistics(self, deleted=()) -> tuple:
+        """
+        参与全局BM25统计的 (文档频率, 分块数, 总词项数)，不计已删除的分块
+
+        Args:
+            deleted: 已删除的分块ID集合
+        """
+        if not deleted:
+            df = Counter({term: len(positions) for term, (positions, _) in self.postings.items()})
+            return df, len(self.ids), float(self.doc_lens.sum())
+        live = np.array([chunk_id not in deleted for chunk_id in self.ids], dtype=bool)
+        df = Counter()
+        for term, (positions, _) in self.postings.items():
+            count = int(live[positions].sum())
+            if count:
+                df[term] = count
+        return df, int(live.sum()), float(self.doc_lens[live].sum())
+
+
+class LexicalIndex:
+    """
+    全部分段的BM25倒排索引
+
+    文档频率和平均长度在所有分段上全局统计，各分段分别打分后合并 top-k。
+    分段随向量分段一起增删，写入时复制，检索无需加锁。
+    已删除（墓碑）的分块不计入全局统计，删除文档后即更新，无需等到分段合并。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._df = Counter()
+        self._num_docs = 0
+        self._total_len = 0.0
+        # 分段ID -> (计入全局统计的 (文档频率, 分块数, 总词项数), 统计时的已删除分块数)
+        self._stats = {}
+
+    def _apply(self, stats, sign: int):
+        df, num_docs, total_len = stats
+        if sign > 0:
+            self._df.update(df)
+        else:
+            self._df.subtract(df)
+        self._num_docs += sign * num_docs
+        self._total_len += sign * total_len
+
+    def add_segment(self, segment_id: str, segment: LexicalSegment):
+        """加入分段；其中已删除的分块在发布检索视图时由 update_deleted 扣除"""
+        with self._lock:
+            segments = dict(self._segments)
+            segments[segment_id] = segment
+            stats = segment.statistics()
+            self._apply(stats, 1)
+            self._stats[segment_id] = (stats, 0)
+            self._segments = segments
+
+    def remove_segment(self, segment_id: str):
+        with self._lock:
+            segments = dict(self._segments)
+            segment = segments.pop(segment_id, None)
+            if segment is None:
+                return
+            stats, _ = self._stats.pop(segment_id)
+            self._apply(stats, -1)
+            self._segments = segments
+
+    def update_deleted(self, deleted: dict):
+        """
+        按最新的已删除分块重新统计发生变化的分段
+
+        分段的已删除分块只增不减，数量变化即表示需要重新统计。
+
+        Args:
+            deleted: 分段ID -> 已删除分块ID集合
+        """
+        with self._lock:
+            for segment_id, removed in deleted.items():
+                segment = self._segments.get(segment_id)
+                if segment is None or self._stats[segment_id][1] == len(removed):
+                    continue
+                stats = segment.statistics(removed)
+                self._apply(self._stats[segment_id][0], -1)
+                self._apply(stats, 1)
+                self._stats[segment_id] = (stats, len(removed))
+
+    def search(self, query: str, k: int, deleted: dict, scope: dict = None) -> list:
+        """
+        BM25检索
+
+        Args:
+            query: 查询文本
+            k: 返回结果数
+            deleted: 分段ID -> 已删除分块ID集合
+            scope: 分段ID -> 允许命中的分块位置数组，只检索其中的分段；缺省检索全部分段
+
+        Returns:
+            list: [(得分, 分段ID, 分块ID)]，按得分降序
+        """
+        terms = set(tokenize(query))
+        segments = self._segments
+        if not terms or not self._num_docs:
+            return []
+        avg_len = self._total_len / self._num_docs
+        idf = {
+            term: float(np.log(1 + (self._num_docs - self._df[term] + 0.5) / (self._df[term] + 0.5)))
+            for term in terms if self._df.get(term, 0) > 0
+        }
+        # 出现在一半以上分块中的词项几乎不影响排序，却有最长的倒排列表，
+        # 查询中还有其他词项时跳过它们
+        selective = {term: value for term, value in idf.items() if self._df[term] <= self._num_docs / 2}
+        if selective:
+            idf = selective
+
+        if scope is not None:
+            segments = {segment_id: segments[segment_id] for segment_id in scope if segment_id in segments}
+
+        results = []
+        for segment_id, segment in segments.items():
+            matched = [term for term in idf if term in segment.postings]
+            if not matched:
+                continue
+            scores = np.zeros(len(segment.ids), dtype="float32")
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * segment.doc_lens / avg_len)
+            for term in matched:
+                positions, tf = segment.postings[term]
+                scores[positions] += idf[term] * tf * (BM25_K1 + 1) / (tf + norm[positions])
+            if scope is not None:
+                # 倒排索引的位置与向量位置一致，范围外的分块得分清零
+                allowed = np.zeros(len(scores), dtype=bool)
+                allowed[scope[segment_id]] = True
+                scores[~allowed] = 0
+
+            removed = deleted.get(segment_id, ())
+            candidates = np.flatnonzero(scores)
+            if not len(candidates):
+                continue
+            # 多取已删除分块的数量，保证过滤后仍有k个有效结果
+            fetch_k = min(len(candidates), k + len(removed))
+            top = candidates[np.argpartition(-scores[candidates], fetch_k - 1)[:fetch_k]]
+            found = 0
+            for position in top[np.argsort(-scores[top])]:
+                chunk_id = segment.ids[position]
+                if chunk_id in removed:
+                    continue
+                results.append((float(scores[position]), segment_id, chunk_id))
+                found += 1
+                if found >= k:
+                    break
+
+        results.sort(key=lambda item: item[0], reverse=True)
+        return results[:k]
+
+
+def reciprocal_rank_fusion(rankings: list, k: int, rrf_k: int = 60) -> list:
+    """
+    倒数排名融合
+
+    Args:
+        rankings: 多个按相关性排序的分块键列表
+        k: 返回结果数
+        rrf_k: 平滑常数
+
+    Returns:
+        list: 融合后的 [(分块键, 融合得分)]
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
@@ -0,0 +1,217 @@
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import asyncio
+import time
+
+SHED_REQUESTS = metrics.counter(
+    "rag_llm_shed_total", "等待生成超过期限而被拒绝的请求数", labels=("reason",)
+)
+CANCELLED_REQUESTS = metrics.counter(
+    "rag_llm_cancelled_total", "客户端断开或重新生成而被取消的生成请求数", labels=("stage",)
+)
+
+# 未指定会话的请求共用的会话名
+DEFAULT_SESSION = "default"
+
+
+class SchedulerOverloaded(Exception):
+    """请求在期限内等不到生成并发，被调度器拒绝"""
+
+
+class _Ticket:
+    """一个排队中的生成请求"""
+
+    def __init__(self, session: str):
+        self.session = session
+        self.enqueued_at = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+        self.timer = None
+
+
+class FairScheduler:
+    """
+    生成请求的公平调度器
+
+    位于自适应限流器之前，决定下一个获得生成并发的请求：
+    - 按会话分别排队，各会话轮流获得空出的并发，同一会话内先来先服务；
+      一个会话的突发请求只占用自己的轮次，不会让其他会话一直等待
+    - 每个请求有等待期限：按排在前面的请求数和平均生成耗时预计等待时间，
+      超过期限时立即拒绝，不再让请求排到注定超时；排队超过期限的请求同样被移出队列
+    - 会话关闭时取消该会话排队中和生成中的请求，生成中的请求随之关闭与Ollama的连接，
+      Ollama的算力只用于仍有人等待的回答
+
+    同时获得并发的请求数不超过限流器当前的并发上限。
+    """
+
+    # 平均生成耗时的平滑系数
+    SMOOTHING = 0.2
+
+    def __init__(self, limiter, deadline: float = None):
+        """
+        Args:
+            limiter: 生成请求的自适应限流器
+            deadline: 请求等待生成的最长秒数，0表示不限
+        """
+        self.limiter = limiter
+        self.deadline = settings.LLM_QUEUE_DEADLINE if deadline is None else deadline
+        # 会话 -> 排队中的请求，按轮转顺序排列
+        self._queues = OrderedDict()
+        # 会话 -> 正在等待或生成的任务，会话关闭时取消
+        self._tasks = {}
+        self._running = 0
+        # 获得并发到释放的平均耗时(秒)，用于预计等待时间
+        self.service_time = None
+        metrics.gauge("rag_llm_sessions_waiting", "有请求在排队的会话数").set_function(
+            lambda: len(self._queues)
+        )
+        metrics.gauge("rag_llm_requests_queued", "在调度器中排队的生成请求数").set_function(
+            lambda: self.queued
+        )
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def predicted_wait(self, session: str) -> float:
+        """
+        预计 session 新增一个请求需要等待的秒数
+
+        轮转调度下，该请求之前会服务本会话已排队的请求，以及其他每个会话最多同样多轮的请求；
+        这些请求和正在生成的请求占满并发后，每空出一个并发平均需要 service_time / 并发上限 秒。
+        """
+        if self.service_time is None:
+            return 0.0
+        own = len(self._queues.get(session, ()))
+        ahead = own + sum(
+            min(len(queue), own + 1) for other, queue in self._queues.items() if other != session
+        )
+        capacity = max(1, int(self.limiter.limit))
+        return max(0, ahead + self._running - capacity + 1) * self.service_time / capacity
+
+    @asynccontextmanager
+    async def acquire(self, session: str = None, deadline: float = None):
+        """
+        排队获取生成并发
+
+        用法:
+            async with scheduler.acquire(session_id) as permit:
+                ...  # permit 为限流器的许可
+
+        Args:
+            session: 会话ID，同一会话的请求轮流排队
+            deadline: 等待生成的最长秒数，缺省为 LLM_QUEUE_DEADLINE，0表示不限
+
+        Raises:
+            SchedulerOverloaded: 预计或实际等待超过期限
+        """
+        session = session or DEFAULT_SESSION
+        deadline = self.deadline if deadline is None else deadline
+        if deadline > 0:
+            predicted = self.predicted_wait(session)
+            if predicted > deadline:
+                SHED_REQUESTS.inc(reason="predicted")
+                raise SchedulerOverloaded(f"预计等待 {predicted:.1f} 秒，超过期限 {deadline:.0f} 秒")
+
+        task = asyncio.current_task()
+        self._tasks.setdefault(session, set()).add(task)
+        try:
+            await self._wait_turn(session, deadline)
+            granted_at = time.perf_counter()
+            completed = False
+            try:
+                async with self.limiter.acquire() as permit:
+                    yield permit
+                completed = True
+            except (asyncio.CancelledError, GeneratorExit):
+                CANCELLED_REQUESTS.inc(stage="generating")
+                raise
+            finally:
+                self._running -= 1
+                if completed:
+                    elapsed = time.perf_counter() - granted_at
+                    self.service_time = elapsed if self.service_time is None else (
+                        self.service_time + (elapsed - self.service_time) * self.SMOOTHING
+                    )
+                self._dispatch()
+        finally:
+            tasks = self._tasks.get(session)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self._tasks[session]
+
+    async def _wait_turn(self, session: str, deadline: float):
+        """登记请求并等待轮到它；返回时已占用一个并发"""
+        ticket = _Ticket(session)
+        self._queues.setdefault(session, deque()).append(ticket)
+        if deadline > 0:
+            ticket.timer = asyncio.get_running_loop().call_later(deadline, self._expire, ticket, deadline)
+        self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            CANCELLED_REQUESTS.inc(stage="queued")
+            if ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None:
+                # 已被分配并发但尚未开始生成
+                self._running -= 1
+                self._dispatch()
+            else:
+                self._remove(ticket)
+            raise
+        finally:
+            if ticket.timer is not None:
+                ticket.timer.cancel()
+        metrics.observe_stage("llm_schedule_wait", time.perf_counter() - ticket.enqueued_at)
+
+    def _dispatch(self):
+        """按会话轮转，把空出的并发分配给排队的请求"""
+        while self._queues and self._running < max(1, int(self.limiter.limit)):
+            session, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+            if ticket.future.done():
+                continue
+            self._running += 1
+            ticket.future.set_result(None)
+
+    def _remove(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.session)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        if not queue:
+            del self._queues[ticket.session]
+
+    def _expire(self, ticket: _Ticket, deadline: float):
+        """请求排队超过期限，移出队列并通知等待者"""
+        if ticket.future.done():
+            return
+        self._remove(ticket)
+        SHED_REQUESTS.inc(reason="expired")
+        ticket.future.set_exception(SchedulerOverloaded(f"排队超过 {deadline:.0f} 秒"))
+
+    def cancel_session(self, session: str) -> int:
+        """取消会话中排队和生成中的请求，返回取消的请求数"""
+        tasks = [task for task in self._tasks.get(session, ()) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.info(f"会话已关闭，取消 {len(tasks)} 个生成请求: {session}")
+        return len(tasks)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "sessions_waiting": len(self._queues),
+            "running": self._running,
+            "service_time": round(self.service_time, 3) if self.service_time is not None else None,
+        }
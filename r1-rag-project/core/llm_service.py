@@ -1,61 +1,170 @@
-import ollama
+from core.ollama_client import get_async_client, get_limiter
+from core.llm_scheduler import FairScheduler, SchedulerOverloaded
+from core.prompt_builder import PromptBuilder
 from config.config import settings
 from utils.logger import logger
+from utils.metrics import metrics
+import hashlib
+import json
 import re
-import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing
+
+# 生成失败时返回给用户的提示
+GENERATION_ERROR_MESSAGE = "抱歉，生成回答时出现错误，请稍后重试。"
+# 等待生成超过期限、请求被拒绝时返回给用户的提示
+OVERLOADED_MESSAGE = "抱歉，当前提问的人较多，请稍后重试。"
+
+
+
+class GenerationFailed(Exception):
+    """生成失败或请求被拒绝，异常信息为提示给用户的文本；已经流式产出的部分回答应当丢弃"""
+
+
+# 缓存的对话摘要数
+_SUMMARY_CACHE_SIZE = 1024
+
+PROMPT_TOKENS = metrics.counter("rag_llm_prompt_tokens_total", "发送给模型的提示词token数(估算)")
+PREFILL_TOKENS = metrics.counter(
+    "rag_llm_prefill_tokens_total", "模型实际预填充的token数，低于提示词token数的部分复用了前缀的KV缓存"
+)
 
 class LLMService:
     def __init__(self):
         """
         初始化LLM服务
         - model: 从配置中获取使用的语言模型名称
-        - semaphore: 创建信号量控制并发请求数量
+        - limiter: 自适应限流器，按服务端延迟调整并发请求数量
+        - scheduler: 公平调度器，按会话轮流分配限流器的并发，并拒绝等不到生成的请求
+        - prompt_builder: 多轮对话的提示词组装，较早的对话压缩为滚动摘要
         """
         self.model = settings.OLLAMA_MODEL
-        # 用于控制并发请求的数量，用于限制同时运行的协程数量，最多允许settings.WORKERS个协程同时运行。
-        self.semaphore = asyncio.Semaphore(settings.WORKERS)
-        
+        # 并发上限从WORKERS开始，根据首token延迟自动增减
+        self.limiter = get_limiter("chat")
+        self.scheduler = FairScheduler(self.limiter)
+        # 最近若干次流式生成的统计(TTFT、tokens/s、提示词token数)
+        self.recent_stats = deque(maxlen=1000)
+        self.prompt_builder = PromptBuilder()
+        # 较早对话的摘要：对话内容哈希 -> 摘要，同一段历史在之后各轮得到相同的摘要，提示词前缀保持不变
+        self._summaries = OrderedDict()
+
+    @property
+    def client(self):
+        """当前事件循环的共享异步客户端，生成请求不再占用线程"""
+        return get_async_client()
+
+    @staticmethod
+    def _history_key(turns: list) -> str:
+        return hashlib.sha256(json.dumps(turns, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def _summarize(self, turns: list, session: str, deadline: float) -> str:
+        """
+        较早对话的滚动摘要
+
+        摘要按对话内容缓存。压缩边界前移时，从上一个边界的摘要出发，
+        只把新移出的对话交给模型合并；模型不可用或繁忙时只保留用户问过的问题。
+        """
+        key = self._history_key(turns)
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self._summaries.move_to_end(key)
+            return summary
+
+        # 找到最近一个已有摘要的压缩边界
+        step = self.prompt_builder.compact_turns
+        previous, start = "", 0
+        for end in range((len(turns) - 1) // step * step, 0, -step):
+            cached = self._summaries.get(self._history_key(turns[:end]))
+            if cached is not None:
+                previous, start = cached, end
+                break
+
+        started = time.perf_counter()
+        if settings.HISTORY_SUMMARY_LLM:
+            try:
+                async with self.scheduler.acquire(session, deadline) as permit:
+                    response = await self.client.chat(
+                        model=self.model,
+                        messages=self.prompt_builder.summary_messages(previous, turns[start:]),
+                        keep_alive=settings.OLLAMA_MODEL_KEEP_ALIVE
+                    )
+                    permit.sample(time.perf_counter() - permit.started_at - (response.get("eval_duration") or 0) / 1e9)
+                content = re.sub(r"<think>.*?</think>", "", response["message"]["content"], flags=re.DOTALL)
+                summary = self.prompt_builder.clip_summary(content)
+            except Exception as e:
+                logger.warning(f"生成对话摘要失败，改为只保留用户的问题: {str(e)}")
+        if not summary:
+            summary = self.prompt_builder.fallback_summary(previous, turns[start:])
+        metrics.observe_stage("history_summary", time.perf_counter() - started)
+        logger.info(f"已把 {len(turns) - start} 轮对话合并入摘要，摘要覆盖 {len(turns)} 轮")
+
+        self._summaries[key] = summary
+        while len(self._summaries) > _SUMMARY_CACHE_SIZE:
+            self._summaries.popitem(last=False)
+        return summary
+
+    async def _prepare_prompt(self, question: str, context: str, chat_history: list, session: str, deadline: float):
+        """组装本轮的提示词：超出历史token预算的较早对话先压缩为摘要"""
+        older, recent = self.prompt_builder.split_history(chat_history or [])
+        summary = await self._summarize(older, session, deadline) if older else ""
+        return self.prompt_builder.build(question, context, recent, summary, len(older))
 
-    async def generate_response(self, question: str, context: str, chat_history: list):
+    @staticmethod
+    def _observe_prompt(prompt, response: dict) -> dict:
+        """
+        记录提示词token数和预填充耗时
+
+        Ollama返回的 prompt_eval_count 只包含实际计算的token，复用了KV缓存的前缀不计入，
+        与提示词token数对比即可看出前缀复用节省的预填充。
+        """
+        prefill_tokens = response.get("prompt_eval_count")
+        prefill_duration = response.get("prompt_eval_duration")
+        PROMPT_TOKENS.inc(prompt.prompt_tokens)
+        if prefill_tokens is not None:
+            PREFILL_TOKENS.inc(prefill_tokens)
+        if prefill_duration:
+            metrics.observe_stage("llm_prefill", prefill_duration / 1e9)
+        return {
+            **prompt.as_dict(),
+            "prefill_tokens": prefill_tokens,
+            "prefill": round(prefill_duration / 1e9, 3) if prefill_duration else None,
+        }
+
+    async def generate_response(self, question: str, context: str, chat_history: list,
+                                session: str = None, deadline: float = None):
         """
         生成回答
         
         Args:
             question: 用户当前问题
             context: 相关文档上下文
-            chat_history: 历史对话记录
+            chat_history: 历史对话记录 [(问题, 回答)]，按token预算带入提示词
+            session: 会话ID，调度器按会话轮流分配并发
+            deadline: 等待生成的最长秒数，缺省为 LLM_QUEUE_DEADLINE
             
         Returns:
             str: 生成的回答内容
+
+        Raises:
+            GenerationFailed: 生成失败或等待超过期限
         """
         try:
             # 记录用户问题
-            logger.info(f"用户问题: {question}")
-
-            # 构建系统提示词
-            system_prompt = """你是一个专业的AI助手。请基于提供的上下文回答问题。
-            - 回答要简洁明了，避免重复
-            - 如果上下文中没有相关信息，请直接说明
-            - 保持回答的连贯性和逻辑性
-            - 请用中文回答"""
-            
-            # 构建用户提示词
-            user_prompt = f"""基于以下信息回答问题：
-            问题：{question}
-            相关上下文：{context}"""
-            
-            # 调用Ollama API，使用信号量控制并发（限制同时运行的并发请求数量）
-            async with self.semaphore:  
-                # 使用asyncio.to_thread将同步操作转换为异步操作，避免阻塞事件循环
-                response = await asyncio.to_thread(
-                    ollama.chat, # 一个同步阻塞调用
-                    model=self.model, 
-                    # 消息格式
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-                )
+            logger.info("用户问题", extra={"fields": {"question": question}})
+            prompt = await self._prepare_prompt(question, context, chat_history, session, deadline)
+
+            # 调用Ollama API，由调度器按会话排队、限流器控制并发
+            async with self.scheduler.acquire(session, deadline) as permit:
+                with metrics.span("llm_generation", streaming=False):
+                    response = await self.client.chat(
+                        model=self.model,
+                        messages=prompt.messages,
+                        keep_alive=settings.OLLAMA_MODEL_KEEP_ALIVE
+                    )
+                # 去掉生成阶段的耗时，只以排队和预填充的耗时作为延迟样本
+                elapsed = time.perf_counter() - permit.started_at
+                permit.sample(elapsed - (response.get("eval_duration") or 0) / 1e9)
             
             # 处理响应
             content = response["message"]["content"]
@@ -63,11 +172,224 @@ class LLMService:
             final_answer = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL).strip()
             
             # 记录模型回答
-            logger.info(f"模型回答: {final_answer}")
+            logger.info("模型回答", extra={"fields": {"answer": final_answer}})
+            logger.info(f"提示词统计: {self._observe_prompt(prompt, response)}")
             
             return final_answer
-            
+
+        except SchedulerOverloaded as e:
+            logger.warning(f"生成请求被拒绝: {str(e)}，调度: {self.scheduler.stats()}")
+            raise GenerationFailed(OVERLOADED_MESSAGE) from e
         except Exception as e:
             logger.error(f"生成回答失败: {str(e)}", exc_info=True)
-            return "抱歉，生成回答时出现错误，请稍后重试。"
-        
+            raise GenerationFailed(GENERATION_ERROR_MESSAGE) from e
+
+    async def stream_response(self, question: str, context: str, chat_history: list,
+                              session: str = None, deadline: float = None):
+        """
+        流式生成回答
+
+        逐个产出可见的回答片段，<think>…</think> 思考过程在到达时即被过滤，
+        并记录首个可见token耗时(TTFT)和生成速度。
+        请求被取消或生成器被提前关闭时，随即关闭与Ollama的流式连接，Ollama停止生成。
+
+        Args:
+            question: 用户当前问题
+            context: 相关文档上下文
+            chat_history: 历史对话记录 [(问题, 回答)]，按token预算带入提示词
+            session: 会话ID，调度器按会话轮流分配并发
+            deadline: 等待生成的最长秒数，缺省为 LLM_QUEUE_DEADLINE
+
+        Yields:
+            str: 新增的回答片段
+
+        Raises:
+            GenerationFailed: 生成失败（包括已产出部分回答之后失败）或等待超过期限，调用方应丢弃已产出的片段
+        """
+        stats = GenerationStats()
+        think_filter = ThinkTagFilter()
+        answer = []
+        try:
+            logger.info("用户问题", extra={"fields": {"question": question}})
+            # 摘要生成自己占用一次并发，须在获取生成并发之前完成
+            prompt = await self._prepare_prompt(question, context, chat_history, session, deadline)
+            stats.prompt = prompt
+
+            async with self.scheduler.acquire(session, deadline) as permit:
+                stats.start()
+                stream = await self.client.chat(
+                    model=self.model,
+                    messages=prompt.messages,
+                    stream=True,
+                    keep_alive=settings.OLLAMA_MODEL_KEEP_ALIVE
+                )
+                async with aclosing(stream):
+                    async for chunk in stream:
+                        stats.on_token()
+                        # 首token耗时反映服务端排队和预填充，作为限流器的延迟样本
+                        if permit.latency is None:
+                            permit.sample(stats.first_token_at - stats.started_at)
+                        text = think_filter.feed(chunk["message"]["content"])
+                        # 与非流式一致，去掉回答开头的空白
+                        if not answer:
+                            text = text.lstrip()
+                        if text:
+                            stats.on_visible()
+                            answer.append(text)
+                            yield text
+                        if chunk.get("done"):
+                            stats.on_done(chunk)
+
+                tail = think_filter.flush()
+                if not answer:
+                    tail = tail.lstrip()
+                if tail:
+                    stats.on_visible()
+                    answer.append(tail)
+                    yield tail
+
+            stats.finish()
+            self.recent_stats.append(stats)
+            if stats.ttft is not None:
+                metrics.observe_stage("llm_ttft", stats.ttft)
+            metrics.observe_stage("llm_generation", stats.finished_at - stats.started_at)
+            self._observe_prompt(prompt, stats.done_chunk or {})
+            logger.info("模型回答", extra={"fields": {"answer": "".join(answer).strip()}})
+            logger.info(f"生成统计: {stats.as_dict()}，并发: {self.limiter.stats()}")
+
+        except SchedulerOverloaded as e:
+            logger.warning(f"生成请求被拒绝: {str(e)}，调度: {self.scheduler.stats()}")
+            raise GenerationFailed(OVERLOADED_MESSAGE) from e
+        except Exception as e:
+            logger.error(f"流式生成回答失败: {str(e)}", exc_info=True)
+            raise GenerationFailed(GENERATION_ERROR_MESSAGE) from e
+
+
+class ThinkTagFilter:
+    """
+    增量过滤 <think>…</think> 思考过程
+
+    标签可能被拆分在多个token中，因此在缓冲区末尾保留可能是标签前缀的部分，
+    等后续token到达后再判断。
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_think = False
+
+    @staticmethod
+    def _partial_tag_length(text: str, tag: str) -> int:
+        """返回text末尾与tag前缀重合的长度"""
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    def feed(self, text: str) -> str:
+        """输入新的token文本，返回可以显示的部分"""
+        self._buffer += text
+        visible = []
+        while True:
+            if self._in_think:
+                index = self._buffer.find(self.CLOSE_TAG)
+                if index < 0:
+                    keep = self._partial_tag_length(self._buffer, self.CLOSE_TAG)
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                self._buffer = self._buffer[index + len(self.CLOSE_TAG):]
+                self._in_think = False
+            else:
+                index = self._buffer.find(self.OPEN_TAG)
+                if index < 0:
+                    keep = self._partial_tag_length(self._buffer, self.OPEN_TAG)
+                    visible.append(self._buffer[:len(self._buffer) - keep])
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                visible.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(self.OPEN_TAG):]
+                self._in_think = True
+        return "".join(visible)
+
+    def flush(self) -> str:
+        """生成结束时返回缓冲区中剩余的可见文本"""
+        remaining = "" if self._in_think else self._buffer
+        self._buffer = ""
+        return remaining
+
+
+class GenerationStats:
+    """单次流式生成的耗时统计"""
+
+    def __init__(self):
+        self.started_at = None
+        self.first_token_at = None
+        self.first_visible_at = None
+        self.finished_at = None
+        self.tokens = 0
+        self.eval_count = None
+        self.eval_duration = None
+        # 本次的提示词(Prompt)和Ollama最后一个分片，后者含预填充的token数和耗时
+        self.prompt = None
+        self.done_chunk = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+
+    def on_token(self):
+        self.tokens += 1
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def on_visible(self):
+        if self.first_visible_at is None:
+            self.first_visible_at = time.perf_counter()
+
+    def on_done(self, chunk):
+        # Ollama在最后一个分片中给出准确的token数和生成耗时(纳秒)
+        self.eval_count = chunk.get("eval_count")
+        self.eval_duration = chunk.get("eval_duration")
+        self.done_chunk = chunk
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+
+    @property
+    def ttft(self):
+        """首个可见token耗时(秒)，不含思考过程"""
+        if self.first_visible_at is None:
+            return None
+        return self.first_visible_at - self.started_at
+
+    @property
+    def tokens_per_second(self):
+        if self.eval_count and self.eval_duration:
+            return self.eval_count / (self.eval_duration / 1e9)
+        if self.first_token_at is None or self.finished_at is None:
+            return None
+        elapsed = self.finished_at - self.first_token_at
+        return self.tokens / elapsed if elapsed > 0 else None
+
+    @property
+    def prefill_tokens(self):
+        """Ollama实际预填充的token数，复用了KV缓存的前缀不计入"""
+        return self.done_chunk.get("prompt_eval_count") if self.done_chunk else None
+
+    @property
+    def prefill_seconds(self):
+        duration = self.done_chunk.get("prompt_eval_duration") if self.done_chunk else None
+        return duration / 1e9 if duration else None
+
+    def as_dict(self) -> dict:
+        return {
+            **(self.prompt.as_dict() if self.prompt is not None else {}),
+            "prefill_tokens": self.prefill_tokens,
+            "prefill": round(self.prefill_seconds, 3) if self.prefill_seconds else None,
+            "ttft": round(self.ttft, 3) if self.ttft is not None else None,
+            "first_token": round(self.first_token_at - self.started_at, 3) if self.first_token_at else None,
+            "total": round(self.finished_at - self.started_at, 3) if self.finished_at else None,
+            "tokens": self.eval_count or self.tokens,
+            "tokens_per_second": round(self.tokens_per_second, 2) if self.tokens_per_second else None,
+        }
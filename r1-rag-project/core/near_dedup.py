@@ -0,0 +1,341 @@
+from core.embedding_cache import normalize_text
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+import numpy as np
+import sqlite3
+import threading
+import mmh3
+import os
+
+# MinHash置换使用的梅森素数，a*h+b 在uint64范围内不会溢出
+_PRIME = (1 << 31) - 1
+
+
+class MinHasher:
+    """
+    MinHash签名
+
+    文本规范化后取字符 n-gram 作为特征（中英文通用，无需分词），
+    每个特征用mmh3哈希一次，再经 num_perm 个线性置换取最小值得到签名。
+    两段文本签名中相等位置的比例是其 n-gram 集合Jaccard相似度的无偏估计。
+    """
+
+    def __init__(self, num_perm: int = None, shingle_size: int = None, seed: int = 1):
+        self.num_perm = num_perm or settings.NEAR_DUP_NUM_PERM
+        self.shingle_size = shingle_size or settings.NEAR_DUP_SHINGLE_SIZE
+        # 固定种子，不同进程、不同次运行得到的签名一致，可以持久化
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, self.num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, self.num_perm).astype(np.uint64)
+
+    def shingles(self, text: str) -> set:
+        text = normalize_text(text).lower()
+        size = self.shingle_size
+        if len(text) <= size:
+            return {text}
+        return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = self.shingles(text)
+        hashes = np.fromiter(
+            (mmh3.hash(shingle, signed=False) for shingle in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME
+        return permuted.min(axis=0).astype(np.uint32)
+
+    @staticmethod
+    def similarity(left: np.ndarray, right: np.ndarray) -> float:
+        """由签名估计Jaccard相似度"""
+        return float(np.mean(left == right))
+
+
+class NearDuplicateIndex:
+    """
+    近似重复分块索引
+
+    分割后、向量化前用MinHash/LSH查找与已入库分块近似重复的分块：
+    - 签名分为 NEAR_DUP_BANDS 段，任一段完全相同即为候选，再按签名估计的相似度确认
+    - 重复分块不再向量化和写入索引，只记录为代表分块的引用（来源文件和页码）
+    - 检索命中代表分块时，在元数据 duplicates 中列出所有引用它的页面
+
+    数据保存在向量库目录下的SQLite中，多个进程共享；写入只在向量库的写锁内进行。
+    删除文档时，仍被其他文档引用的代表分块由调用方保留。
+    """
+
+    FILE_NAME = "near_dup.sqlite"
+
+    def __init__(self, db_path: str, hasher: MinHasher = None, bands: int = None, threshold: float = None):
+        self.path = os.path.join(db_path, self.FILE_NAME)
+        self.hasher = hasher or MinHasher()
+        self.bands = bands or settings.NEAR_DUP_BANDS
+        self.threshold = threshold or settings.NEAR_DUP_THRESHOLD
+        if self.hasher.num_perm % self.bands:
+            raise ValueError(f"NEAR_DUP_NUM_PERM({self.hasher.num_perm}) 必须能被 NEAR_DUP_BANDS({self.bands}) 整除")
+        self.rows = self.hasher.num_perm // self.bands
+        # 每个线程使用独立的连接，首次使用时创建，向量库目录此时一定已存在
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS representatives (
+                    chunk_id TEXT PRIMARY KEY,
+                    doc_id TEXT NOT NULL,
+                    signature BLOB NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS bands (
+                    band INTEGER NOT NULL,
+                    key BLOB NOT NULL,
+                    chunk_id TEXT NOT NULL,
+                    PRIMARY KEY (band, key, chunk_id)
+                ) WITHOUT ROWID"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS duplicates (
+                    chunk_id TEXT NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    page INTEGER
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_representatives_doc ON representatives(doc_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_bands_chunk ON bands(chunk_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_chunk ON duplicates(chunk_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_doc ON duplicates(doc_id)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def band_keys(self, signature: np.ndarray) -> list:
+        """签名各段的 (段号, 键)"""
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def find(self, signature: np.ndarray, exclude=()):
+        """
+        在已入库的代表分块中查找最相似且超过阈值的一个，返回分块ID或None
+
+        Args:
+            exclude: 不参与匹配的代表分块所属文档ID
+        """
+        keys = self.band_keys(signature)
+        placeholders = ",".join("(?, ?)" for _ in keys)
+        exclude = list(exclude)
+        excluded = f" AND r.doc_id NOT IN ({','.join('?' * len(exclude))})" if exclude else ""
+        rows = self._conn().execute(
+            f"""SELECT DISTINCT r.chunk_id, r.signature FROM bands b
+                JOIN representatives r ON r.chunk_id = b.chunk_id
+                WHERE (b.band, b.key) IN (VALUES {placeholders}){excluded}""",
+            [value for key in keys for value in key] + exclude,
+        ).fetchall()
+        best, best_similarity = None, self.threshold
+        for chunk_id, blob in rows:
+            similarity = MinHasher.similarity(signature, np.frombuffer(blob, dtype=np.uint32))
+            if similarity >= best_similarity:
+                best, best_similarity = chunk_id, similarity
+        return best
+
+    def session(self, replaced=None):
+        """
+        开始一次入库的去重，结果在索引提交后由 commit 写入
+
+        Args:
+            replaced: 按来源查找将被替换的旧文档ID的函数，旧版本的分块不作为代表分块
+        """
+        return NearDuplicateSession(self, replaced)
+
+    def commit(self, session, doc_ids) -> int:
+        """
+        写入会话中属于 doc_ids 的代表分块和重复引用
+
+        Args:
+            session: 去重会话
+            doc_ids: 已写入索引的文档ID
+
+        Returns:
+            int: 写入的重复引用数
+        """
+        doc_ids = set(doc_ids)
+        representatives = [item for item in session.representatives if item[1] in doc_ids]
+        kept = {chunk_id for chunk_id, _, _ in representatives}
+        # 引用会话内代表分块的重复，只有代表分块所在文档也写入了才保留
+        duplicates = [
+            item for item in session.duplicates
+            if item[1] in doc_ids and (item[0] in kept or item[0] not in session.pending_ids)
+        ]
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO representatives (chunk_id, doc_id, signature) VALUES (?, ?, ?)",
+                [(chunk_id, doc_id, signature.tobytes()) for chunk_id, doc_id, signature in representatives],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO bands (band, key, chunk_id) VALUES (?, ?, ?)",
+                [
+                    (band, key, chunk_id)
+                    for chunk_id, _, signature in representatives
+                    for band, key in self.band_keys(signature)
+                ],
+            )
+            conn.executemany(
+                "INSERT INTO duplicates (chunk_id, doc_id, source, page) VALUES (?, ?, ?, ?)",
+                duplicates,
+            )
+        metrics.counter("rag_ingest_duplicate_chunks_total", "近似重复、未向量化的分块数").inc(len(duplicates))
+        return len(duplicates)
+
+    def references(self, chunk_ids) -> dict:
+        """查询代表分块被哪些页面引用，返回 {分块ID: [{"source": 来源, "page": 页码}]}"""
+        chunk_ids = list(chunk_ids)
+        found = {}
+        for start in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for chunk_id, source, page in self._conn().execute(
+                f"SELECT chunk_id, source, page FROM duplicates WHERE chunk_id IN ({placeholders}) ORDER BY rowid",
+                batch,
+            ):
+                found.setdefault(chunk_id, []).append({"source": source, "page": page})
+        return found
+
+    def referenced_by(self, doc_ids) -> dict:
+        """查询文档中重复分块所引用的代表分块，返回 {代表分块所属文档ID: [分块ID]}"""
+        doc_ids = list(doc_ids)
+        found = {}
+        for start in range(0, len(doc_ids), 500):
+            batch = doc_ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for chunk_id, owner in self._conn().execute(
+                f"""SELECT DISTINCT d.chunk_id, r.doc_id FROM duplicates d
+                    JOIN representatives r ON r.chunk_id = d.chunk_id
+                    WHERE d.doc_id IN ({placeholders})""",
+                batch,
+            ):
+                found.setdefault(owner, []).append(chunk_id)
+        return found
+
+    def remove_document(self, doc_id: str, owner: str) -> list:
+        """
+        删除文档的去重记录
+
+        先删除该文档自身的重复引用；该文档的代表分块中仍被其他文档引用的，
+        归属改为 owner 并返回，其余的代表分块一并删除。
+
+        Returns:
+            list: 需要保留的代表分块ID
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM duplicates WHERE doc_id = ?", (doc_id,))
+            shared = [row[0] for row in conn.execute(
+                """SELECT r.chunk_id FROM representatives r WHERE r.doc_id = ?
+                   AND EXISTS (SELECT 1 FROM duplicates d WHERE d.chunk_id = r.chunk_id)""",
+                (doc_id,),
+            )]
+            conn.executemany("UPDATE representatives SET doc_id = ? WHERE chunk_id = ?", [(owner, c) for c in shared])
+            self._delete_representatives(conn, "doc_id = ?", (doc_id,))
+        return shared
+
+    def release_unreferenced(self, owners) -> list:
+        """删除归属于 owners、已不再被任何文档引用的代表分块，返回其分块ID"""
+        owners = list(owners)
+        if not owners:
+            return []
+        conn = self._conn()
+        placeholders = ",".join("?" * len(owners))
+        condition = (
+            f"doc_id IN ({placeholders}) "
+            "AND NOT EXISTS (SELECT 1 FROM duplicates d WHERE d.chunk_id = representatives.chunk_id)"
+        )
+        with conn:
+            released = [row[0] for row in conn.execute(
+                f"SELECT chunk_id FROM representatives WHERE {condition}", owners
+            )]
+            self._delete_representatives(conn, condition, owners)
+        return released
+
+    @staticmethod
+    def _delete_representatives(conn, condition: str, params):
+        conn.execute(
+            f"DELETE FROM bands WHERE chunk_id IN (SELECT chunk_id FROM representatives WHERE {condition})", params
+        )
+        conn.execute(f"DELETE FROM representatives WHERE {condition}", params)
+
+
+class NearDuplicateSession:
+    """
+    一次入库的去重会话
+
+    除了已入库的代表分块，还在本次入库已保留的分块中查找重复，
+    同一文件内或同一批文件之间重复的页眉、页脚和免责声明也只保留一份。
+    同名文件的新版本不与旧版本的代表分块去重：提交时旧版本被删除，其代表分块随之释放，
+    未变化的内容必须由新版本自己保留。
+    """
+
+    def __init__(self, index: NearDuplicateIndex, replaced=None):
+        self.index = index
+        self.replaced = replaced
+        # [(分块ID, 文档ID, 签名)]
+        self.representatives = []
+        # [(代表分块ID, 文档ID, 来源, 页码)]
+        self.duplicates = []
+        self.pending_ids = set()
+        self._bands = {}
+        self._lock = threading.Lock()
+
+    @property
+    def saved(self) -> int:
+        """跳过向量化的分块数"""
+        return len(self.duplicates)
+
+    def _find_pending(self, signature: np.ndarray):
+        best, best_similarity = None, self.index.threshold
+        for key in self.index.band_keys(signature):
+            for position in self._bands.get(key, ()):
+                chunk_id, _, other = self.representatives[position]
+                similarity = MinHasher.similarity(signature, other)
+                if similarity >= best_similarity:
+                    best, best_similarity = chunk_id, similarity
+        return best
+
+    def filter(self, doc_id: str, source: str, chunks: list, chunk_ids: list) -> tuple:
+        """
+        过滤近似重复的分块
+
+        Args:
+            doc_id: 分块所属文档ID
+            source: 文档来源，记录在重复引用中
+            chunks: 按顺序排列的分块
+            chunk_ids: 分块保留时使用的分块ID，与 chunks 一一对应
+
+        Returns:
+            tuple: (保留的分块, 保留分块的ID)
+        """
+        kept, kept_ids = [], []
+        signatures = [self.index.hasher.signature(chunk.page_content) for chunk in chunks]
+        old_doc_id = self.replaced(source) if self.replaced is not None else None
+        exclude = [old_doc_id] if old_doc_id is not None and old_doc_id != doc_id else []
+        with self._lock:
+            for chunk, chunk_id, signature in zip(chunks, chunk_ids, signatures):
+                match = self._find_pending(signature) or self.index.find(signature, exclude)
+                if match is not None:
+                    self.duplicates.append((match, doc_id, source, chunk.metadata.get("page")))
+                    continue
+                for key in self.index.band_keys(signature):
+                    self._bands.setdefault(key, []).append(len(self.representatives))
+                self.representatives.append((chunk_id, doc_id, signature))
+                self.pending_ids.add(chunk_id)
+                kept.append(chunk)
+                kept_ids.append(chunk_id)
+        if len(kept) < len(chunks):
+            logger.debug(f"近似重复过滤: {source} {len(chunks)} 个分块中 {len(chunks) - len(kept)} 个重复")
+        return kept, kept_ids
@@ -0,0 +1,300 @@
+from langchain_core.embeddings import Embeddings
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+import asyncio
+import weakref
+import ollama
+import httpx
+import time
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.OLLAMA_MAX_CONNECTIONS,
+        keepalive_expiry=settings.OLLAMA_KEEPALIVE_EXPIRY,
+    )
+
+
+# 事件循环 -> 异步客户端
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> ollama.AsyncClient:
+    """
+    共享的Ollama异步客户端
+
+    底层httpx连接池保持长连接，生成和向量化请求复用同一组连接，
+    不再为每个请求占用一个线程。服务地址沿用 OLLAMA_HOST 环境变量。
+    连接绑定在创建它的事件循环上，启动预热和Gradio服务运行在不同的事件循环中，因此每个事件循环各用一个客户端。
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = ollama.AsyncClient(timeout=settings.OLLAMA_TIMEOUT, limits=_http_limits())
+    return client
+
+
+@lru_cache(maxsize=1)
+def get_sync_client() -> ollama.Client:
+    """全局共享的Ollama同步客户端，供工作线程中的同步调用使用"""
+    return ollama.Client(timeout=settings.OLLAMA_TIMEOUT, limits=_http_limits())
+
+
+class _Permit:
+    """一次并发许可，记录请求耗时作为限流器的延迟样本"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.latency = None
+
+    def sample(self, latency: float):
+        """指定延迟样本，默认取整个请求的耗时"""
+        self.latency = latency
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发限流器
+
+    替代固定大小的信号量，按延迟梯度和AIMD调整允许的并发数：
+    - 延迟接近基线（历史最小延迟）且并发已用满时，并发上限加性增长
+    - 延迟超过基线的 tolerance 倍时，说明请求在服务端排队，按延迟比例收缩上限
+    - 请求失败或超时，上限乘以 backoff
+    并发上限已降到最小值而延迟仍然偏高时，说明服务端本身变慢（如切换了模型），
+    此时基线才向当前延迟漂移；负载下不漂移，避免排队延迟被当作新的基线。
+    """
+
+    # 基线每个样本向当前延迟漂移的比例
+    BASELINE_DRIFT = 0.05
+    # 延迟过高时上限向目标值收缩的平滑系数
+    SMOOTHING = 0.2
+
+    def __init__(self, name: str, initial: int, max_limit: int, min_limit: int = 1,
+                 tolerance: float = None, backoff: float = None):
+        """
+        Args:
+            name: 限流器名称，用于日志
+            initial: 初始并发上限
+            max_limit: 并发上限的最大值
+            min_limit: 并发上限的最小值
+            tolerance: 延迟超过基线该倍数时开始收缩
+            backoff: 请求失败时上限的乘数
+        """
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.tolerance = tolerance or settings.LIMITER_LATENCY_TOLERANCE
+        self.backoff = backoff or settings.LIMITER_BACKOFF
+        self.in_flight = 0
+        self.waiting = 0
+        self.baseline = None
+        self.successes = 0
+        self.drops = 0
+        # 条件变量绑定在首次使用它的事件循环上，换到其他事件循环时重新创建
+        self._loop = None
+        self._condition = None
+        metrics.gauge("rag_limiter_in_flight", "限流器当前在途请求数", ["limiter"]).set_function(
+            lambda: self.in_flight, limiter=name
+        )
+        metrics.gauge("rag_limiter_waiting", "限流器当前排队请求数", ["limiter"]).set_function(
+            lambda: self.waiting, limiter=name
+        )
+        metrics.gauge("rag_limiter_limit", "限流器当前并发上限", ["limiter"]).set_function(
+            lambda: self.limit, limiter=name
+        )
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        获取并发许可
+
+        用法:
+            async with limiter.acquire() as permit:
+                ...
+                permit.sample(latency)  # 可选，默认取整个请求的耗时
+        """
+        queued_at = time.perf_counter()
+        condition = self._get_condition()
+        async with condition:
+            self.waiting += 1
+            try:
+                await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+        metrics.observe_stage(f"{self.name}_queue_wait", time.perf_counter() - queued_at)
+
+        permit = _Permit()
+        try:
+            yield permit
+        except asyncio.CancelledError:
+            # 客户端取消不代表服务端过载，不调整上限
+            raise
+        except Exception:
+            self._on_drop()
+            raise
+        else:
+            latency = permit.latency
+            if latency is None:
+                latency = time.perf_counter() - permit.started_at
+            self._on_sample(latency)
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                condition.notify_all()
+
+    def _get_condition(self) -> asyncio.Condition:
+        """
+        当前事件循环的条件变量
+
+        启动预热在 asyncio.run 的事件循环中执行，之后的请求由Gradio的事件循环处理；
+        限流状态（上限、基线）跨事件循环保留，只有等待用的条件变量随事件循环重新创建。
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._condition = loop, asyncio.Condition()
+        return self._condition
+
+    def _on_sample(self, latency: float):
+        self.successes += 1
+        if latency <= 0:
+            return
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        elif self.limit <= self.min_limit:
+            self.baseline += (latency - self.baseline) * self.BASELINE_DRIFT
+
+        gradient = self.baseline * self.tolerance / latency
+        if gradient < 1.0:
+            target = self.limit * max(0.5, gradient)
+            self.limit += (target - self.limit) * self.SMOOTHING
+        elif self.in_flight >= int(self.limit):
+            # 只有并发真正用满时才需要探测更高的上限
+            self.limit += 1.0 / self.limit
+        self.limit = min(max(self.limit, self.min_limit), self.max_limit)
+
+    def _on_drop(self):
+        self.drops += 1
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        logger.warning(f"{self.name} 请求失败，并发上限降为 {int(self.limit)}")
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "baseline": round(self.baseline, 4) if self.baseline is not None else None,
+            "successes": self.successes,
+            "drops": self.drops,
+        }
+
+
+async def warm_up_models(timeout: float = None) -> dict:
+    """
+    预热生成模型和embedding模型
+
+    空消息的chat请求只把模型载入内存而不生成内容，embed请求同时载入embedding模型；
+    两者都带 keep_alive，模型在空闲期间保持加载。Ollama尚未启动时重试直到超时。
+
+    Returns:
+        dict: 各模型的预热耗时(秒)，预热失败的模型为None
+    """
+    timeout = settings.STARTUP_WARMUP_TIMEOUT if timeout is None else timeout
+    client = get_async_client()
+    keep_alive = settings.OLLAMA_MODEL_KEEP_ALIVE
+
+    async def warm(model, request):
+        started = time.perf_counter()
+        delay = 0.5
+        while True:
+            try:
+                await request()
+                elapsed = time.perf_counter() - started
+                logger.info(f"模型预热完成: {model}，耗时 {elapsed:.2f} 秒")
+                return elapsed
+            except Exception as e:
+                if time.perf_counter() - started + delay > timeout:
+                    logger.warning(f"模型预热失败: {model}: {str(e)}")
+                    return None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    results = await asyncio.gather(
+        warm(settings.OLLAMA_MODEL, lambda: client.chat(
+            model=settings.OLLAMA_MODEL, messages=[], keep_alive=keep_alive
+        )),
+        warm(settings.EMBED_MODEL, lambda: client.embed(
+            model=settings.EMBED_MODEL, input=["预热"], keep_alive=keep_alive
+        )),
+    )
+    return dict(zip((settings.OLLAMA_MODEL, settings.EMBED_MODEL), results))
+
+
+@lru_cache(maxsize=None)
+def get_limiter(name: str) -> AdaptiveLimiter:
+    """
+    按名称获取全局共享的限流器
+
+    chat 用于生成；embed 用于文档批量向量化，query 用于单条问题向量化。
+    两类向量化请求的延迟相差很大，分开统计基线。
+    """
+    if name == "chat":
+        return AdaptiveLimiter(name, settings.WORKERS, settings.LLM_CONCURRENCY_MAX)
+    if name in ("embed", "query"):
+        return AdaptiveLimiter(name, settings.EMBED_CONCURRENCY_INITIAL, settings.EMBED_CONCURRENCY_MAX)
+    raise ValueError(f"未知的限流器: {name}")
+
+
+class PooledOllamaEmbeddings(Embeddings):
+    """
+    基于共享连接池的Ollama embedding模型
+
+    异步接口直接使用共享的异步客户端，文档和问题分别经过 embed、query 限流器；
+    同步接口供工作线程中的旧调用路径使用。
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.limiter = get_limiter("embed")
+        self.query_limiter = get_limiter("query")
+
+    def embed_documents(self, texts: list) -> list:
+        if not texts:
+            return []
+        with metrics.span("embed_documents"):
+            return list(get_sync_client().embed(
+                model=self.model, input=texts, keep_alive=settings.OLLAMA_MODEL_KEEP_ALIVE
+            )["embeddings"])
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+    async def _aembed(self, texts: list, limiter: AdaptiveLimiter) -> list:
+        stage = "embed_documents" if limiter is self.limiter else "embed_query"
+        async with limiter.acquire() as permit:
+            with metrics.span(stage, texts=len(texts)):
+                response = await get_async_client().embed(
+                    model=self.model, input=texts, keep_alive=settings.OLLAMA_MODEL_KEEP_ALIVE
+                )
+            # 批次大小不一，按单条文本的平均耗时作为延迟样本
+            permit.sample((time.perf_counter() - permit.started_at) / len(texts))
+        return list(response["embeddings"])
+
+    async def aembed_documents(self, texts: list) -> list:
+        if not texts:
+            return []
+        return await self._aembed(texts, self.limiter)
+
+    async def aembed_query(self, text: str) -> list:
+        return (await self._aembed([text], self.query_limiter))[0]
+
+    async def aembed_queries(self, texts: list) -> list:
+        """一次请求计算多个问题的向量，供检索微批处理使用"""
+        if not texts:
+            return []
+        return await self._aembed(texts, self.query_limiter)
@@ -1,12 +1,78 @@
-from langchain_community.document_loaders import PyMuPDFLoader
 # RecursiveCharacterTextSplitter 用于递归地将文本分割成更小的部分
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from core.text_chunker import TokenTextChunker
 from config.config import settings
 from utils.logger import logger
+from utils.metrics import metrics
 # asyncio 提供异步I/O操作的支持，允许编写并发代码
 import asyncio
 # ThreadPoolExecutor 用于管理线程池，支持多线程并发执行
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from langchain_core.documents import Document
+from collections import deque
+import multiprocessing
+import threading
+import time
+# fitz(PyMuPDF) 用于按页范围读取PDF
+import fitz
+
+
+def _pdf_loader(pdf_path: str):
+    """创建PDF加载器；langchain_community 导入较慢，首次使用时才导入，缩短启动时间"""
+    from langchain_community.document_loaders import PyMuPDFLoader
+    return PyMuPDFLoader(pdf_path)
+
+
+def make_text_splitter():
+    """
+    按 CHUNKER 创建文本分割器
+
+    - token: 按token预算单遍分割，句子边界包括中文标点（默认）
+    - recursive: langchain 的 RecursiveCharacterTextSplitter，按字符数分割
+    """
+    if settings.CHUNKER == "recursive":
+        return RecursiveCharacterTextSplitter(
+            chunk_size=settings.CHUNK_SIZE,  # 每个文本块的最大字符数
+            chunk_overlap=settings.CHUNK_OVERLAP,  # 相邻文本块之间的重叠字符数
+            add_start_index=True  # 记录分块在页面中的起始位置，组装上下文时据此合并相邻分块
+        )
+    if settings.CHUNKER != "token":
+        raise ValueError(f"不支持的分割器: {settings.CHUNKER}")
+    return TokenTextChunker()
+
+
+def _parse_page_range(pdf_path: str, start: int, end: int):
+    """
+    在子进程中解析并分割PDF的 [start, end) 页
+
+    页面元数据与 PyMuPDFLoader 保持一致（source、file_path、page、total_pages 及文档元数据）。
+    """
+    splitter = make_text_splitter()
+    with fitz.open(pdf_path) as doc:
+        doc_metadata = {
+            key: value for key, value in doc.metadata.items()
+            if isinstance(value, (str, int))
+        }
+        pages = []
+        for number in range(start, end):
+            metadata = {
+                "source": pdf_path,
+                "file_path": pdf_path,
+                "page": number,
+                "total_pages": doc.page_count,
+                **doc_metadata,
+            }
+            pages.append(Document(page_content=doc[number].get_text(), metadata=metadata))
+    return splitter.split_documents(pages)
+
+
+def _parse_file(pdf_path: str):
+    """在子进程中计算文件哈希并解析、分割整个PDF，返回 (文件哈希, 页数, 分块)"""
+    from core.segmented_store import file_hash
+    with fitz.open(pdf_path) as doc:
+        total_pages = doc.page_count
+    return file_hash(pdf_path), total_pages, _parse_page_range(pdf_path, 0, total_pages)
+
 
 class PDFProcessor:
     """
@@ -23,12 +89,12 @@ class PDFProcessor:
         - 文本分割器：用于将PDF文档分割成较小的文本块
         - 线程池：用于处理IO密集型操作
         """
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=settings.CHUNK_SIZE,  # 每个文本块的最大字符数
-            chunk_overlap=settings.CHUNK_OVERLAP  # 相邻文本块之间的重叠字符数
-        )
+        self.text_splitter = make_text_splitter()
         # 创建线程池，用于管理线程池，支持多线程并发执行
         self.executor = ThreadPoolExecutor(max_workers=settings.WORKERS)  
+        # 进程池：大文件按页范围分片并行解析，首次使用时才创建
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
         
     async def process_pdf(self, pdf_path: str):
         """
@@ -54,6 +120,92 @@ class PDFProcessor:
         """
         同步处理PDF文件
         """
-        loader = PyMuPDFLoader(pdf_path)  # 创建PDF加载器实例
-        data = loader.load()  # 加载PDF文件内容
-        return self.text_splitter.split_documents(data)  # 将文档分割成块并返回 
\ No newline at end of file
+        total_pages = self.page_count(pdf_path)
+        if self.use_process_pool(total_pages):
+            # 大文件：按页范围分片到进程池并行解析，按页序合并
+            chunks = []
+            for _, _, shard_chunks in self.iter_sharded_chunks(pdf_path, total_pages):
+                chunks.extend(shard_chunks)
+            return chunks
+        loader = _pdf_loader(pdf_path)  # 创建PDF加载器实例
+        with metrics.span("pdf_load"):
+            data = loader.load()  # 加载PDF文件内容
+        with metrics.span("split"):
+            return self.text_splitter.split_documents(data)  # 将文档分割成块并返回 
+
+    @staticmethod
+    def page_count(pdf_path: str) -> int:
+        """读取PDF总页数"""
+        with fitz.open(pdf_path) as doc:
+            return doc.page_count
+
+    @staticmethod
+    def use_process_pool(total_pages: int) -> bool:
+        """小文件在进程内解析，避免进程启动和数据传输的开销超过并行收益"""
+        return (
+            settings.PDF_PROCESS_POOL_ENABLED
+            and settings.WORKERS > 1
+            and total_pages >= settings.PDF_PROCESS_POOL_MIN_PAGES
+        )
+
+    def _get_process_pool(self):
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # 使用spawn启动子进程，避免在多线程的服务进程中fork
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=settings.WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._process_pool
+
+    def submit_file(self, pdf_path: str):
+        """
+        把整个文件提交到进程池解析，批量入库时多个文件并行处理
+
+        Returns:
+            concurrent.futures.Future: 结果为 (文件哈希, 页数, 分块)
+        """
+        return self._get_process_pool().submit(_parse_file, pdf_path)
+
+    def iter_sharded_chunks(self, pdf_path: str, total_pages: int):
+        """
+        在进程池中按页范围分片解析PDF
+
+        同时在途的分片数限制为进程数的两倍，结果按页序产出，
+        因此内存占用与文档总页数无关。
+
+        Yields:
+            tuple: (起始页, 结束页, 该范围内的分块)
+        """
+        pool = self._get_process_pool()
+        shard_size = settings.PDF_PAGES_PER_SHARD
+        ranges = deque(
+            (start, min(start + shard_size, total_pages))
+            for start in range(0, total_pages, shard_size)
+        )
+        in_flight = deque()
+        while ranges or in_flight:
+            while ranges and len(in_flight) < settings.WORKERS * 2:
+                start, end = ranges.popleft()
+                future = pool.submit(_parse_page_range, pdf_path, start, end)
+                in_flight.append((start, end, future, time.perf_counter()))
+            start, end, future, submitted = in_flight.popleft()
+            chunks = future.result()
+            # 子进程中的耗时无法直接采集，记录分片从提交到完成的时间
+            metrics.observe_stage("pdf_shard", time.perf_counter() - submitted)
+            yield start, end, chunks
+
+    def iter_pages(self, pdf_path: str):
+        """逐页读取PDF，每次只在内存中保留一页"""
+        pages = _pdf_loader(pdf_path).lazy_load()
+        while True:
+            with metrics.span("pdf_load"):
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+    def split_page(self, page):
+        """分割单页文档，结果与整本分割时一致"""
+        with metrics.span("split"):
+            return self.text_splitter.split_documents([page])
@@ -0,0 +1,136 @@
+from utils.token_counter import get_token_counter
+from config.config import settings
+
+# 系统提示词，所有轮次、所有会话相同，作为可复用的提示词前缀
+SYSTEM_PROMPT = """你是一个专业的AI助手。请基于提供的上下文回答问题。
+- 回答要简洁明了，避免重复
+- 如果上下文中没有相关信息，请直接说明
+- 结合此前的对话理解追问中省略的对象
+- 保持回答的连贯性和逻辑性
+- 请用中文回答"""
+
+# 生成对话摘要的系统提示词
+SUMMARY_PROMPT = """你负责压缩对话记录。请把已有摘要和新增对话合并为一段简洁的中文摘要，
+保留用户关心的对象、已经确认的事实和尚未解决的问题，不要添加对话中没有的内容，不超过{limit}个字。"""
+
+# 每条消息的角色标记等额外token数的估计
+_MESSAGE_OVERHEAD = 4
+
+
+class Prompt:
+    """一次生成请求的消息列表及其token统计"""
+
+    def __init__(self, messages: list, prompt_tokens: int, history_turns: int, summarized_turns: int):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.history_turns = history_turns
+        self.summarized_turns = summarized_turns
+
+    def as_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "history_turns": self.history_turns,
+            "summarized_turns": self.summarized_turns,
+        }
+
+
+class PromptBuilder:
+    """
+    多轮对话的提示词组装
+
+    消息按变化频率从低到高排列，使相邻轮次的提示词共享尽可能长的前缀，Ollama可以复用前缀的KV缓存：
+    1. 固定的系统提示词
+    2. 较早对话的滚动摘要，只在压缩边界移动时变化
+    3. 最近的历史对话，原样逐轮追加（历史中的问题不带当时的上下文）
+    4. 本轮检索到的上下文和问题
+
+    历史对话的token数超过 HISTORY_MAX_TOKENS 时，最早的对话每次按 HISTORY_COMPACT_TURNS 轮
+    移入摘要；压缩边界只取决于历史本身，两次压缩之间摘要和历史前缀保持不变。
+    """
+
+    def __init__(self, history_tokens: int = None, compact_turns: int = None, summary_tokens: int = None,
+                 token_counter=None):
+        self.history_tokens = settings.HISTORY_MAX_TOKENS if history_tokens is None else history_tokens
+        self.compact_turns = max(1, compact_turns or settings.HISTORY_COMPACT_TURNS)
+        self.summary_tokens = summary_tokens or settings.HISTORY_SUMMARY_TOKENS
+        self.token_counter = token_counter or get_token_counter()
+
+    @property
+    def enabled(self) -> bool:
+        """是否在提示词中带上历史对话"""
+        return self.history_tokens > 0
+
+    def _turn_tokens(self, turn) -> int:
+        question, answer = turn
+        return self.token_counter.count(question) + self.token_counter.count(answer) + 2 * _MESSAGE_OVERHEAD
+
+    def split_history(self, history: list) -> tuple:
+        """
+        把历史对话分为需要压缩为摘要的较早部分和原样保留的最近部分
+
+        Args:
+            history: [(问题, 回答)]，回答为空的轮次被忽略
+
+        Returns:
+            tuple: (较早的对话, 最近的对话)
+        """
+        if not self.enabled:
+            return [], []
+        turns = [(question, answer) for question, answer in history if question and answer]
+        counts = [self._turn_tokens(turn) for turn in turns]
+        start, total = 0, sum(counts)
+        while start < len(turns) and total > self.history_tokens:
+            step = min(self.compact_turns, len(turns) - start)
+            total -= sum(counts[start:start + step])
+            start += step
+        return turns[:start], turns[start:]
+
+    @staticmethod
+    def _user_prompt(question: str, context: str) -> str:
+        if not context:
+            return question
+        return f"相关上下文：\n{context}\n\n问题：{question}"
+
+    def build(self, question: str, context: str, recent: list, summary: str = "", summarized_turns: int = 0) -> Prompt:
+        """
+        组装发送给模型的消息列表
+
+        Args:
+            question: 用户当前问题
+            context: 本轮检索到的上下文，为空时直接与模型对话
+            recent: split_history 返回的最近的对话
+            summary: 较早对话的摘要
+            summarized_turns: 摘要覆盖的轮数
+        """
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if summary:
+            messages.append({"role": "system", "content": f"此前对话的摘要：\n{summary}"})
+        for previous_question, previous_answer in recent:
+            messages.append({"role": "user", "content": previous_question})
+            messages.append({"role": "assistant", "content": previous_answer})
+        messages.append({"role": "user", "content": self._user_prompt(question, context)})
+        prompt_tokens = sum(
+            self.token_counter.count(message["content"]) + _MESSAGE_OVERHEAD for message in messages
+        )
+        return Prompt(messages, prompt_tokens, len(recent), summarized_turns)
+
+    def summary_messages(self, previous: str, turns: list) -> list:
+        """请模型把已有摘要和新移出的对话合并为新摘要的消息列表"""
+        lines = [f"已有摘要：{previous or '无'}", "", "新增对话："]
+        for question, answer in turns:
+            lines.append(f"用户：{question}")
+            lines.append(f"助手：{answer}")
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT.format(limit=self.summary_tokens)},
+            {"role": "user", "content": "\n".join(lines)},
+        ]
+
+    def fallback_summary(self, previous: str, turns: list) -> str:
+        """无法调用模型生成摘要时，只保留已有摘要和用户问过的问题"""
+        asked = "；".join(question for question, _ in turns)
+        summary = f"{previous}\n用户还问过：{asked}" if previous else f"用户问过：{asked}"
+        return self.clip_summary(summary)
+
+    def clip_summary(self, summary: str) -> str:
+        """把摘要截断到 HISTORY_SUMMARY_TOKENS 以内"""
+        return self.token_counter.truncate(summary.strip(), self.summary_tokens)
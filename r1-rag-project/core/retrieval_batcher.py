@@ -0,0 +1,125 @@
+from config.config import settings
+from utils.logger import logger
+import asyncio
+
+
+class MicroBatcher:
+    """
+    微批处理器
+
+    收集在 max_wait 秒内到达、或达到 max_batch 个的请求，合并为一次批量调用，
+    再把结果分发给各自等待的协程。单个请求因攒批增加的等待不超过 max_wait。
+    """
+
+    def __init__(self, name: str, process, max_batch: int, max_wait: float):
+        """
+        Args:
+            name: 名称，用于日志
+            process: 批量处理协程函数，输入请求列表，返回等长的结果列表
+            max_batch: 每批最多的请求数
+            max_wait: 第一个请求到达后最多等待的秒数
+        """
+        self.name = name
+        self.process = process
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        # 保留正在运行的批次任务的引用，避免被垃圾回收
+        self._tasks = set()
+
+    async def submit(self, item):
+        """提交一个请求并等待其结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # 已取消的请求（如客户端断开）不再处理
+        batch = [(item, future) for item, future in self._pending if not future.done()]
+        self._pending = []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await self.process([item for item, _ in batch])
+        except Exception as e:
+            logger.error(f"{self.name} 批处理失败: {str(e)}", exc_info=True)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.debug(f"{self.name} 批处理 {len(batch)} 个请求")
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class RetrievalBatcher:
+    """
+    检索微批处理
+
+    并发会话的问题向量化合并为一次Ollama请求，向量检索合并为一次批量 index.search，
+    以更少的往返和BLAS批量计算替代大量单条请求。
+    """
+
+    def __init__(self, store, embeddings, max_batch: int = None, max_wait_ms: float = None):
+        """
+        Args:
+            store: 分段向量存储
+            embeddings: embedding模型，需提供 aembed_queries
+            max_batch: 每批最多的请求数
+            max_wait_ms: 攒批最长等待时间(毫秒)
+        """
+        self.store = store
+        self.embeddings = embeddings
+        max_batch = max_batch or settings.RETRIEVAL_BATCH_MAX_SIZE
+        max_wait = (max_wait_ms if max_wait_ms is not None else settings.RETRIEVAL_BATCH_MAX_WAIT_MS) / 1000
+        self._embedder = MicroBatcher("问题向量化", self._embed_batch, max_batch, max_wait)
+        self._searcher = MicroBatcher("向量检索", self._search_batch, max_batch, max_wait)
+
+    async def embed(self, query: str) -> list:
+        """计算问题向量，与同一时间窗口内的其他问题合并请求"""
+        return await self._embedder.submit(query)
+
+    async def retrieve(self, query: str, k: int, vector=None, doc_ids=None) -> list:
+        """检索相关分块，与同一时间窗口内的其他查询合并检索；doc_ids 限定检索的文档"""
+        if vector is None:
+            vector = await self.embed(query)
+        doc_ids = None if doc_ids is None else tuple(sorted(set(doc_ids)))
+        return await self._searcher.submit((query, k, vector, doc_ids))
+
+    async def _embed_batch(self, queries: list) -> list:
+        # 同一批次中相同的问题只计算一次
+        unique = list(dict.fromkeys(queries))
+        vectors = dict(zip(unique, await self.embeddings.aembed_queries(unique)))
+        return [vectors[query] for query in queries]
+
+    async def _search_batch(self, items: list) -> list:
+        # 按k和文档范围分组，每组一次批量检索
+        groups = {}
+        for position, (query, k, vector, doc_ids) in enumerate(items):
+            groups.setdefault((k, doc_ids), []).append((position, query, vector))
+        results = [None] * len(items)
+        for (k, doc_ids), group in groups.items():
+            docs = await asyncio.to_thread(
+                self.store.retrieve_batch,
+                [query for _, query, _ in group],
+                k,
+                [vector for _, _, vector in group],
+                doc_ids
+            )
+            for (position, _, _), found in zip(group, docs):
+                results[position] = found
+        return results
@@ -0,0 +1,993 @@
+from langchain_community.vectorstores import FAISS
+from langchain_core.vectorstores import VectorStore as BaseVectorStore
+from langchain_core.documents import Document
+from core.index_manifest import IndexManifest
+from core.ann_index import (
+    build_index, apply_search_params, index_type_of, storage_of, is_compressed, rescore,
+    restricted_search_params, search_thread_limits
+)
+from core.sqlite_docstore import SQLiteDocstore, SQLiteDocstoreWriter, PositionIdMap
+from core.lexical_index import LexicalIndex, LexicalSegment, reciprocal_rank_fusion
+from core.near_dedup import NearDuplicateIndex
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from filelock import FileLock
+import numpy as np
+import faiss
+import tempfile
+import asyncio
+import hashlib
+import shutil
+import threading
+import time
+import io
+import os
+
+
+def file_hash(path: str) -> str:
+    """计算文件内容的SHA-256，作为文档ID"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_chunk_id(doc_id: str, position: int) -> str:
+    """文档中第 position 个分块的ID"""
+    return f"{doc_id[:16]}-{position:06d}"
+
+
+# 文档删除后仍被其他文档引用的代表分块，转入以此为前缀的共享条目
+SHARED_PREFIX = "shared-"
+# 分段构建目录的前缀，位于分段目录下
+BUILD_PREFIX = ".build-"
+# 构建目录超过该秒数未被修改时，视为进程崩溃后遗留的目录
+_STALE_BUILD_SECONDS = 24 * 3600
+
+
+class SegmentedVectorStore(BaseVectorStore):
+    """
+    分段式向量存储
+
+    每次上传的文档写入一个独立的分段（FAISS索引 + SQLite分块存储 + 原始向量），
+    并在清单中记录文件哈希、分块ID和向量区间：
+    - 新增文档只写新分段，代价为 O(新分块数)
+    - 删除文档只在清单中标记已删除分块，检索时过滤
+    - 后台合并把小分段和删除较多的分段压缩为一个分段
+
+    检索时各分段作为分片在线程池中并行搜索，按距离合并 top-k；
+    限定文档范围的检索只搜索包含这些文档的分段。
+
+    多个进程可以共享同一个向量库目录：写操作持有目录下的文件锁，并在加锁后先同步其他进程的修改；
+    检索前每隔 INDEX_REFRESH_INTERVAL 秒检查清单文件，发现变化时只加载新增的分段。
+    """
+
+    def __init__(self, db_path: str, embeddings):
+        self.db_path = db_path
+        self.segment_dir = os.path.join(db_path, "segments")
+        self.manifest = IndexManifest(db_path)
+        self._embedding = embeddings
+        # 写操作（新增、删除、合并）串行执行，文件锁使多个进程之间也串行
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(db_path, ".write.lock"))
+        self._next_refresh = 0.0
+        # 检索使用的只读视图：(分段ID -> FAISS, 分段ID -> 已删除分块ID集合)
+        # 写操作完成后整体替换，检索线程无需加锁
+        self._view = ({}, {})
+        # BM25倒排索引，与向量分段同步增删
+        self.lexical = LexicalIndex()
+        # 近似重复分块索引，入库时跳过与已有分块重复的分块
+        self.near_dup = NearDuplicateIndex(db_path) if settings.NEAR_DUP_ENABLED else None
+        # 并行检索分段的线程池，首次检索时创建
+        self._search_pool = None
+        self._loaded = False
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    @property
+    def version(self) -> int:
+        """索引版本号，每次保存清单（包括合并分段）后递增"""
+        return self.manifest.version
+
+    @property
+    def corpus_version(self) -> int:
+        """语料版本号，只在增删文档后递增"""
+        return self.manifest.corpus_version
+
+    def load(self):
+        """加载清单和全部分段；兼容旧版单文件索引"""
+        with self._lock:
+            if self._loaded:
+                return
+            os.makedirs(self.segment_dir, exist_ok=True)
+            self._remove_stale_builds()
+            if self.manifest.exists():
+                self._reload()
+            elif os.path.exists(os.path.join(self.db_path, "index.faiss")):
+                with self._write_lock():
+                    if not self.manifest.exists():
+                        self._import_legacy()
+            self._loaded = True
+
+    def _reload(self) -> bool:
+        """清单被其他进程修改后重新加载：已打开的分段直接复用，只加载新增的分段"""
+        if not self.manifest.changed_on_disk():
+            return False
+        self.manifest.load()
+        current = self._view[0]
+        segments = {
+            segment_id: current.get(segment_id) or self._load_segment(segment_id)
+            for segment_id in self.manifest.segments
+        }
+        for segment_id in current:
+            if segment_id not in segments:
+                self.lexical.remove_segment(segment_id)
+        self._publish(segments)
+        return True
+
+    def _remove_stale_builds(self):
+        """删除崩溃后遗留的构建目录；其他进程正在使用的构建目录持续被写入，不会被删除"""
+        now = time.time()
+        for name in os.listdir(self.segment_dir):
+            if not name.startswith(BUILD_PREFIX):
+                continue
+            path = os.path.join(self.segment_dir, name)
+            try:
+                modified = max(
+                    [os.path.getmtime(path)] + [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path)]
+                )
+            except FileNotFoundError:
+                continue
+            if now - modified > _STALE_BUILD_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.info(f"已删除遗留的分段构建目录: {name}")
+
+    def _remove_orphan_segments(self):
+        """
+        删除清单中没有记录的分段目录，即写入分段后、保存清单前崩溃遗留的目录
+
+        需持有写锁：其他进程保存分段和清单也在写锁内完成，不会把正在写入的分段当作遗留目录。
+        """
+        referenced = set(self.manifest.segments) | set(self.manifest.retired)
+        for name in os.listdir(self.segment_dir):
+            if name.startswith(BUILD_PREFIX) or name in referenced:
+                continue
+            shutil.rmtree(self._segment_path(name), ignore_errors=True)
+            logger.info(f"已删除清单中没有记录的分段目录: {name}")
+
+    def refresh(self) -> bool:
+        """同步其他进程对索引的修改，返回是否有变化"""
+        if not self._loaded or not self.manifest.changed_on_disk():
+            return False
+        with self._lock:
+            changed = self._reload()
+        if changed:
+            logger.info(f"索引已被其他进程更新，当前版本 {self.version}")
+        return changed
+
+    def _maybe_refresh(self):
+        """检索前按间隔检查清单文件，避免每次检索都访问文件系统"""
+        now = time.monotonic()
+        if settings.INDEX_REFRESH_INTERVAL >= 0 and now >= self._next_refresh:
+            self._next_refresh = now + settings.INDEX_REFRESH_INTERVAL
+            self.refresh()
+
+    def current_corpus_version(self) -> int:
+        """按间隔同步其他进程的修改后返回语料版本；命中答案缓存时不经过检索，需先在这里同步"""
+        self._maybe_refresh()
+        return self.corpus_version
+
+    @contextmanager
+    def _write_lock(self):
+        """写操作的锁：进程内和进程间都串行执行；加锁后先同步其他进程的修改，避免分段ID冲突或覆盖清单"""
+        with self._lock, self._file_lock:
+            self._reload()
+            yield
+
+    def preload(self) -> int:
+        """
+        把各分段的文件读入操作系统页缓存
+
+        分段以内存映射方式打开，首次检索时才从磁盘读取；启动时预先顺序读取一遍，
+        首个问题不再承担磁盘读取的延迟。
+
+        Returns:
+            int: 读取的字节数
+        """
+        self.load()
+        total = 0
+        for segment_id in list(self.manifest.segments):
+            path = self._segment_path(segment_id)
+            for name in os.listdir(path):
+                file_path = os.path.join(path, name)
+                if not os.path.isfile(file_path):
+                    continue
+                with open(file_path, "rb") as f:
+                    while block := f.read(4 * 1024 * 1024):
+                        total += len(block)
+        return total
+
+    def _segment_path(self, segment_id: str) -> str:
+        return os.path.join(self.segment_dir, segment_id)
+
+    def _load_segment(self, segment_id: str):
+        """
+        加载分段
+
+        向量索引以只读内存映射方式打开，分块文本留在SQLite中按需读取，
+        因此加载几乎不耗时，多个进程共享同一份页缓存。
+        """
+        path = self._segment_path(segment_id)
+        if not os.path.exists(os.path.join(path, SQLiteDocstore.FILE_NAME)):
+            self._migrate_pickle_segment(path)
+        index = self._read_index(os.path.join(path, "index.faiss"))
+        apply_search_params(index)
+        docstore = SQLiteDocstore(os.path.join(path, SQLiteDocstore.FILE_NAME))
+
+        lexical_path = os.path.join(path, LexicalSegment.FILE_NAME)
+        if os.path.exists(lexical_path):
+            lexical = LexicalSegment.load(lexical_path)
+        else:
+            # 旧分段没有倒排索引，或是 pickle 格式的 lexical.pkl；从分块存储补建，不反序列化旧文件
+            ids, texts = zip(*docstore.iter_texts()) if docstore.count() else ((), ())
+            lexical = LexicalSegment.build(list(ids), list(texts))
+            lexical.save(lexical_path)
+            legacy_path = os.path.join(path, "lexical.pkl")
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+        self.lexical.add_segment(segment_id, lexical)
+        store = FAISS(self._embedding, index, docstore, PositionIdMap(docstore))
+        # 压缩索引的候选用全精度向量重排；向量以内存映射方式打开，只有被读取的行进入内存
+        vectors_path = os.path.join(path, "vectors.npy")
+        store.full_vectors = (
+            np.load(vectors_path, mmap_mode="r")
+            if is_compressed(index) and os.path.exists(vectors_path) else None
+        )
+        return store
+
+    @staticmethod
+    def _read_index(index_path: str):
+        """读取FAISS索引，开启 INDEX_MMAP 时以只读内存映射方式打开"""
+        if settings.INDEX_MMAP:
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+            try:
+                return faiss.read_index(index_path, flags)
+            except RuntimeError as e:
+                # 部分索引类型不支持内存映射，退回普通读取
+                logger.warning(f"索引不支持内存映射，改为读入内存: {index_path}, {str(e)}")
+        return faiss.read_index(index_path)
+
+    def _migrate_pickle_segment(self, path: str):
+        """把旧格式(index.pkl)分段的分块迁移到SQLite"""
+        store = FAISS.load_local(
+            path,
+            self._embedding,
+            allow_dangerous_deserialization=True  # 分段文件由本服务自己写入
+        )
+        ids = [store.index_to_docstore_id[i] for i in range(store.index.ntotal)]
+        SQLiteDocstore.create(
+            os.path.join(path, SQLiteDocstore.FILE_NAME),
+            ids,
+            {chunk_id: store.docstore.search(chunk_id) for chunk_id in ids}
+        )
+        os.remove(os.path.join(path, "index.pkl"))
+        logger.info(f"已把分段分块存储迁移到SQLite: {path}")
+
+    def _save_segment(self, segment_id: str, builder):
+        """
+        保存分段：FAISS索引、SQLite分块存储，以及用于合并和重建近似索引的原始向量
+
+        向量和分块在追加时已写入构建目录，这里移入分段目录，再从内存映射的向量构建检索索引、
+        从分块存储逐条读取文本建立倒排索引，不在内存中复制整个分段。
+        先写入临时目录再整体改名，崩溃时不会留下不完整的分段。
+        """
+        path = self._segment_path(segment_id)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        vectors = builder.finish(tmp_path)
+        index = build_index(vectors)
+        logger.info(f"已构建 {index_type_of(index)}/{storage_of(index)} 索引，{index.ntotal} 个向量")
+        faiss.write_index(index, os.path.join(tmp_path, "index.faiss"))
+        del index, vectors
+        docstore = SQLiteDocstore(os.path.join(tmp_path, SQLiteDocstore.FILE_NAME))
+        LexicalSegment.build(
+            builder.ids, (text for _, text in docstore.iter_texts())
+        ).save(os.path.join(tmp_path, LexicalSegment.FILE_NAME))
+        os.replace(tmp_path, path)
+        builder.discard()
+        return self._load_segment(segment_id)
+
+    def _segment_vectors(self, segment_id: str, store):
+        """读取分段的原始向量"""
+        path = os.path.join(self._segment_path(segment_id), "vectors.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode="r")
+        # 旧分段没有单独保存向量，从索引中还原
+        index = faiss.downcast_index(store.index)
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        return index.reconstruct_n(0, index.ntotal)
+
+    def _publish(self, segments: dict):
+        """发布新的只读检索视图"""
+        deleted = {
+            segment_id: self.manifest.deleted_ids(segment_id)
+            for segment_id in segments
+        }
+        self.lexical.update_deleted(deleted)
+        self._view = (segments, deleted)
+
+    def has_document(self, doc_id: str) -> bool:
+        return doc_id in self.manifest.documents
+
+    def dedup_session(self):
+        """开始一次入库的近似重复过滤，未启用时返回None；同名旧文档的分块不作为去重依据"""
+        if self.near_dup is None:
+            return None
+        return self.near_dup.session(self.manifest.find_by_source)
+
+    def _commit_dedup(self, dedup, doc_ids):
+        """索引提交后写入去重会话中属于已写入文档的记录"""
+        if dedup is None or self.near_dup is None:
+            return
+        saved = self.near_dup.commit(dedup, doc_ids)
+        if saved:
+            logger.info(f"近似重复过滤: {saved} 个分块引用已有分块，节省 {saved} 次向量化")
+
+    def _remove_document(self, doc_id: str) -> dict:
+        """
+        从清单中移除文档
+
+        文档中仍被其他文档作为代表分块引用的分块不删除，转入共享条目；
+        共享条目中已无引用的分块随之释放。
+        """
+        doc = self.manifest.remove_document(doc_id)
+        if self.near_dup is not None:
+            owner = SHARED_PREFIX + doc_id
+            shared = self.near_dup.remove_document(doc_id, owner)
+            if shared:
+                self.manifest.keep_shared(owner, doc, shared)
+            released = self.near_dup.release_unreferenced(
+                shared_id for shared_id in self.manifest.documents if shared_id.startswith(SHARED_PREFIX)
+            )
+            self.manifest.release_shared(released)
+        return doc
+
+    def add_document(self, doc_id: str, source: str, documents: list) -> bool:
+        """
+        把一个文档的分块写入新分段
+
+        Args:
+            doc_id: 文档ID（文件内容哈希）
+            source: 文件名，同名文件内容变化时替换旧文档
+            documents: 文档分块
+
+        Returns:
+            bool: 是否写入了新分段（内容已索引过时返回False）
+        """
+        prepared = self._prepare_document(doc_id, source, documents)
+        if prepared is None:
+            return False
+        documents, ids, dedup = prepared
+        texts = [doc.page_content for doc in documents]
+        # 向量计算在锁外进行，不阻塞其他写操作
+        vectors = self._embedding.embed_documents(texts) if texts else []
+        return self.add_embeddings(
+            doc_id, source, texts, vectors, [doc.metadata for doc in documents], ids, dedup
+        )
+
+    async def aadd_document(self, doc_id: str, source: str, documents: list) -> bool:
+        """
+        add_document 的异步版本
+
+        向量通过异步接口计算，经过 embed 限流器，等待期间不占用工作线程；
+        去重过滤和分段写入仍在工作线程中执行。
+        """
+        prepared = await asyncio.to_thread(self._prepare_document, doc_id, source, documents)
+        if prepared is None:
+            return False
+        documents, ids, dedup = prepared
+        texts = [doc.page_content for doc in documents]
+        vectors = await self._embedding.aembed_documents(texts) if texts else []
+        return await asyncio.to_thread(
+            self.add_embeddings, doc_id, source, texts, vectors, [doc.metadata for doc in documents], ids, dedup
+        )
+
+    def _prepare_document(self, doc_id: str, source: str, documents: list):
+        """
+        检查文档是否需要写入，并过滤与已有分块近似重复的分块
+
+        Returns:
+            tuple: (保留的分块, 分块ID, 去重会话)；不需要写入时返回None
+        """
+        if self.has_document(doc_id):
+            logger.info(f"文档已在索引中，跳过: {source}")
+            return None
+        if not documents:
+            logger.warning(f"文档没有可索引的分块: {source}")
+            return None
+        ids = [make_chunk_id(doc_id, i) for i in range(len(documents))]
+        dedup = self.dedup_session()
+        if dedup is not None:
+            documents, ids = dedup.filter(doc_id, source, documents, ids)
+        return documents, ids, dedup
+
+    def add_embeddings(self, doc_id: str, source: str, texts: list, vectors, metadatas: list,
+                       ids: list = None, dedup=None) -> bool:
+        """把已计算好向量的分块写入新分段，并替换同名旧文档"""
+        builder = self.begin_document(doc_id)
+        builder.add(texts, vectors, metadatas, ids)
+        return self.commit_document(builder, source, dedup)
+
+    def begin_document(self, doc_id: str = None):
+        """开始增量写入一个文档，分块可分批追加到返回的构建器中；批量写入多个文档时不指定文档ID"""
+        return SegmentBuilder(self.segment_dir, doc_id)
+
+    @staticmethod
+    @contextmanager
+    def _discarding(builder):
+        """提交结束后删除构建目录，分段已保存或不需要保存时都不再保留"""
+        try:
+            yield
+        finally:
+            builder.discard()
+
+    @metrics.timed("index_commit")
+    def commit_document(self, builder, source: str, dedup=None) -> bool:
+        """
+        把构建器中的分块作为新分段落盘并发布，同时替换同名旧文档
+
+        Args:
+            builder: 追加了文档全部分块的构建器
+            source: 文件名
+            dedup: 入库时使用的去重会话；全部分块都与已有分块重复时只登记文档和重复引用
+        """
+        doc_id = builder.doc_id
+        with self._write_lock(), self._discarding(builder):
+            if self.has_document(doc_id):
+                return False
+            if not builder.ids and not (dedup is not None and dedup.saved):
+                logger.warning(f"文档没有可索引的分块: {source}")
+                return False
+            ids = builder.ids
+            segments = dict(self._view[0])
+            segment_id = None
+            if ids:
+                segment_id = self.manifest.new_segment_id()
+                segments[segment_id] = self._save_segment(segment_id, builder)
+                self.manifest.add_segment(segment_id, len(ids))
+
+            old_doc_id = self.manifest.find_by_source(source)
+            if old_doc_id is not None:
+                self._remove_document(old_doc_id)
+                logger.info(f"文档内容已变化，替换旧版本: {source}")
+            self.manifest.add_document(doc_id, source, segment_id, ids, (0, len(ids)))
+            self._commit_dedup(dedup, [doc_id])
+            self.manifest.save()
+            self._publish(segments)
+            logger.info(f"已写入分段 {segment_id}: {source}，{len(ids)} 个分块")
+            return True
+
+    @metrics.timed("index_commit")
+    def commit_documents(self, builder, documents: list, dedup=None) -> list:
+        """
+        把多个文档的分块作为一个分段落盘并发布，批量入库时减少分段数和清单写入次数
+
+        Args:
+            builder: 按文档顺序追加了全部分块的构建器
+            documents: [(文档ID, 来源, (起始位置, 结束位置))]，位置为分块在构建器中的区间
+            dedup: 入库时使用的去重会话
+
+        Returns:
+            list: 写入的文档ID，已在索引中的文档被跳过
+        """
+        with self._write_lock(), self._discarding(builder):
+            if not documents:
+                return []
+            segments = dict(self._view[0])
+            segment_id = None
+            if builder.ids:
+                segment_id = self.manifest.new_segment_id()
+                segments[segment_id] = self._save_segment(segment_id, builder)
+                self.manifest.add_segment(segment_id, len(builder.ids))
+            written = []
+            for doc_id, source, (start, end) in documents:
+                chunk_ids = builder.ids[start:end]
+                if self.has_document(doc_id):
+                    # 其他进程已写入同一文档，本分段中的副本记为已删除，由合并回收
+                    if chunk_ids:
+                        self.manifest.segments[segment_id]["deleted"].extend(chunk_ids)
+                    continue
+                old_doc_id = self.manifest.find_by_source(source)
+                if old_doc_id is not None:
+                    self._remove_document(old_doc_id)
+                    logger.info(f"文档内容已变化，替换旧版本: {source}")
+                self.manifest.add_document(
+                    doc_id, source, segment_id if chunk_ids else None, chunk_ids, (start, end)
+                )
+                written.append(doc_id)
+            self._commit_dedup(dedup, written)
+            self.manifest.save()
+            self._publish(segments)
+            logger.info(f"已写入分段 {segment_id}: {len(written)} 个文档，{len(builder.ids)} 个分块")
+            return written
+
+    def delete_document(self, doc_id: str) -> bool:
+        """删除文档：在清单中标记其分块为已删除，由后台合并回收空间"""
+        with self._write_lock():
+            if not self.has_document(doc_id):
+                return False
+            doc = self._remove_document(doc_id)
+            self.manifest.save()
+            self._publish(dict(self._view[0]))
+            logger.info(f"已删除文档: {doc['source']}")
+            return True
+
+    def needs_compaction(self) -> bool:
+        return bool(self._compaction_candidates())
+
+    def _compaction_candidates(self) -> list:
+        """选出需要合并的分段：足够多的小分段，或删除比例过高的分段"""
+        small, dirty = [], []
+        for segment_id, segment in self.manifest.segments.items():
+            total = segment["num_vectors"]
+            if total and len(segment["deleted"]) / total >= settings.SEGMENT_MAX_DELETED_RATIO:
+                dirty.append(segment_id)
+            elif self.manifest.live_vectors(segment_id) < settings.SEGMENT_SMALL_VECTORS:
+                small.append(segment_id)
+        if len(small) < settings.SEGMENT_MERGE_MIN_SEGMENTS:
+            small = []
+        return small + dirty
+
+    @metrics.timed("compaction")
+    def compact(self) -> bool:
+        """把候选分段中仍然有效的分块合并写入一个新分段"""
+        with self._write_lock():
+            candidates = self._compaction_candidates()
+            if not candidates:
+                return False
+            segments = self._view[0]
+            candidate_set = set(candidates)
+
+            # 建立 分块ID -> (分段, 位置) 的映射，并取回原始向量
+            positions, vectors = {}, {}
+            for segment_id in candidates:
+                store = segments[segment_id]
+                vectors[segment_id] = self._segment_vectors(segment_id, store)
+                for position, chunk_id in store.index_to_docstore_id.items():
+                    positions[chunk_id] = (segment_id, position)
+
+            # 按文档顺序把有效分块追加到新分段，每个文档的向量区间保持连续
+            builder = self.begin_document()
+            with self._discarding(builder):
+                ranges = {}
+                for doc_id, doc in self.manifest.documents.items():
+                    if doc["segment"] not in candidate_set:
+                        continue
+                    start = len(builder.ids)
+                    by_segment = {}
+                    for chunk_id in doc["chunk_ids"]:
+                        by_segment.setdefault(positions[chunk_id][0], []).append(chunk_id)
+                    chunks = {}
+                    for segment_id, chunk_ids in by_segment.items():
+                        chunks.update(segments[segment_id].docstore.mget(chunk_ids))
+                    builder.add(
+                        [chunks[chunk_id].page_content for chunk_id in doc["chunk_ids"]],
+                        np.vstack([
+                            vectors[positions[chunk_id][0]][positions[chunk_id][1]]
+                            for chunk_id in doc["chunk_ids"]
+                        ]),
+                        [chunks[chunk_id].metadata for chunk_id in doc["chunk_ids"]],
+                        doc["chunk_ids"]
+                    )
+                    ranges[doc_id] = (start, len(builder.ids))
+
+                ids = builder.ids
+                new_segments = {k: v for k, v in segments.items() if k not in candidate_set}
+                if ids:
+                    segment_id = self.manifest.new_segment_id()
+                    store = self._save_segment(segment_id, builder)
+                    self.manifest.add_segment(segment_id, len(ids))
+                    for doc_id, vector_range in ranges.items():
+                        self.manifest.documents[doc_id]["segment"] = segment_id
+                        self.manifest.documents[doc_id]["vector_range"] = list(vector_range)
+                    new_segments[segment_id] = store
+                for old_id in candidates:
+                    del self.manifest.segments[old_id]
+                    self.lexical.remove_segment(old_id)
+                # 正在进行的检索可能仍持有旧视图，旧分段记入清单，延迟到下一次合并时再删除；
+                # 记录在清单中，进程重启后由下一次合并删除，不会遗留在磁盘上
+                for old_id in self.manifest.retired:
+                    shutil.rmtree(self._segment_path(old_id), ignore_errors=True)
+                self.manifest.retired = list(candidates)
+                self.manifest.save()
+                self._publish(new_segments)
+                self._remove_orphan_segments()
+                logger.info(f"已合并 {len(candidates)} 个分段，保留 {len(ids)} 个分块")
+                return True
+
+    def _import_legacy(self):
+        """把旧版的单文件索引(index.faiss/index.pkl)导入为一个分段"""
+        legacy = FAISS.load_local(
+            self.db_path, self._embedding, allow_dangerous_deserialization=True
+        )
+        vectors = legacy.index.reconstruct_n(0, legacy.index.ntotal)
+        by_source = {}
+        for position in range(legacy.index.ntotal):
+            chunk = legacy.docstore.search(legacy.index_to_docstore_id[position])
+            source = os.path.basename(chunk.metadata.get("source", "legacy"))
+            by_source.setdefault(source, []).append((position, chunk))
+
+        builder = self.begin_document()
+        with self._discarding(builder):
+            segment_id = self.manifest.new_segment_id()
+            self.manifest.add_segment(segment_id, legacy.index.ntotal)
+            for source, chunks in by_source.items():
+                doc_id = "legacy-" + hashlib.sha256(source.encode("utf-8")).hexdigest()
+                start = len(builder.ids)
+                chunk_ids = [f"{doc_id[:23]}-{i:06d}" for i in range(len(chunks))]
+                builder.add(
+                    [chunk.page_content for _, chunk in chunks],
+                    np.vstack([vectors[position] for position, _ in chunks]),
+                    [chunk.metadata for _, chunk in chunks],
+                    chunk_ids
+                )
+                self.manifest.add_document(doc_id, source, segment_id, chunk_ids, (start, len(builder.ids)))
+
+            store = self._save_segment(segment_id, builder)
+        ids = builder.ids
+        self.manifest.save()
+        self._publish({segment_id: store})
+        logger.info(f"已把旧版向量存储导入为分段 {segment_id}，{len(ids)} 个分块")
+
+    def _get_search_pool(self) -> ThreadPoolExecutor:
+        """
+        检索线程池
+
+        OpenMP的线程数是按线程设置的，每个检索线程启动时设置一次，
+        使并行检索的总线程数不超过CPU核数。
+        """
+        if self._search_pool is None:
+            with self._lock:
+                if self._search_pool is None:
+                    threads, omp_threads = search_thread_limits()
+                    self._search_pool = ThreadPoolExecutor(
+                        max_workers=threads,
+                        thread_name_prefix="segment-search",
+                        initializer=faiss.omp_set_num_threads,
+                        initargs=(omp_threads,)
+                    )
+                    logger.info(f"分段检索线程池: {threads} 个线程，每个线程 {omp_threads} 个OpenMP线程")
+        return self._search_pool
+
+    def _search_scope(self, doc_ids) -> dict:
+        """
+        限定文档范围时需要检索的分段和其中的向量位置
+
+        除文档自身的分块外，还包括文档中重复分块所引用的代表分块（可能位于其他文档的分段中）。
+
+        Returns:
+            dict: 分段ID -> 向量位置数组，不包含范围内文档的分段不出现
+        """
+        documents = self.manifest.documents
+        segments = self._view[0]
+        parts = {}
+        for doc_id in doc_ids:
+            doc = documents.get(doc_id)
+            if doc is None or doc["segment"] is None:
+                continue
+            start, end = doc["vector_range"]
+            parts.setdefault(doc["segment"], []).append(np.arange(start, end, dtype="int64"))
+        if self.near_dup is not None:
+            for owner, chunk_ids in self.near_dup.referenced_by(doc_ids).items():
+                doc = documents.get(owner)
+                if doc is None or doc["segment"] not in segments:
+                    continue
+                positions = segments[doc["segment"]].docstore.positions_of(chunk_ids)
+                parts.setdefault(doc["segment"], []).append(np.fromiter(positions.values(), dtype="int64"))
+        return {segment_id: np.unique(np.concatenate(arrays)) for segment_id, arrays in parts.items()}
+
+    @staticmethod
+    def _search_segment(store, removed: set, queries, k: int, positions=None) -> list:
+        """
+        在一个分段上检索，返回每个查询的 [(距离, 分块ID)]，最多k个，已过滤已删除分块
+
+        Args:
+            positions: 只在这些向量位置中检索，缺省检索整个分段
+        """
+        size = store.index.ntotal if positions is None else len(positions)
+        # 多取已删除分块的数量，保证过滤后仍有k个有效结果
+        fetch_k = min(k + len(removed), size)
+        if fetch_k <= 0:
+            return [[] for _ in range(len(queries))]
+        params = None if positions is None else restricted_search_params(store.index, positions)
+        if store.full_vectors is not None:
+            # 压缩索引多取候选，再按全精度向量的精确距离取前 fetch_k 个
+            search_k = min(fetch_k * settings.RESCORE_FACTOR, size)
+            _, found = store.index.search(queries, search_k, params=params)
+            distances, found = rescore(queries, found, store.full_vectors, fetch_k)
+        else:
+            distances, found = store.index.search(queries, fetch_k, params=params)
+        # 一次查询取回本分段所有命中位置的分块ID
+        chunk_ids = store.docstore.ids_at(set(found[found >= 0].tolist()))
+        results = []
+        for row in range(len(queries)):
+            hits = []
+            for distance, position in zip(distances[row], found[row]):
+                if position < 0 or len(hits) >= k:
+                    break
+                chunk_id = chunk_ids[int(position)]
+                if chunk_id not in removed:
+                    hits.append((float(distance), chunk_id))
+            results.append(hits)
+        return results
+
+    @metrics.timed("index_search")
+    def _dense_candidates(self, vectors, k: int, scope: dict = None) -> list:
+        """
+        向量检索，返回每个查询的 [(距离, 分段ID, 分块ID)]，按距离升序
+
+        各分段作为分片提交到检索线程池并行搜索，再合并各分段的 top-k。
+
+        Args:
+            scope: 分段ID -> 允许命中的向量位置，只检索其中的分段；缺省检索全部分段
+        """
+        segments, deleted = self._view
+        queries = np.asarray(vectors, dtype="float32")
+        if scope is None:
+            tasks = [(segment_id, store, None) for segment_id, store in segments.items()]
+        else:
+            tasks = [
+                (segment_id, segments[segment_id], positions)
+                for segment_id, positions in scope.items() if segment_id in segments
+            ]
+        candidates = [[] for _ in range(len(queries))]
+        if not tasks:
+            return candidates
+        pool = self._get_search_pool()
+        futures = [
+            (segment_id, pool.submit(self._search_segment, store, deleted[segment_id], queries, k, positions))
+            for segment_id, store, positions in tasks
+        ]
+        for segment_id, future in futures:
+            for row, hits in enumerate(future.result()):
+                candidates[row].extend((distance, segment_id, chunk_id) for distance, chunk_id in hits)
+        for row in candidates:
+            row.sort(key=lambda item: item[0])
+            del row[k:]
+        return candidates
+
+    @metrics.timed("chunk_fetch")
+    def _fetch_documents(self, keys) -> dict:
+        """按 (分段ID, 分块ID) 批量读取分块，只读取最终命中的分块文本"""
+        segments = self._view[0]
+        selected = {}
+        for segment_id, chunk_id in keys:
+            selected.setdefault(segment_id, []).append(chunk_id)
+        documents = {}
+        for segment_id, chunk_ids in selected.items():
+            for chunk_id, doc in segments[segment_id].docstore.mget(chunk_ids).items():
+                documents[(segment_id, chunk_id)] = doc
+        if self.near_dup is not None and documents:
+            # 代表分块附上所有与之重复的页面
+            references = self.near_dup.references({chunk_id for _, chunk_id in documents})
+            for (_, chunk_id), doc in documents.items():
+                if chunk_id in references:
+                    doc.metadata["duplicates"] = references[chunk_id]
+        return documents
+
+    def search_by_vectors(self, vectors, k: int, doc_ids=None) -> list:
+        """
+        批量向量检索
+
+        Args:
+            vectors: 查询向量矩阵 (n, dim)
+            k: 每个查询返回的结果数
+            doc_ids: 只在这些文档中检索，缺省检索全部文档
+
+        Returns:
+            list: 每个查询一个 [(Document, 距离)] 列表，按距离升序
+        """
+        self._maybe_refresh()
+        scope = None if doc_ids is None else self._search_scope(doc_ids)
+        candidates = self._dense_candidates(vectors, k, scope)
+        documents = self._fetch_documents(
+            (segment_id, chunk_id) for row in candidates for _, segment_id, chunk_id in row
+        )
+        return [
+            [(documents[(segment_id, chunk_id)], distance) for distance, segment_id, chunk_id in row]
+            for row in candidates
+        ]
+
+    @metrics.timed("lexical_search")
+    def lexical_search(self, query: str, k: int, scope: dict = None) -> list:
+        """BM25检索，返回 [(得分, 分段ID, 分块ID)]；scope 同 _dense_candidates"""
+        started = time.perf_counter()
+        results = self.lexical.search(query, k, self._view[1], scope)
+        logger.debug(f"BM25检索耗时 {(time.perf_counter() - started) * 1000:.3f} ms")
+        return results
+
+    def retrieve(self, query: str, k: int, vector=None, doc_ids=None) -> list:
+        """
+        检索与问题最相关的分块
+
+        开启 HYBRID_SEARCH_ENABLED 时，向量检索与BM25检索各取 k*HYBRID_FETCH_FACTOR 个候选，
+        用倒数排名融合(RRF)合并，能命中型号、条款号、错误码等精确标识符。
+
+        Args:
+            query: 问题文本
+            k: 返回结果数
+            vector: 问题向量，缺省时现算
+            doc_ids: 只在这些文档中检索，缺省检索全部文档
+        """
+        if vector is None:
+            vector = self._embedding.embed_query(query)
+        return self.retrieve_batch([query], k, [vector], doc_ids)[0]
+
+    def retrieve_batch(self, queries: list, k: int, vectors, doc_ids=None) -> list:
+        """
+        批量检索，所有查询的向量检索合并为每个分段一次 index.search
+
+        Args:
+            queries: 问题文本列表
+            k: 每个问题返回的结果数
+            vectors: 与问题一一对应的向量
+            doc_ids: 只在这些文档中检索，缺省检索全部文档
+
+        Returns:
+            list: 每个问题一个分块列表
+        """
+        self._maybe_refresh()
+        if not settings.HYBRID_SEARCH_ENABLED:
+            return [[doc for doc, _ in row] for row in self.search_by_vectors(vectors, k, doc_ids)]
+
+        scope = None if doc_ids is None else self._search_scope(doc_ids)
+        fetch_k = k * settings.HYBRID_FETCH_FACTOR
+        dense = self._dense_candidates(vectors, fetch_k, scope)
+        fused = []
+        for query, candidates in zip(queries, dense):
+            lexical = self.lexical_search(query, fetch_k, scope)
+            fused.append(reciprocal_rank_fusion(
+                [
+                    [(segment_id, chunk_id) for _, segment_id, chunk_id in candidates],
+                    [(segment_id, chunk_id) for _, segment_id, chunk_id in lexical],
+                ],
+                k,
+                settings.RRF_K
+            ))
+        documents = self._fetch_documents(key for row in fused for key, _ in row)
+        return [[documents[key] for key, _ in row] for row in fused]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, **kwargs):
+        return self.search_by_vectors([embedding], k)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs):
+        embedding = self._embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs):
+        # 检索器(as_retriever)走这里，按配置使用混合检索
+        return self.retrieve(query, k)
+
+    def _select_relevance_score_fn(self):
+        # 分段索引使用L2距离
+        return self._euclidean_relevance_score_fn
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        """按langchain接口写入文本，整批文本作为一个文档"""
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        doc_id = hashlib.sha256("\x00".join(texts).encode("utf-8")).hexdigest()
+        documents = [Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)]
+        self.add_document(doc_id, kwargs.get("source", doc_id), documents)
+        return self.manifest.documents.get(doc_id, {}).get("chunk_ids", [])
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        store = cls(kwargs.pop("db_path", settings.VECTOR_DB_PATH), embedding)
+        store.load()
+        store.add_texts(texts, metadatas, **kwargs)
+        return store
+
+
+class SegmentBuilder:
+    """
+    分段构建器
+
+    分块和向量可以分批追加，每批到达时即写入构建目录：向量追加到 vectors.npy，分块写入SQLite分块存储，
+    内存中只保留分块ID。提交时从内存映射的向量文件构建检索索引，入库大文档时内存占用不随文档增长。
+    追加、结束和丢弃在同一把锁下执行：取消入库时工作线程中正在执行的追加完成后才会删除构建目录。
+    """
+
+    def __init__(self, directory: str, doc_id: str = None):
+        """
+        Args:
+            directory: 构建目录的父目录，与分段目录位于同一文件系统，提交时直接改名移入分段
+            doc_id: 文档ID，追加时未指定分块ID则按它生成
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.doc_id = doc_id
+        self.path = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=directory)
+        self.ids = []
+        self.dim = None
+        self._vectors = None
+        self._header_size = 0
+        self._docstore = SQLiteDocstoreWriter(os.path.join(self.path, SQLiteDocstore.FILE_NAME))
+        self._lock = threading.Lock()
+        self._discarded = False
+
+    def _vector_header(self) -> bytes:
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(
+            header, {"descr": "<f4", "fortran_order": False, "shape": (len(self.ids), self.dim)}
+        )
+        return header.getvalue()
+
+    @metrics.timed("index_add")
+    def add(self, texts: list, vectors, metadatas: list, ids: list = None):
+        """追加一批分块及其向量"""
+        if not texts:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        with self._lock:
+            if self._discarded:
+                raise RuntimeError("分段构建器已丢弃")
+            if self._vectors is None:
+                self.dim = vectors.shape[1]
+                self._vectors = open(os.path.join(self.path, "vectors.npy"), "wb")
+                # 先写入0行的文件头占位，结束时按实际行数改写；两者长度相同（按64字节对齐）
+                header = self._vector_header()
+                self._header_size = len(header)
+                self._vectors.write(header)
+            if ids is None:
+                start = len(self.ids)
+                ids = [make_chunk_id(self.doc_id, start + i) for i in range(len(texts))]
+            self._vectors.write(vectors.tobytes())
+            self._docstore.append(ids, texts, metadatas)
+            self.ids.extend(ids)
+
+    def finish(self, target: str):
+        """
+        结束追加，把向量文件和分块存储移入 target 目录
+
+        Returns:
+            np.ndarray: 以只读内存映射方式打开的全部向量
+        """
+        with self._lock:
+            if self._discarded:
+                raise RuntimeError("分段构建器已丢弃")
+            header = self._vector_header()
+            if len(header) != self._header_size:
+                raise RuntimeError(f"向量文件头长度变化: {self._header_size} -> {len(header)}")
+            self._vectors.seek(0)
+            self._vectors.write(header)
+            self._vectors.close()
+            self._docstore.close()
+            os.makedirs(target, exist_ok=True)
+            vectors_path = os.path.join(target, "vectors.npy")
+            os.replace(os.path.join(self.path, "vectors.npy"), vectors_path)
+            os.replace(self._docstore.path, os.path.join(target, SQLiteDocstore.FILE_NAME))
+        return np.load(vectors_path, mmap_mode="r")
+
+    def discard(self):
+        """
+        删除构建目录；提交后或放弃写入时调用，可重复调用
+
+        正在其他线程中执行的追加完成后才删除，之后的追加抛出 RuntimeError。
+        """
+        with self._lock:
+            self._discarded = True
+            if self._vectors is not None and not self._vectors.closed:
+                self._vectors.close()
+            if os.path.exists(self._docstore.tmp_path):
+                self._docstore.discard()
+            shutil.rmtree(self.path, ignore_errors=True)
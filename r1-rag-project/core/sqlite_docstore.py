@@ -0,0 +1,184 @@
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+from collections.abc import Mapping
+import sqlite3
+import threading
+import json
+import os
+
+
+class SQLiteDocstore(Docstore):
+    """
+    基于SQLite的只读分块存储
+
+    替代整体反序列化的 index.pkl：分块文本和元数据按向量位置存放在磁盘上，
+    检索时只读取 top-k 命中的分块。多个进程打开同一文件时共享操作系统页缓存。
+    分段写入后不再修改，因此不提供 add/delete：删除的分块记录在索引清单中，由分段合并回收。
+    """
+
+    FILE_NAME = "chunks.sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        # 每个线程使用独立的只读连接
+        self._local = threading.local()
+
+    @classmethod
+    def create(cls, path: str, ids: list, documents: dict):
+        """
+        按向量位置顺序写入分块，生成只读存储
+
+        Args:
+            path: 数据库文件路径
+            ids: 按向量位置排列的分块ID
+            documents: 分块ID -> Document
+        """
+        writer = SQLiteDocstoreWriter(path)
+        writer.append(
+            ids,
+            [documents[chunk_id].page_content for chunk_id in ids],
+            [documents[chunk_id].metadata for chunk_id in ids]
+        )
+        writer.close()
+        return cls(path)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_document(chunk_id, text, metadata):
+        return Document(id=chunk_id, page_content=text, metadata=json.loads(metadata))
+
+    def search(self, search: str):
+        """按分块ID读取分块，与InMemoryDocstore一致，找不到时返回提示字符串"""
+        row = self._conn().execute(
+            "SELECT id, text, metadata FROM chunks WHERE id = ?", (search,)
+        ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return self._to_document(*row)
+
+    def mget(self, ids: list) -> dict:
+        """批量读取分块，返回 {分块ID: Document}"""
+        found = {}
+        for start in range(0, len(ids), 500):
+            batch = list(ids[start:start + 500])
+            placeholders = ",".join("?" * len(batch))
+            for row in self._conn().execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", batch
+            ):
+                found[row[0]] = self._to_document(*row)
+        return found
+
+    def ids_at(self, positions) -> dict:
+        """批量查询向量位置对应的分块ID，返回 {位置: 分块ID}"""
+        positions = [int(position) for position in positions]
+        found = {}
+        for start in range(0, len(positions), 500):
+            batch = positions[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            found.update(self._conn().execute(
+                f"SELECT position, id FROM chunks WHERE position IN ({placeholders})", batch
+            ))
+        return found
+
+    def positions_of(self, ids) -> dict:
+        """批量查询分块ID对应的向量位置，返回 {分块ID: 位置}"""
+        ids = list(ids)
+        found = {}
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            found.update(self._conn().execute(
+                f"SELECT id, position FROM chunks WHERE id IN ({placeholders})", batch
+            ))
+        return found
+
+    def iter_ids(self):
+        """按位置顺序遍历 (位置, 分块ID)"""
+        yield from self._conn().execute("SELECT position, id FROM chunks ORDER BY position")
+
+    def iter_texts(self):
+        """按位置顺序遍历 (分块ID, 文本)"""
+        yield from self._conn().execute("SELECT id, text FROM chunks ORDER BY position")
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+class SQLiteDocstoreWriter:
+    """
+    分批写入分块存储
+
+    分块按向量位置顺序追加，每批写入后即提交，内存中不保留分块；
+    close 后文件才出现在目标路径，之后以 SQLiteDocstore 只读打开。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        # 追加可能来自不同的工作线程，但不会并发
+        self._conn = sqlite3.connect(self.tmp_path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE chunks (
+                position INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            )"""
+        )
+        self.count = 0
+
+    def append(self, ids: list, texts: list, metadatas: list):
+        """追加一批分块，位置接在已写入的分块之后"""
+        start = self.count
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO chunks (position, id, text, metadata) VALUES (?, ?, ?, ?)",
+                (
+                    (start + offset, chunk_id, text, json.dumps(metadata, ensure_ascii=False, default=str))
+                    for offset, (chunk_id, text, metadata) in enumerate(zip(ids, texts, metadatas))
+                ),
+            )
+        self.count += len(ids)
+
+    def close(self) -> str:
+        """结束写入，把文件移到目标路径"""
+        self._conn.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def discard(self):
+        """放弃写入，删除临时文件"""
+        self._conn.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class PositionIdMap(Mapping):
+    """向量位置 -> 分块ID 的惰性映射，替代常驻内存的 index_to_docstore_id 字典"""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, position):
+        found = self.docstore.ids_at([position])
+        if int(position) not in found:
+            raise KeyError(position)
+        return found[int(position)]
+
+    def __iter__(self):
+        for position, _ in self.docstore.iter_ids():
+            yield position
+
+    def __len__(self):
+        return self.docstore.count()
+
+    def items(self):
+        return self.docstore.iter_ids()
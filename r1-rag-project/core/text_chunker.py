@@ -0,0 +1,131 @@
+from langchain_core.documents import Document
+from utils.token_counter import get_token_counter
+from config.config import settings
+from bisect import bisect_left, bisect_right
+import re
+
+# 句末标点（含全角标点及其后的引号、括号）、英文句点后接空白、空行，均视为句子边界；
+# 以单个字符类开头，正则引擎可以快速跳过不可能匹配的位置，比多个分支的写法快约一倍
+_SENTENCE_END_RE = re.compile(
+    r"[。！？!?；;….\n]"
+    r"(?:(?<=[。！？!?；;…])[。！？!?；;…]*[”’」』）)\]]*|(?<=\.)(?=\s)|(?<=\n)(?=[^\S\n]*\n))"
+    r"\s*"
+)
+# 超出预算的长句再按逗号、顿号、冒号和换行细分
+_CLAUSE_END_RE = re.compile(r"[，,、：:]\s*|\n")
+
+
+def _boundaries(pattern, text: str, start: int, end: int) -> list:
+    """按 pattern 切分 text[start:end]，返回递增的边界位置 [start, ..., end]，只记录位置"""
+    boundaries = [start]
+    boundaries.extend(match.end() for match in pattern.finditer(text, start, end))
+    if boundaries[-1] < end:
+        boundaries.append(end)
+    return boundaries
+
+
+class TokenTextChunker:
+    """
+    按token预算分块的单遍分割器
+
+    可直接替换 RecursiveCharacterTextSplitter（提供 split_documents / split_text）：
+    - 在页面原文上一次扫描出句子边界（包括中文句末标点），全程只记录区间位置，
+      每个分块只在输出时切片一次，不做逐段的字符串拼接和反复重切
+    - 按 CHUNK_TOKENS 把连续的句子装入分块，相邻分块重叠约 CHUNK_OVERLAP_TOKENS 个token的完整句子
+    - 单句超出预算时按逗号、换行细分，仍超出时按字符窗口切开
+    - 分块保留页面元数据，并记录 start_index，组装上下文时据此合并相邻分块
+
+    token数由 CONTEXT_TOKENIZER 的分词器统计，无法加载时按字符估算（中文每字约一个token）。
+    """
+
+    def __init__(self, chunk_tokens: int = None, overlap_tokens: int = None, token_counter=None):
+        self.chunk_tokens = chunk_tokens or settings.CHUNK_TOKENS
+        self.overlap_tokens = min(
+            settings.CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens,
+            self.chunk_tokens // 2
+        )
+        self.token_counter = token_counter or get_token_counter()
+
+    def _units(self, text: str) -> tuple:
+        """把页面切分为不超过预算的最小单元，返回 (边界位置列表, 各单元token数列表)"""
+        boundaries = _boundaries(_SENTENCE_END_RE, text, 0, len(text))
+        counts = self.token_counter.count_segments(text, boundaries)
+        if not len(counts) or counts.max() <= self.chunk_tokens:
+            return boundaries, counts.tolist()
+
+        # 少数超长句子再细分
+        units, unit_counts = [0], []
+        for start, end, tokens in zip(boundaries[:-1], boundaries[1:], counts.tolist()):
+            if tokens <= self.chunk_tokens:
+                units.append(end)
+                unit_counts.append(tokens)
+                continue
+            clauses = _boundaries(_CLAUSE_END_RE, text, start, end)
+            for clause_start, clause_end, clause_tokens in zip(
+                clauses[:-1], clauses[1:], self.token_counter.count_segments(text, clauses).tolist()
+            ):
+                if clause_tokens <= self.chunk_tokens:
+                    units.append(clause_end)
+                    unit_counts.append(clause_tokens)
+                    continue
+                # 没有可用的断点：按字符窗口切开，窗口字符数取token预算（中文约每字一个token）
+                windows = list(range(clause_start, clause_end, self.chunk_tokens)) + [clause_end]
+                units.extend(windows[1:])
+                unit_counts.extend(self.token_counter.count_segments(text, windows).tolist())
+        return units, unit_counts
+
+    def _chunk_spans(self, text: str) -> list:
+        """
+        把单元依次装入分块，返回分块的 [(起始, 结束)]
+
+        在单元token数的前缀和上二分查找每个分块的结束单元和下一个分块的重叠起点，
+        循环次数与分块数成正比，而不是与句子数成正比。
+        """
+        boundaries, counts = self._units(text)
+        count = len(counts)
+        # 单次查找用列表上的 bisect，比 numpy 标量调用的开销小
+        prefix = [0]
+        for tokens in counts:
+            prefix.append(prefix[-1] + tokens)
+        spans = []
+        first = 0
+        while first < count:
+            # 单元 [first, last) 的token数不超过预算，且至少包含一个单元
+            last = max(first + 1, bisect_right(prefix, prefix[first] + self.chunk_tokens) - 1)
+            spans.append((boundaries[first], boundaries[last]))
+            if last >= count:
+                break
+            # 下一个分块从末尾若干个完整单元开始，重叠部分不超过 overlap_tokens，且至少前进一个单元
+            overlap_first = bisect_left(prefix, prefix[last] - self.overlap_tokens)
+            first = min(last, max(first + 1, overlap_first))
+        return spans
+
+    @staticmethod
+    def _strip(text: str, start: int, end: int) -> tuple:
+        """去掉区间首尾的空白，只移动位置"""
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return start, end
+
+    def _iter_spans(self, text: str):
+        for start, end in self._chunk_spans(text):
+            start, end = self._strip(text, start, end)
+            if start < end:
+                yield start, end
+
+    def split_text(self, text: str) -> list:
+        return [text[start:end] for start, end in self._iter_spans(text)]
+
+    def split_documents(self, documents: list) -> list:
+        """分割页面文档，每个分块复制页面元数据并记录在页面中的起始位置"""
+        chunks = []
+        for document in documents:
+            text = document.page_content
+            for start, end in self._iter_spans(text):
+                chunks.append(Document(
+                    page_content=text[start:end],
+                    metadata={**document.metadata, "start_index": start}
+                ))
+        return chunks
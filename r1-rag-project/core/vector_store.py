@@ -1,12 +1,16 @@
-from langchain_ollama import OllamaEmbeddings
-# FAISS用于存储和检索向量
-from langchain_community.vectorstores import FAISS
+from core.ollama_client import PooledOllamaEmbeddings
 # BaseRetriever是检索器的基类,提供了检索文档的基本接口
 from langchain.schema import BaseRetriever
+from core.embedding_cache import EmbeddingCache, CachedEmbeddings
+# 分段式FAISS向量存储，支持增量写入和删除
+from core.segmented_store import SegmentedVectorStore, file_hash
+from core.ann_index import VECTOR_STORAGE_TYPES
 from config.config import settings
 from utils.logger import logger
+from utils.metrics import metrics
 import os
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 # BaseModel用于数据验证,Field用于字段定义
 from pydantic import BaseModel, Field
 from typing import Any
@@ -47,70 +51,107 @@ class VectorStore:
     def __init__(self):
         """初始化向量存储类"""
         try:
-            self.embeddings = OllamaEmbeddings(
-                model=settings.EMBED_MODEL
-            )
+            # 使用共享连接池的embedding模型，异步接口不占用线程
+            self.embeddings = PooledOllamaEmbeddings(settings.EMBED_MODEL)
             logger.info(f"已加载embedding模型: {settings.EMBED_MODEL}")
+            if settings.EMBED_CACHE_ENABLED:
+                # 在模型前加一层持久化缓存，重复的分块不再重新计算向量
+                self.embedding_cache = EmbeddingCache(
+                    settings.EMBED_CACHE_PATH,
+                    settings.EMBED_MODEL,
+                    settings.EMBED_CACHE_MAX_ENTRIES
+                )
+                self.embeddings = CachedEmbeddings(
+                    self.embeddings,
+                    self.embedding_cache,
+                    settings.EMBED_BATCH_SIZE
+                )
+                logger.info(f"已启用embedding缓存: {settings.EMBED_CACHE_PATH}")
+
+            # 索引中的向量可按fp16/int8压缩保存，检索候选再用磁盘上的全精度向量重排
+            if settings.VECTOR_STORAGE.lower() not in VECTOR_STORAGE_TYPES:
+                raise ValueError(f"不支持的向量存储精度: {settings.VECTOR_STORAGE}")
+            logger.info(f"向量存储精度: {settings.VECTOR_STORAGE}，压缩索引重排倍数: {settings.RESCORE_FACTOR}")
+
+            # 分段式向量存储，新增文档只写入新分段
+            self.store = SegmentedVectorStore(settings.VECTOR_DB_PATH, self.embeddings)
+            # 单线程执行器，用于后台合并小分段
+            self.merge_executor = ThreadPoolExecutor(max_workers=1)
+            self._register_metrics()
         except Exception as e:
             logger.error(f"加载embedding模型失败: {str(e)}")
             raise
-            
-    async def get_vectorstore(self, documents):
-        """创建或获取向量存储"""
+
+    def _register_metrics(self):
+        """索引大小等指标在抓取时计算"""
+        manifest = lambda: self.store.manifest
+        metrics.gauge("rag_index_vectors", "索引中有效的分块数").set_function(
+            lambda: sum(manifest().live_vectors(segment_id) for segment_id in manifest().segments)
+        )
+        metrics.gauge("rag_index_segments", "索引分段数").set_function(lambda: len(manifest().segments))
+        metrics.gauge("rag_index_documents", "已索引的文档数").set_function(lambda: len(manifest().documents))
+        metrics.gauge("rag_corpus_version", "语料版本").set_function(lambda: self.store.corpus_version)
+
+    async def get_vectorstore(self, documents, pdf_path: str = None):
+        """
+        把文档分块增量写入向量存储，并返回检索器
+
+        Args:
+            documents: 文档分块
+            pdf_path: 源文件路径，缺省时取分块元数据中的source
+        """
         try:
-            # 确保向量存储目录存在
-            os.makedirs(settings.VECTOR_DB_PATH, exist_ok=True)
-            
-            index_path = os.path.join(settings.VECTOR_DB_PATH, "index.faiss")
-
-            if os.path.exists(index_path):
-                try:
-                    # 如果存在，则加载现有的向量存储
-                    vectorstore = FAISS.load_local(
-                        settings.VECTOR_DB_PATH,
-                        self.embeddings
-                    )
-                    logger.info("已加载现有的向量存储")
-                except Exception as e:
-                    logger.warning(f"加载现有向量存储失败，将创建新的向量存储: {str(e)}")
-                    vectorstore = await self._create_vectorstore(documents)
-            else:
-                vectorstore = await self._create_vectorstore(documents)
-
-            # 创建基础检索器，用于从向量数据库中检索最相似的文档
-            # k : 表示检索时返回的最相似文档数量
-            base_retriever = vectorstore.as_retriever(
-                search_kwargs={"k": 2}
-            )
-            
-            # 包装为异步检索器，提高系统的并发处理能力
-            return AsyncVectorStoreRetriever(base_retriever)
+            # 首次调用时加载清单和已有分段
+            await asyncio.to_thread(self.store.load)
+
+            if documents:
+                pdf_path = pdf_path or documents[0].metadata.get("source")
+                # 以文件内容哈希作为文档ID，重复上传同一文件不会重复写入
+                doc_id = await asyncio.to_thread(file_hash, pdf_path)
+                # 向量化走异步接口和 embed 限流器，不在工作线程中阻塞等待
+                await self.store.aadd_document(doc_id, os.path.basename(pdf_path), documents)
+                self.schedule_compaction()
+
+            return await self.get_retriever()
 
         except Exception as e:
             logger.error(f"向量存储错误: {str(e)}", exc_info=True)
             raise
 
-    async def _create_vectorstore(self, documents):
-        """创建新的向量存储"""
+    async def get_retriever(self):
+        """获取基于当前向量存储的检索器"""
+        await asyncio.to_thread(self.store.load)
+
+        # 创建基础检索器，用于从向量数据库中检索最相似的文档
+        # k : 表示检索时返回的最相似文档数量
+        base_retriever = self.store.as_retriever(
+            search_kwargs={"k": settings.RETRIEVAL_K}
+        )
+        
+        # 包装为异步检索器，提高系统的并发处理能力
+        return AsyncVectorStoreRetriever(base_retriever)
+
+    async def delete_document(self, source: str) -> bool:
+        """按文件名或文档ID删除已索引的文档"""
         try:
-            # 创建向量存储
-            # 将同步操作转换为异步操作，避免阻塞事件循环
-            """代码逻辑：
-            (1) 使用embeddings模型将文档文本转换为向量;
-            (2) 创建FAISS索引存储这些向量;
-            (3) 建立文档内容和向量之间的映射;
-            """
-            vectorstore = await asyncio.to_thread(
-                FAISS.from_documents,
-                documents,
-                self.embeddings
-            )
-            
-            # 保存向量存储
-            vectorstore.save_local(settings.VECTOR_DB_PATH)
-            logger.info("已创建并保存新的向量存储")
-            return vectorstore
-            
+            await asyncio.to_thread(self.store.load)
+            doc_id = source if self.store.has_document(source) else self.store.manifest.find_by_source(source)
+            if doc_id is None:
+                return False
+            deleted = await asyncio.to_thread(self.store.delete_document, doc_id)
+            self.schedule_compaction()
+            return deleted
         except Exception as e:
-            logger.error(f"创建向量存储失败: {str(e)}", exc_info=True)
-            raise 
\ No newline at end of file
+            logger.error(f"删除文档失败: {str(e)}", exc_info=True)
+            raise
+
+    def schedule_compaction(self):
+        """在后台线程中合并小分段，不阻塞上传请求"""
+        if self.store.needs_compaction():
+            future = self.merge_executor.submit(self.store.compact)
+            future.add_done_callback(self._log_compaction_error)
+
+    @staticmethod
+    def _log_compaction_error(future):
+        if future.exception() is not None:
+            logger.error(f"分段合并失败: {str(future.exception())}")
@@ -0,0 +1,229 @@
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager, aclosing
+from fronted.chat_interface import ChatInterface, REQUESTS_IN_FLIGHT
+from core.llm_service import GenerationFailed
+from config.config import settings
+from utils.logger import logger
+from utils.metrics import metrics
+from utils.startup import StartupTracker
+import asyncio
+import shutil
+import json
+import time
+import uuid
+import os
+
+
+class RetrieveRequest(BaseModel):
+    question: str = Field(..., min_length=1, description="问题")
+    k: int = Field(None, ge=1, le=100, description="返回的分块数，缺省为RETRIEVAL_K")
+    doc_ids: list[str] = Field(None, max_length=1000, description="只在这些文档(入库任务ID)中检索，缺省检索全部文档")
+
+
+class AnswerRequest(BaseModel):
+    question: str = Field(..., min_length=1, description="问题")
+    history: list[tuple[str, str]] = Field(default_factory=list, description="历史对话 [(问题, 回答)]")
+    use_documents: bool = Field(True, description="是否检索文档作为上下文")
+    use_cache: bool = Field(True, description="是否使用答案缓存")
+    stream: bool = Field(False, description="是否以NDJSON流式返回")
+    session_id: str = Field(None, max_length=128, description="会话ID，生成请求按会话轮流排队，缺省按客户端地址")
+    deadline: float = Field(None, ge=0, description="等待生成的最长秒数，缺省为LLM_QUEUE_DEADLINE，0表示不限")
+
+
+class BatchAnswerRequest(BaseModel):
+    questions: list[str] = Field(..., min_length=1, max_length=settings.API_MAX_BATCH, description="问题列表")
+    use_documents: bool = Field(True, description="是否检索文档作为上下文")
+    use_cache: bool = Field(True, description="是否使用答案缓存")
+    session_id: str = Field(None, max_length=128, description="会话ID，整批问题作为一个会话排队，缺省按客户端地址")
+    deadline: float = Field(None, ge=0, description="等待生成的最长秒数，缺省为LLM_QUEUE_DEADLINE，0表示不限")
+
+
+def _document_dict(doc) -> dict:
+    return {"content": doc.page_content, "metadata": doc.metadata}
+
+
+def _session_id(request: Request, session_id: str) -> str:
+    """请求的调度会话：优先使用请求中的会话ID，否则按客户端地址"""
+    if session_id:
+        return session_id
+    return f"api:{request.client.host}" if request.client else "api"
+
+
+async def _collect_answer(chat: ChatInterface, question: str, history: list, use_documents: bool, use_cache: bool,
+                          session: str = None, deadline: float = None) -> dict:
+    """生成完整回答；检索或生成失败、等待超过期限时 error 为 true，answer 为失败提示"""
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    failed = False
+    try:
+        answer = ""
+        async for answer in chat.answer(
+            question, history, use_documents, use_cache=use_cache, session=session, deadline=deadline
+        ):
+            pass
+    except GenerationFailed as e:
+        answer, failed = str(e), True
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        metrics.observe_stage("request", time.perf_counter() - started)
+    return {
+        "question": question,
+        "answer": answer,
+        "error": failed,
+        "elapsed": round(time.perf_counter() - started, 3),
+    }
+
+
+async def _stream_answer(chat: ChatInterface, request: AnswerRequest, session: str):
+    """
+    以NDJSON逐行输出新增的回答片段，最后一行为完整回答
+
+    生成中途失败时，最后一行的 error 为 true、answer 为失败提示，客户端应丢弃此前收到的片段。
+    客户端断开时响应生成器被关闭，关闭随之传到生成阶段，Ollama停止生成。
+    """
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    failed = False
+    try:
+        answer = ""
+        try:
+            async with aclosing(chat.answer(
+                request.question, request.history, request.use_documents, use_cache=request.use_cache,
+                session=session, deadline=request.deadline
+            )) as answers:
+                async for answer_so_far in answers:
+                    delta = answer_so_far[len(answer):] if answer_so_far.startswith(answer) else answer_so_far
+                    answer = answer_so_far
+                    if delta:
+                        yield json.dumps({"delta": delta}, ensure_ascii=False) + "\n"
+        except GenerationFailed as e:
+            answer, failed = str(e), True
+        yield json.dumps({
+            "done": True,
+            "answer": answer,
+            "error": failed,
+            "elapsed": round(time.perf_counter() - started, 3),
+        }, ensure_ascii=False) + "\n"
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        metrics.observe_stage("request", time.perf_counter() - started)
+
+
+def create_app() -> FastAPI:
+    """
+    创建无界面的HTTP API
+
+    每个工作进程各自创建一个 ChatInterface，共享同一个向量库目录：
+    任一进程入库后，其他进程在下一次检索前发现清单变化并加载新分段。
+    接口不经过Gradio的事件队列，并发由各进程的自适应限流器控制。
+    """
+    startup = StartupTracker()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if settings.STARTUP_WARMUP_ENABLED:
+            from core.ollama_client import warm_up_models
+            with startup.phase("model_warmup"):
+                await warm_up_models()
+        with startup.phase("init"):
+            app.state.chat = ChatInterface()
+        with startup.phase("index_preload"):
+            await app.state.chat.preload()
+        startup.mark_ready()
+        yield
+
+    app = FastAPI(title="RAG 智能问答 API", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/ready")
+    async def ready():
+        if not startup.is_ready():
+            raise HTTPException(503, "starting")
+        return {"status": "ready", "pid": os.getpid(), "corpus_version": app.state.chat.vector_store.store.corpus_version}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def prometheus_metrics():
+        # 每个工作进程各自统计，抓取到的是处理本次请求的进程的指标
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.post("/v1/ingest", status_code=202)
+    async def ingest(file: UploadFile = File(...)):
+        """上传PDF并登记后台入库任务，立即返回任务信息"""
+        if not (file.filename or "").lower().endswith(".pdf"):
+            raise HTTPException(400, "只支持PDF文件")
+        # 保留原文件名，索引中的来源名称与界面上传一致
+        upload_dir = os.path.join(settings.API_UPLOAD_DIR, uuid.uuid4().hex)
+        os.makedirs(upload_dir, exist_ok=True)
+        path = os.path.join(upload_dir, os.path.basename(file.filename))
+        with open(path, "wb") as f:
+            await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+
+        job = await app.state.chat.ingest_jobs.submit(path)
+        if job.task is not None and job.pdf_path == path:
+            job.task.add_done_callback(lambda _: shutil.rmtree(upload_dir, ignore_errors=True))
+        else:
+            # 复用了已有任务或索引，上传的副本不再需要
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        return job.as_dict()
+
+    @app.get("/v1/ingest/{job_id}")
+    async def ingest_status(job_id: str):
+        """查询入库任务，任务可以由任一工作进程执行；任务记录已清理时按索引中是否已有该文档返回"""
+        chat = app.state.chat
+        job = await asyncio.to_thread(chat.ingest_jobs.get, job_id)
+        if job is not None:
+            return job.as_dict()
+        store = chat.vector_store.store
+        await asyncio.to_thread(store.refresh)
+        if store.has_document(job_id):
+            return {"job_id": job_id, "status": "done", "source": store.manifest.documents[job_id]["source"]}
+        raise HTTPException(404, "任务不存在")
+
+    @app.delete("/v1/ingest/{job_id}")
+    async def cancel_ingest(job_id: str):
+        """取消入库任务；由其他工作进程执行的任务在其下一次心跳时取消"""
+        if not app.state.chat.ingest_jobs.cancel(job_id):
+            raise HTTPException(404, "任务不存在或已结束")
+        return {"job_id": job_id, "cancelled": True}
+
+    @app.post("/v1/retrieve")
+    async def retrieve(request: RetrieveRequest):
+        """检索与问题最相关的分块"""
+        docs = await app.state.chat.retrieve(request.question, request.k, request.doc_ids)
+        return {"question": request.question, "documents": [_document_dict(doc) for doc in docs]}
+
+    @app.post("/v1/answer")
+    async def answer(request: AnswerRequest, http_request: Request):
+        """问答；stream=true 时以NDJSON流式返回 {"delta": ...}，最后一行为 {"done": true, "answer": ...}"""
+        chat = app.state.chat
+        session = _session_id(http_request, request.session_id)
+        if request.stream:
+            return StreamingResponse(_stream_answer(chat, request, session), media_type="application/x-ndjson")
+        return await _collect_answer(
+            chat, request.question, request.history, request.use_documents, request.use_cache,
+            session, request.deadline
+        )
+
+    @app.post("/v1/answer/batch")
+    async def answer_batch(request: BatchAnswerRequest, http_request: Request):
+        """
+        批量问答，问题并发处理，向量化和检索由微批处理合并
+
+        整批问题属于同一个调度会话，与其他会话轮流获得生成并发，大批量请求不会挤占交互式提问。
+        """
+        chat = app.state.chat
+        session = _session_id(http_request, request.session_id)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            _collect_answer(chat, question, [], request.use_documents, request.use_cache, session, request.deadline)
+            for question in request.questions
+        ))
+        logger.info(f"批量问答完成: {len(results)} 个问题，耗时 {time.perf_counter() - started:.2f} 秒")
+        return {"answers": results, "elapsed": round(time.perf_counter() - started, 3)}
+
+    return app
@@ -1,24 +1,57 @@
-import gradio as gr
 from core.pdf_processor import PDFProcessor
 from core.vector_store import VectorStore
-from core.llm_service import LLMService
+from core.llm_service import LLMService, GenerationFailed, GENERATION_ERROR_MESSAGE, OVERLOADED_MESSAGE
+from core.answer_cache import AnswerCache
+from core.ingest_pipeline import IngestPipeline
+from core.ingest_jobs import IngestJobManager
+from core.context_builder import ContextBuilder
+from core.retrieval_batcher import RetrievalBatcher
+from config.config import settings
 from utils.logger import logger
+from utils.metrics import metrics
+from contextlib import aclosing
 import asyncio
+import time
+
+# 检索失败时返回给用户的提示
+RETRIEVAL_ERROR_MESSAGE = "抱歉，检索相关文档时出现错误，请稍后重试。"
+
+# 正在处理的问答请求数
+REQUESTS_IN_FLIGHT = metrics.gauge("rag_requests_in_flight", "正在处理的问答请求数")
 
 class ChatInterface:
     def __init__(self):
         self.pdf_processor = PDFProcessor()
         self.vector_store = VectorStore()
         self.llm_service = LLMService()
+        self.ingest_pipeline = IngestPipeline(self.pdf_processor, self.vector_store)
+        # 上传的文件在后台入库，上传请求立即返回
+        self.ingest_jobs = IngestJobManager(self.pdf_processor, self.vector_store, self.ingest_pipeline)
+        self.context_builder = ContextBuilder()
+        # 并发会话的问题向量化和检索合并为批量请求
+        self.retrieval_batcher = RetrievalBatcher(
+            self.vector_store.store,
+            self.vector_store.embeddings
+        ) if settings.RETRIEVAL_BATCH_ENABLED else None
+        # 语义答案缓存，相同或相近的问题直接返回已有答案
+        self.answer_cache = AnswerCache(
+            settings.ANSWER_CACHE_MAX_ENTRIES,
+            settings.ANSWER_CACHE_TTL,
+            settings.ANSWER_CACHE_SIMILARITY
+        ) if settings.ANSWER_CACHE_ENABLED else None
         
     async def create_interface(self):
         """创建Gradio界面"""
+        # 只有界面需要gradio，无界面的API进程不导入
+        import gradio as gr
+
         with gr.Blocks(css=self._get_css()) as demo:
             # 状态变量
             pdf_state = gr.State(None)
             text_splitter_state = gr.State(None)
             vectorstore_state = gr.State(None)
             retriever_state = gr.State(None)
+            job_state = gr.State(None)
             
             # 标题
             gr.Markdown("# 📚 RAG 智能问答系统-Demo", elem_classes="header")
@@ -30,6 +63,11 @@ class ChatInterface:
                     file_types=[".pdf"],
                     elem_classes="file-upload"
                 )
+                with gr.Row():
+                    job_status = gr.Markdown("")
+                    cancel_job = gr.Button("取消入库", variant="secondary", scale=0)
+                # 定时刷新后台入库进度
+                status_timer = gr.Timer(settings.INGEST_STATUS_INTERVAL)
             
             # 聊天区域
             with gr.Column(elem_classes="chat-container"):
@@ -58,108 +96,277 @@ class ChatInterface:
             file.upload(
                 self._process_file,
                 [file],
-                [pdf_state, text_splitter_state, vectorstore_state, retriever_state],
+                [pdf_state, text_splitter_state, vectorstore_state, retriever_state, job_state, job_status],
             )
+            status_timer.tick(self._job_status, [job_state], [job_status], queue=False)
+            cancel_job.click(self._cancel_job, [job_state], [job_status], queue=False)
             
+            # 以Gradio会话ID作为调度会话，生成请求按会话轮流排队
+            async def respond(message, history, pdf_path, text_splitter, vectorstore, retriever,
+                              request: gr.Request):
+                async with aclosing(self._respond(
+                    message, history, pdf_path, text_splitter, vectorstore, retriever, request.session_hash
+                )) as updates:
+                    async for update in updates:
+                        yield update
+
+            async def regenerate_answer(history, pdf_path, text_splitter, vectorstore, retriever,
+                                        request: gr.Request):
+                async with aclosing(self._regenerate(
+                    history, pdf_path, text_splitter, vectorstore, retriever, request.session_hash
+                )) as updates:
+                    async for update in updates:
+                        yield update
+
+            # 排队和并发由生成调度器控制，Gradio不再逐个串行处理提问
             # 发送消息-方式1 : 按回车键提交
-            msg.submit(
-                self._respond,
+            submit_event = msg.submit(
+                respond,
                 [msg, chatbot, pdf_state, text_splitter_state, vectorstore_state, retriever_state],
-                [msg, chatbot]
+                [msg, chatbot],
+                concurrency_limit=None
             )
             # 发送消息-方式2 : 点击发送按钮
-            send_btn.click(
-                self._respond,
+            click_event = send_btn.click(
+                respond,
                 [msg, chatbot, pdf_state, text_splitter_state, vectorstore_state, retriever_state],
-                [msg, chatbot]
+                [msg, chatbot],
+                concurrency_limit=None
             )
             
-            # 清空对话
-            clear.click(lambda: None, None, chatbot, queue=False)
-            
-            # 重新生成
-            regenerate.click(
-                self._regenerate,
+            # 重新生成：取消本会话中仍在进行的生成，只为新的回答占用Ollama
+            regenerate_event = regenerate.click(
+                regenerate_answer,
                 [chatbot, pdf_state, text_splitter_state, vectorstore_state, retriever_state],
-                [chatbot]
+                [chatbot],
+                cancels=[submit_event, click_event],
+                concurrency_limit=None
             )
+
+            # 清空对话，同时取消进行中的生成
+            clear.click(lambda: None, None, chatbot, queue=False, cancels=[submit_event, click_event, regenerate_event])
+
+            # 页面关闭时取消该会话排队中和生成中的请求
+            async def close_session(request: gr.Request):
+                self.llm_service.scheduler.cancel_session(request.session_hash)
+
+            demo.unload(close_session)
             
         return demo
     
     async def _process_file(self, file):
-        """处理上传的PDF文件"""
+        """处理上传的PDF文件：登记后台入库任务后立即返回"""
         try:
             if file is None:
-                return None, None, None, None
-                
-            # 处理PDF文件
-            chunks = await self.pdf_processor.process_pdf(file.name)
-            
-            # 创建向量存储和检索器
-            retriever = await self.vector_store.get_vectorstore(chunks)
-            
-            # 直接返回 retriever，不需要再次调用 as_retriever()
-            return file.name, self.pdf_processor.text_splitter, None, retriever
+                return None, None, None, None, None, ""
+
+            job = await self.ingest_jobs.submit(file.name)
+            # 检索器直接查询共享的向量存储，入库完成后即可检索到新文档
+            retriever = await self.vector_store.get_retriever()
+            return file.name, self.pdf_processor.text_splitter, None, retriever, job.job_id, job.describe()
         except Exception as e:
             logger.error(f"文件处理错误: {str(e)}")
             raise
+
+    def _job_status(self, job_id):
+        """当前会话入库任务的进度"""
+        job = self.ingest_jobs.get(job_id) if job_id else None
+        return job.describe() if job is not None else ""
+
+    def _cancel_job(self, job_id):
+        """取消当前会话的入库任务"""
+        if job_id and self.ingest_jobs.cancel(job_id):
+            logger.info(f"用户取消入库任务: {job_id}")
+        return self._job_status(job_id)
     
-    async def _respond(self, message, history, pdf_path, text_splitter, vectorstore, retriever):
-        """处理用户消息"""
+    async def preload(self):
+        """启动时加载持久化的索引，并用一次检索预热向量化、检索和上下文组装"""
+        store = self.vector_store.store
+        if settings.STARTUP_PRELOAD_INDEX:
+            size = await asyncio.to_thread(store.preload)
+            logger.info(f"已预加载索引文件 {size / 1024 / 1024:.1f} MB")
+        else:
+            await asyncio.to_thread(store.load)
+        if not store.manifest.documents:
+            return
+        try:
+            vector = await self._embed_query("预热")
+            await self._retrieve_context("预热", None, vector)
+        except Exception as e:
+            logger.warning(f"检索预热失败: {str(e)}")
+
+    async def _retrieve_context(self, message, retriever, vector=None):
+        """检索相关文档并组装为上下文；已有问题向量时直接按向量检索"""
+        started = time.perf_counter()
+        if self.retrieval_batcher is not None:
+            docs = await self.retrieval_batcher.retrieve(message, settings.RETRIEVAL_K, vector)
+        elif vector is not None:
+            docs = await asyncio.to_thread(
+                self.vector_store.store.retrieve,
+                message,
+                settings.RETRIEVAL_K,
+                vector
+            )
+        else:
+            # 使用 get_relevant_documents 替代 ainvoke
+            docs = await asyncio.to_thread(
+                retriever.get_relevant_documents,
+                message
+            )
+        metrics.observe_stage("retrieval", time.perf_counter() - started)
+        return await asyncio.to_thread(self.context_builder.build, docs)
+
+    async def _embed_query(self, message):
+        """计算问题向量，启用微批处理时与并发的其他问题合并请求"""
+        if self.retrieval_batcher is not None:
+            return await self.retrieval_batcher.embed(message)
+        return await self.vector_store.embeddings.aembed_query(message)
+
+    async def retrieve(self, message, k=None, doc_ids=None):
+        """检索与问题最相关的分块，doc_ids 限定只在这些文档中检索"""
+        k = k or settings.RETRIEVAL_K
+        vector = await self._embed_query(message)
+        if self.retrieval_batcher is not None:
+            return await self.retrieval_batcher.retrieve(message, k, vector, doc_ids)
+        return await asyncio.to_thread(self.vector_store.store.retrieve, message, k, vector, doc_ids)
+
+    async def answer(self, message, history, use_documents, retriever=None, use_cache=True,
+                     session=None, deadline=None):
+        """
+        检索上下文并逐步产出累计的回答文本
+
+        use_documents=False 时不检索文档，直接与模型对话。
+        session 和 deadline 传给生成调度器：同一会话的请求轮流排队，等待超过期限的请求被拒绝。
+
+        启用答案缓存时，先按问题文本精确匹配，再按问题向量做语义匹配，
+        命中则直接返回已有答案；未命中时生成回答并写入缓存。
+        重新生成时 use_cache=False，跳过查找但用新回答覆盖缓存。
+        提示词带有历史对话时，同样的问题可能指代不同的对象，不使用答案缓存。
+
+        Raises:
+            GenerationFailed: 检索或生成失败、等待超过期限，已产出的部分回答应替换为异常中的提示
+        """
+        scope = "rag" if use_documents else "chat"
+        # 文档问答的缓存绑定语料版本，增删文档后自动失效，合并分段不影响；先同步其他工作进程的入库和删除
+        corpus_version = await asyncio.to_thread(self.vector_store.store.current_corpus_version) if use_documents else 0
+        # 失败、繁忙时的提示不是模型的回答，不带入历史
+        history = [
+            (question, reply) for question, reply in history or []
+            if reply and reply not in (GENERATION_ERROR_MESSAGE, OVERLOADED_MESSAGE, RETRIEVAL_ERROR_MESSAGE)
+        ]
+        cacheable = self.answer_cache is not None and not (history and self.llm_service.prompt_builder.enabled)
+        vector = None
+        if cacheable:
+            if use_cache:
+                cached = self.answer_cache.lookup_exact(message, scope, corpus_version)
+                if cached is not None:
+                    yield cached
+                    return
+            vector = await self._embed_query(message)
+            if use_cache:
+                cached = self.answer_cache.lookup_similar(vector, scope, corpus_version)
+                if cached is not None:
+                    yield cached
+                    return
+
+        context = ""
+        if use_documents:
+            # RAG对话模式
+            try:
+                context = await self._retrieve_context(message, retriever, vector)
+            except Exception as e:
+                logger.error(f"检索文档失败: {str(e)}", exc_info=True)
+                raise GenerationFailed(RETRIEVAL_ERROR_MESSAGE) from e
+
+        started = time.perf_counter()
+        answer = ""
+        completed = False
+        async with aclosing(self._stream_answer(message, context, history, session, deadline)) as answers:
+            async for answer in answers:
+                yield answer
+            # 生成失败时 GenerationFailed 向上传播，只有完整生成的回答才写入缓存
+            completed = True
+        if cacheable and completed and answer:
+            self.answer_cache.store(
+                message, vector, answer, scope, corpus_version, time.perf_counter() - started
+            )
+
+    async def _respond(self, message, history, pdf_path, text_splitter, vectorstore, retriever, session=None):
+        """处理用户消息，流式输出回答"""
         try:
             if not message.strip():
-                return "", history
-                
-            if pdf_path is None:
-                # 普通对话模式
-                response = await self.llm_service.generate_response(message, "", history)
-            else:
-                # RAG对话模式
-                try:
-                    # 使用 get_relevant_documents 替代 ainvoke
-                    docs = await asyncio.to_thread(
-                        retriever.get_relevant_documents,
-                        message
-                    )
-                    context = "\n\n".join(doc.page_content for doc in docs)
-                    
-                    # 生成回答
-                    response = await self.llm_service.generate_response(message, context, history)
-                except Exception as e:
-                    logger.error(f"检索文档失败: {str(e)}", exc_info=True)
-                    response = "抱歉，检索相关文档时出现错误，请稍后重试。"
-
-            history.append((message, response))
-            return "", history
+                yield "", history
+                return
+
+            # 先显示用户问题，再随着token到达逐步填充回答
+            history.append((message, ""))
+            started = time.perf_counter()
+            REQUESTS_IN_FLIGHT.inc()
+            try:
+                async with aclosing(self.answer(
+                    message, history[:-1], pdf_path is not None, retriever, session=session
+                )) as answers:
+                    async for answer in answers:
+                        history[-1] = (message, answer)
+                        yield "", history
+            except GenerationFailed as e:
+                # 已显示的部分回答替换为失败提示
+                history[-1] = (message, str(e))
+                yield "", history
+            finally:
+                REQUESTS_IN_FLIGHT.dec()
+                metrics.observe_stage("request", time.perf_counter() - started)
             
         except Exception as e:
             logger.error(f"响应生成错误: {str(e)}", exc_info=True)
             error_message = "抱歉，处理您的问题时出现错误，请稍后重试。"
-            history.append((message, error_message))
-            return "", history
+            if history and history[-1][0] == message and not history[-1][1]:
+                history[-1] = (message, error_message)
+            else:
+                history.append((message, error_message))
+            yield "", history
             
-    async def _regenerate(self, history, pdf_path, text_splitter, vectorstore, retriever):
-        """重新生成回答"""
+    async def _regenerate(self, history, pdf_path, text_splitter, vectorstore, retriever, session=None):
+        """重新生成回答，流式输出"""
         try:
             if not history:
-                return history
+                yield history
+                return
                 
             last_user_message = history[-1][0]
             history = history[:-1]
-            
-            if pdf_path is None:
-                response = await self.llm_service.generate_response(last_user_message, "", history)
-            else:
-                # 使用 invoke 方法替代 get_relevant_documents
-                docs = await retriever.ainvoke(last_user_message)
-                context = "\n\n".join(doc.page_content for doc in docs)
-                response = await self.llm_service.generate_response(last_user_message, context, history)
-                
-            history.append((last_user_message, response))
-            return history
+
+            history.append((last_user_message, ""))
+            started = time.perf_counter()
+            REQUESTS_IN_FLIGHT.inc()
+            try:
+                # 用户要求重新生成，不使用缓存中的旧答案
+                async with aclosing(self.answer(
+                    last_user_message, history[:-1], pdf_path is not None, retriever, use_cache=False, session=session
+                )) as answers:
+                    async for answer in answers:
+                        history[-1] = (last_user_message, answer)
+                        yield history
+            except GenerationFailed as e:
+                history[-1] = (last_user_message, str(e))
+                yield history
+            finally:
+                REQUESTS_IN_FLIGHT.dec()
+                metrics.observe_stage("request", time.perf_counter() - started)
         except Exception as e:
             logger.error(f"重新生成错误: {str(e)}")
-            return history
+            yield history
+
+    async def _stream_answer(self, message, context, history, session=None, deadline=None):
+        """逐步产出累计的回答文本；关闭流式时一次性产出完整回答"""
+        if not settings.LLM_STREAMING:
+            yield await self.llm_service.generate_response(message, context, history, session, deadline)
+            return
+        answer = ""
+        async with aclosing(self.llm_service.stream_response(message, context, history, session, deadline)) as deltas:
+            async for delta in deltas:
+                answer += delta
+                yield answer
             
     def _get_css(self):
         """获取CSS样式"""
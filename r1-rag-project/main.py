@@ -2,40 +2,79 @@ import sys
 # 禁用Python生成.pyc文件，避免缓存文件的生成
 sys.dont_write_bytecode = True
 
-import gradio as gr 
-from fronted.chat_interface import ChatInterface 
-from config.config import settings  
+from config.config import settings
 from utils.logger import logger
+from utils.metrics import start_metrics_server
+from utils.startup import StartupTracker
 import asyncio
 
+
+def _import_interface():
+    """
+    导入界面和核心模块
+
+    gradio、langchain 等依赖导入耗时较长，放在工作线程中执行，与模型预热同时进行。
+    """
+    import gradio  # noqa: F401
+    from fronted.chat_interface import ChatInterface
+    return ChatInterface
+
+
 async def main():
     """
     主函数：初始化并启动Gradio聊天界面服务
-    
+
     异步函数，负责：
-    1. 创建聊天接口实例
-    2. 初始化Gradio界面
-    3. 配置并启动Web服务
+    1. 并行导入界面模块、预热生成和embedding模型
+    2. 创建聊天接口实例，预加载索引并预热检索
+    3. 初始化Gradio界面，配置并启动Web服务
+    各阶段耗时记录到日志和指标中，全部完成后才报告就绪。
     """
-    try:  
+    try:
+        startup = StartupTracker()
+        # 启动Prometheus指标端点，预热完成前 /ready 返回503；关闭指标采集时仍提供 /ready
+        start_metrics_server(ready=startup.is_ready)
+
+        async def load_modules():
+            with startup.phase("import"):
+                return await asyncio.to_thread(_import_interface)
+
+        async def warm_up():
+            if not settings.STARTUP_WARMUP_ENABLED:
+                return
+            from core.ollama_client import warm_up_models
+            with startup.phase("model_warmup"):
+                await warm_up_models()
+
+        ChatInterface, _ = await asyncio.gather(load_modules(), warm_up())
+
         # 初始化聊天接口实例
-        chat_interface = ChatInterface()
+        with startup.phase("init"):
+            chat_interface = ChatInterface()
+        # 加载持久化的索引，并走一遍检索路径
+        with startup.phase("index_preload"):
+            await chat_interface.preload()
         # 创建Gradio界面
-        demo = await chat_interface.create_interface()
+        with startup.phase("ui"):
+            demo = await chat_interface.create_interface()
         logger.info("Gradio界面创建成功")
-        
+
         # 配置并启动Gradio服务，api_open=False禁用API端点暴露
         # queue()处理并发请求，确保请求按照队列顺序进行处理。
         demo.queue(api_open=False)
-        demo.launch(
-            server_name=settings.HOST,  # 服务器主机地址
-            server_port=settings.PORT,  # 服务器端口
-            show_api=False,  # 不显示API文档
-            share=False  # 不创建公共URL
-        )
+        with startup.phase("launch"):
+            demo.launch(
+                server_name=settings.HOST,  # 服务器主机地址
+                server_port=settings.PORT,  # 服务器端口
+                show_api=False,  # 不显示API文档
+                share=False,  # 不创建公共URL
+                prevent_thread_lock=True  # 服务启动后返回，先报告就绪再阻塞
+            )
+        startup.mark_ready()
         logger.info("服务启动成功")
-        
-        
+        demo.block_thread()
+
+
     except Exception as e:
         # 记录错误日志并重新抛出异常
         logger.error(f"服务启动失败: {str(e)}")
@@ -43,4 +82,4 @@ async def main():
 
 if __name__ == "__main__":
     # 启动事件循环并执行异步任务
-    asyncio.run(main()) 
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+"""
+近似检索索引对比报告
+
+对比各索引类型相对精确检索(flat)的 recall@k 与单次查询延迟，用于调整 INDEX_TYPE 及
+nprobe/efSearch 等参数；并对比 float32/fp16/int8 存储精度的内存占用，以及压缩索引
+直接检索和全精度重排后的 recall@k，用于选择 VECTOR_STORAGE 和 RESCORE_FACTOR。
+默认使用向量库中已保存的分段向量（不含已删除的分块）；向量库为空时生成少量合成数据，
+更大规模的合成数据需用 --synthetic 显式指定（每10万个4096维向量约占1.6GB内存）。
+
+用法:
+    python scripts/ann_report.py --k 10 --queries 200
+    python scripts/ann_report.py --synthetic 200000 --types flat,hnsw,ivfflat
+    python scripts/ann_report.py --synthetic 50000 --types flat --storage-index hnsw
+"""
+import sys
+import os
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.ann_index import evaluate_index_types, evaluate_storage_modes, INDEX_TYPES, VECTOR_STORAGE_TYPES
+from core.index_manifest import IndexManifest
+from core.sqlite_docstore import SQLiteDocstore
+from config.config import settings
+import numpy as np
+import argparse
+import json
+
+# 向量库为空且未指定 --synthetic 时生成的合成向量数
+DEFAULT_SYNTHETIC = 10000
+
+
+def load_corpus_vectors():
+    """读取向量库中清单记录的各分段的原始向量，去掉已删除（墓碑）的分块"""
+    manifest = IndexManifest(settings.VECTOR_DB_PATH)
+    if not manifest.exists():
+        return None
+    manifest.load()
+    parts = []
+    for segment_id in sorted(manifest.segments):
+        path = os.path.join(settings.VECTOR_DB_PATH, "segments", segment_id)
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        deleted = manifest.deleted_ids(segment_id)
+        if deleted:
+            docstore = SQLiteDocstore(os.path.join(path, SQLiteDocstore.FILE_NAME))
+            live = [position for position, chunk_id in docstore.iter_ids() if chunk_id not in deleted]
+            vectors = vectors[live]
+        if len(vectors):
+            parts.append(np.asarray(vectors, dtype="float32"))
+    if not parts:
+        return None
+    return np.vstack(parts)
+
+
+def synthetic_vectors(count: int, dim: int):
+    """生成带聚类结构的合成向量，比均匀随机分布更接近真实embedding"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(max(1, count // 500), dim)).astype("float32")
+    labels = rng.integers(0, len(centers), size=count)
+    return centers[labels] + 0.3 * rng.normal(size=(count, dim)).astype("float32")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近似检索索引 recall@k / 延迟对比")
+    parser.add_argument("--k", type=int, default=10, help="召回数量")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help="逗号分隔的索引类型")
+    parser.add_argument(
+        "--synthetic", type=int, default=0, help=f"使用指定数量的合成向量；未指定且向量库为空时使用 {DEFAULT_SYNTHETIC} 个"
+    )
+    parser.add_argument("--storage", default=",".join(VECTOR_STORAGE_TYPES), help="逗号分隔的存储精度，为空时不对比")
+    parser.add_argument("--storage-index", default="flat", help="对比存储精度时使用的索引类型")
+    parser.add_argument("--rescore-factor", type=int, default=settings.RESCORE_FACTOR, help="重排时多取候选的倍数")
+    args = parser.parse_args()
+
+    vectors = None if args.synthetic else load_corpus_vectors()
+    if vectors is None:
+        vectors = synthetic_vectors(args.synthetic or DEFAULT_SYNTHETIC, settings.VECTOR_DIMENSIONS)
+
+    # 查询取自语料向量并加入少量噪声，模拟与文档相近的问题
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)
+    queries = vectors[rows] + 0.05 * rng.normal(size=(len(rows), vectors.shape[1])).astype("float32")
+
+    report = evaluate_index_types(vectors, queries, args.k, args.types.split(","))
+    storage = evaluate_storage_modes(
+        vectors, queries, args.k, args.storage_index, args.storage.split(","), args.rescore_factor
+    ) if args.storage else []
+    print(json.dumps({
+        "num_vectors": int(len(vectors)),
+        "dim": int(vectors.shape[1]),
+        "k": args.k,
+        "results": report,
+        "storage": storage,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
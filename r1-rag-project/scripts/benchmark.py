@@ -0,0 +1,293 @@
+"""
+离线基准测试
+
+启动本地Ollama替身服务（scripts/fake_ollama.py），生成合成PDF，依次测量：
+- 入库：pages/s、chunks/s
+- 检索：问题向量化 + 检索 + 上下文组装的 p50/p99，以及命中率
+- 端到端：并发调用 ChatInterface._respond 的 TTFT、总耗时和 QPS；--turns 大于1时每个会话连续追问，
+  按轮次报告提示词token数和实际预填充的token数、耗时，对比多轮对话中前缀复用的效果
+结果以JSON输出，可在普通Linux机器上对比前后版本，发现性能回退。
+
+用法:
+    python scripts/benchmark.py --docs 2 --pages 50 --queries 200 --concurrency 16
+    python scripts/benchmark.py --token-rate 20 --parallel 2 --output bench.json
+    python scripts/benchmark.py --turns 8 --prefill-rate 2000 --e2e-queries 64
+"""
+import sys
+import os
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_ollama
+from types import SimpleNamespace
+import multiprocessing
+import numpy as np
+import urllib.request
+import argparse
+import asyncio
+import tempfile
+import random
+import socket
+import shutil
+import json
+import time
+import fitz
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_ollama(config) -> tuple:
+    """在独立进程中启动替身服务，避免与被测代码争用GIL，返回 (进程, 地址)"""
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=fake_ollama.serve, args=("127.0.0.1", port, config), daemon=True
+    )
+    process.start()
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f"{url}/api/version", timeout=1).read()
+            return process, url
+        except OSError:
+            if time.time() > deadline or not process.is_alive():
+                raise RuntimeError("替身Ollama服务启动失败")
+            time.sleep(0.1)
+
+
+def make_pdf(path: str, doc_index: int, pages: int, facts_per_page: int, rng) -> list:
+    """
+    生成合成PDF，每页若干条带唯一设备编号的中英文事实
+
+    Returns:
+        list: [(设备编号, 页码)]，用于构造查询和计算命中率
+    """
+    facts = []
+    doc = fitz.open()
+    for page_number in range(pages):
+        lines = []
+        for fact in range(facts_per_page):
+            unit = f"A-{doc_index}-{page_number}-{fact}"
+            power = rng.randint(100, 9999)
+            lines.append(f"设备 {unit} 的额定功率为 {power} 瓦。Unit {unit} is rated at {power} W.")
+            facts.append((unit, page_number))
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(36, 36, 559, 806), "\n".join(lines), fontsize=8, fontname="china-s")
+    doc.save(path)
+    doc.close()
+    return facts
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    data = np.asarray(values) * 1000
+    return {
+        "count": len(values),
+        "p50_ms": round(float(np.percentile(data, 50)), 2),
+        "p90_ms": round(float(np.percentile(data, 90)), 2),
+        "p99_ms": round(float(np.percentile(data, 99)), 2),
+        "max_ms": round(float(data.max()), 2),
+    }
+
+
+async def run_concurrent(items: list, concurrency: int, worker) -> float:
+    """以固定并发执行 worker(item)，返回总耗时"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            await worker(item)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(item) for item in items))
+    return time.perf_counter() - started
+
+
+async def benchmark(args, workdir: str) -> dict:
+    # 环境变量需在导入项目模块之前设置，配置在导入时读取
+    from fronted.chat_interface import ChatInterface
+    from config.config import settings
+    from utils.metrics import metrics
+
+    rng = random.Random(args.seed)
+    chat = ChatInterface()
+    report = {"config": {
+        "docs": args.docs,
+        "pages": args.pages,
+        "facts_per_page": args.facts_per_page,
+        "queries": args.queries,
+        "concurrency": args.concurrency,
+        "fake_ollama": vars(fake_ollama.config_from_args(args)),
+        "settings": {
+            key: getattr(settings, key) for key in (
+                "WORKERS", "CHUNKER", "CHUNK_TOKENS", "CHUNK_OVERLAP_TOKENS", "CHUNK_SIZE", "CHUNK_OVERLAP",
+                "RETRIEVAL_K", "INDEX_TYPE", "SEARCH_THREADS", "FAISS_OMP_THREADS",
+                "HYBRID_SEARCH_ENABLED", "INGEST_PIPELINE_ENABLED", "EMBED_CACHE_ENABLED",
+                "RETRIEVAL_BATCH_ENABLED", "LLM_STREAMING", "CONTEXT_MAX_TOKENS",
+                "HISTORY_MAX_TOKENS", "HISTORY_COMPACT_TURNS", "HISTORY_SUMMARY_LLM",
+            )
+        },
+    }}
+
+    # 入库
+    facts, pdf_paths = [], []
+    for doc_index in range(args.docs):
+        path = os.path.join(workdir, f"synthetic-{doc_index}.pdf")
+        facts.extend(make_pdf(path, doc_index, args.pages, args.facts_per_page, rng))
+        pdf_paths.append(path)
+
+    store = chat.vector_store.store
+    started = time.perf_counter()
+    for path in pdf_paths:
+        job_id = (await chat._process_file(SimpleNamespace(name=path)))[4]
+        job = await chat.ingest_jobs.wait(job_id)
+        if job.error:
+            raise RuntimeError(f"入库失败: {job.error}")
+    retriever = await chat.vector_store.get_retriever()
+    elapsed = time.perf_counter() - started
+    pages = args.docs * args.pages
+    chunks = sum(store.manifest.live_vectors(segment_id) for segment_id in store.manifest.segments)
+    report["ingest"] = {
+        "pages": pages,
+        "chunks": chunks,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 2),
+        "chunks_per_second": round(chunks / elapsed, 2),
+    }
+
+    queries = [
+        (f"设备 {unit} 的额定功率是多少？", unit)
+        for unit, _ in rng.sample(facts, min(args.queries, len(facts)))
+    ]
+    pdf_path = pdf_paths[-1]
+
+    # 检索
+    latencies, hits = [], 0
+
+    async def retrieve(item):
+        nonlocal hits
+        question, unit = item
+        started = time.perf_counter()
+        vector = await chat._embed_query(question)
+        context = await chat._retrieve_context(question, retriever, vector)
+        latencies.append(time.perf_counter() - started)
+        hits += f"{unit} " in context
+
+    elapsed = await run_concurrent(queries, args.concurrency, retrieve)
+    report["retrieval"] = {
+        **percentiles(latencies),
+        "qps": round(len(queries) / elapsed, 2),
+        "hit_rate": round(hits / len(queries), 4),
+    }
+
+    # 端到端
+    ttfts, totals, errors = [], [], 0
+    chat.llm_service.recent_stats.clear()
+
+    async def respond(conversation):
+        # 同一会话的问题依次提问，历史对话随之增长
+        nonlocal errors
+        history = []
+        for question, _ in conversation:
+            started = time.perf_counter()
+            first = None
+            answer = ""
+            async for _, history in chat._respond(question, history, pdf_path, None, None, retriever):
+                answer = history[-1][1]
+                if answer and first is None:
+                    first = time.perf_counter() - started
+            totals.append(time.perf_counter() - started)
+            if first is not None:
+                ttfts.append(first)
+            if not answer or answer.startswith("抱歉"):
+                errors += 1
+
+    e2e_queries = queries[:args.e2e_queries] if args.e2e_queries else queries
+    turns = max(1, args.turns)
+    conversations = [e2e_queries[start:start + turns] for start in range(0, len(e2e_queries), turns)]
+    elapsed = await run_concurrent(conversations, args.concurrency, respond)
+    model_ttfts = [stats.ttft for stats in chat.llm_service.recent_stats if stats.ttft is not None]
+    report["end_to_end"] = {
+        "requests": len(e2e_queries),
+        "errors": errors,
+        "qps": round(len(e2e_queries) / elapsed, 2),
+        "ttft": percentiles(ttfts),
+        "model_ttft": percentiles(model_ttfts),
+        "total": percentiles(totals),
+        "limiter": chat.llm_service.limiter.stats(),
+        "prompt": prompt_report(chat.llm_service.recent_stats),
+    }
+    if chat.answer_cache is not None:
+        report["end_to_end"]["answer_cache"] = chat.answer_cache.stats()
+    # 各阶段耗时，定位回退发生在哪个阶段
+    report["stages"] = metrics.stage_seconds.summary()
+    return report
+
+
+def prompt_report(recent_stats) -> list:
+    """按对话轮次统计提示词token数和实际预填充的token数、耗时"""
+    by_turn = {}
+    for stats in recent_stats:
+        if stats.prompt is None:
+            continue
+        turn = stats.prompt.history_turns + stats.prompt.summarized_turns + 1
+        by_turn.setdefault(turn, []).append(stats)
+    report = []
+    for turn in sorted(by_turn):
+        group = by_turn[turn]
+        prefill_tokens = [stats.prefill_tokens for stats in group if stats.prefill_tokens is not None]
+        prefill_seconds = [stats.prefill_seconds for stats in group if stats.prefill_seconds is not None]
+        report.append({
+            "turn": turn,
+            "requests": len(group),
+            "prompt_tokens": round(float(np.mean([stats.prompt.prompt_tokens for stats in group])), 1),
+            "summarized_turns": round(float(np.mean([stats.prompt.summarized_turns for stats in group])), 1),
+            "prefill_tokens": round(float(np.mean(prefill_tokens)), 1) if prefill_tokens else None,
+            "prefill_ms": round(float(np.mean(prefill_seconds)) * 1000, 2) if prefill_seconds else None,
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试")
+    parser.add_argument("--docs", type=int, default=2, help="合成PDF数量")
+    parser.add_argument("--pages", type=int, default=50, help="每个PDF的页数")
+    parser.add_argument("--facts-per-page", type=int, default=20, help="每页的事实条数")
+    parser.add_argument("--queries", type=int, default=200, help="检索查询数")
+    parser.add_argument("--e2e-queries", type=int, default=50, help="端到端请求数，0表示与检索查询数相同")
+    parser.add_argument("--turns", type=int, default=1, help="端到端每个会话连续提问的轮数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--answer-cache", action="store_true", help="启用答案缓存（默认关闭，避免掩盖生成耗时）")
+    parser.add_argument("--output", help="结果输出文件，缺省时打印到标准输出")
+    fake_ollama.add_arguments(parser)
+    args = parser.parse_args()
+
+    process, url = start_fake_ollama(fake_ollama.config_from_args(args))
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    os.environ["OLLAMA_HOST"] = url
+    os.environ["VECTOR_DB_PATH"] = os.path.join(workdir, "vector_db")
+    os.environ["EMBED_CACHE_PATH"] = os.path.join(workdir, "embedding_cache.sqlite")
+    os.environ["ANSWER_CACHE_ENABLED"] = "true" if args.answer_cache else "false"
+    # 基准测试不下载分词器，按字符估算token数
+    os.environ.setdefault("CONTEXT_TOKENIZER", "")
+    try:
+        report = asyncio.run(benchmark(args, workdir))
+    finally:
+        process.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
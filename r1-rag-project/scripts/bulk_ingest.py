@@ -0,0 +1,271 @@
+"""
+批量入库
+
+遍历目录树中的PDF，在进程池中并行解析和分割，多个文件的分块合并为大批次请求embedding模型，
+按 --commit-chunks 个分块为一个分段批量写入索引。每批写入后更新检查点文件，
+崩溃或 Ctrl-C 后重新运行同一命令时跳过已完成的文件。结束时输出整体吞吐量。
+
+解析进程数由 WORKERS 环境变量决定。
+
+用法:
+    python scripts/bulk_ingest.py /data/manuals
+    WORKERS=8 python scripts/bulk_ingest.py /data/manuals --embed-batch 128 --commit-chunks 50000
+    python scripts/bulk_ingest.py /data/manuals --retry-failed
+"""
+import sys
+import os
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.pdf_processor import PDFProcessor
+from core.vector_store import VectorStore
+from core.segmented_store import make_chunk_id
+from config.config import settings
+from utils.logger import logger
+from collections import deque
+import argparse
+import asyncio
+import json
+import time
+
+
+class Checkpoint:
+    """
+    批量入库检查点
+
+    以JSON记录已写入索引（或确认无需写入）的文件和解析失败的文件，键为相对于根目录的路径。
+    只在分段提交之后记录，检查点中的文件一定已经在索引中。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = {}
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.done = data.get("done", {})
+            self.failed = data.get("failed", {})
+
+    def save(self):
+        """先写临时文件再替换，中断时不会留下半个检查点"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done, "failed": self.failed}, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def find_pdfs(root: str) -> list:
+    """按路径排序返回目录树中的全部PDF（相对路径）"""
+    found = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.lower().endswith(".pdf"):
+                found.append(os.path.relpath(os.path.join(directory, name), root))
+    return sorted(found)
+
+
+class BulkIngester:
+    """
+    批量入库
+
+    三个环节重叠执行：
+    - 进程池并行解析文件，同时在途的文件数有上限，内存占用与文件总数无关
+    - 已解析的文件先过滤与已入库或本批其他文件近似重复的分块，
+      凑满 embed_batch * embed_concurrency 个分块后，按批并发请求embedding模型
+    - 向量追加到分段构建器，累计 commit_chunks 个分块后作为一个分段提交，并更新检查点
+    """
+
+    def __init__(self, root: str, checkpoint: Checkpoint, embed_batch: int, embed_concurrency: int,
+                 commit_chunks: int, max_in_flight: int):
+        self.root = root
+        self.checkpoint = checkpoint
+        self.embed_batch = embed_batch
+        self.embed_concurrency = embed_concurrency
+        self.commit_chunks = commit_chunks
+        self.max_in_flight = max_in_flight
+        self.pdf_processor = PDFProcessor()
+        self.vector_store = VectorStore()
+        self.store = self.vector_store.store
+        # duplicates: 近似重复、未向量化的分块数，即节省的embedding次数
+        self.stats = {"files": 0, "indexed": 0, "skipped": 0, "failed": 0, "pages": 0, "chunks": 0, "duplicates": 0}
+        # 已向量化、等待提交的文件: [(相对路径, 文件哈希, 分块数)]
+        self._builder = self.store.begin_document()
+        self._pending = []
+        # 近似重复过滤会话，与分段构建器一同提交
+        self._dedup = self.store.dedup_session()
+        # 本次运行中已解析、尚未提交的文件哈希，用于跳过内容相同的文件
+        self._queued = set()
+
+    async def run(self, files: list) -> dict:
+        try:
+            return await self._run(files)
+        finally:
+            # 提交后新建的构建器以及中途失败时未提交的构建器，都删除其构建目录
+            self._builder.discard()
+
+    async def _run(self, files: list) -> dict:
+        await asyncio.to_thread(self.store.load)
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        queue = deque(files)
+        in_flight = deque()
+        parsed, parsed_chunks = [], 0
+
+        while queue or in_flight:
+            while queue and len(in_flight) < self.max_in_flight:
+                relpath = queue.popleft()
+                future = self.pdf_processor.submit_file(os.path.join(self.root, relpath))
+                in_flight.append((relpath, asyncio.wrap_future(future, loop=loop)))
+            # 按提交顺序取结果，检查点和分段中的文件顺序稳定
+            relpath, future = in_flight.popleft()
+            self.stats["files"] += 1
+            try:
+                doc_id, pages, chunks = await future
+            except Exception as e:
+                logger.error(f"解析失败: {relpath}: {str(e)}")
+                self.checkpoint.failed[relpath] = str(e)
+                self.stats["failed"] += 1
+                continue
+            self.stats["pages"] += pages
+            if self.store.has_document(doc_id) or doc_id in self._queued or not chunks:
+                # 内容已在索引中、与本批其他文件重复，或没有可索引的文本
+                self.checkpoint.done[relpath] = {"doc_id": doc_id, "chunks": 0}
+                self.checkpoint.failed.pop(relpath, None)
+                self.stats["skipped"] += 1
+                continue
+            ids = [make_chunk_id(doc_id, i) for i in range(len(chunks))]
+            if self._dedup is not None:
+                kept, ids = await asyncio.to_thread(self._dedup.filter, doc_id, relpath, chunks, ids)
+                self.stats["duplicates"] += len(chunks) - len(kept)
+                chunks = kept
+            parsed.append((relpath, doc_id, chunks, ids))
+            self._queued.add(doc_id)
+            parsed_chunks += len(chunks)
+            if parsed_chunks >= self.embed_batch * self.embed_concurrency:
+                await self._embed(parsed)
+                parsed, parsed_chunks = [], 0
+                if len(self._builder.ids) >= self.commit_chunks:
+                    await self._commit()
+            self._report_progress(started, len(files))
+
+        if parsed:
+            await self._embed(parsed)
+        await self._commit()
+
+        elapsed = time.perf_counter() - started
+        self.vector_store.schedule_compaction()
+        self.vector_store.merge_executor.shutdown(wait=True)
+        return {
+            **self.stats,
+            "seconds": round(elapsed, 2),
+            "files_per_second": round(self.stats["files"] / elapsed, 2) if elapsed else None,
+            "pages_per_second": round(self.stats["pages"] / elapsed, 2) if elapsed else None,
+            "chunks_per_second": round(self.stats["chunks"] / elapsed, 2) if elapsed else None,
+        }
+
+    async def _embed(self, parsed: list):
+        """多个文件的分块合并为批次并发向量化，再按文件顺序追加到构建器"""
+        texts = [chunk.page_content for _, _, chunks, _ in parsed for chunk in chunks]
+        semaphore = asyncio.Semaphore(self.embed_concurrency)
+
+        async def embed(batch):
+            async with semaphore:
+                return await self.vector_store.embeddings.aembed_documents(batch)
+
+        results = await asyncio.gather(*(
+            embed(texts[i:i + self.embed_batch]) for i in range(0, len(texts), self.embed_batch)
+        ))
+        vectors = [vector for batch in results for vector in batch]
+
+        offset = 0
+        for relpath, doc_id, chunks, ids in parsed:
+            count = len(chunks)
+            await asyncio.to_thread(
+                self._builder.add,
+                [chunk.page_content for chunk in chunks],
+                vectors[offset:offset + count],
+                [chunk.metadata for chunk in chunks],
+                ids
+            )
+            self._pending.append((relpath, doc_id, count))
+            offset += count
+
+    async def _commit(self):
+        """把构建器中的文件作为一个分段提交，然后更新检查点"""
+        if self._pending:
+            documents, start = [], 0
+            for relpath, doc_id, count in self._pending:
+                # 来源取相对路径，不同目录下的同名文件不会互相替换
+                documents.append((doc_id, relpath, (start, start + count)))
+                start += count
+            written = set(await asyncio.to_thread(
+                self.store.commit_documents, self._builder, documents, self._dedup
+            ))
+            for relpath, doc_id, count in self._pending:
+                self.checkpoint.done[relpath] = {"doc_id": doc_id, "chunks": count if doc_id in written else 0}
+                self.checkpoint.failed.pop(relpath, None)
+                if doc_id in written:
+                    self.stats["indexed"] += 1
+                    self.stats["chunks"] += count
+                else:
+                    self.stats["skipped"] += 1
+            self._builder = self.store.begin_document()
+            self._pending = []
+            self._dedup = self.store.dedup_session()
+            self._queued.clear()
+        await asyncio.to_thread(self.checkpoint.save)
+
+    def _report_progress(self, started: float, total: int):
+        if self.stats["files"] % 50 and self.stats["files"] != total:
+            return
+        elapsed = time.perf_counter() - started
+        print(
+            f"[{self.stats['files']}/{total}] 已写入 {self.stats['indexed']} 个文件，"
+            f"{self.stats['chunks']} 个分块，{self.stats['pages'] / elapsed:.1f} 页/秒",
+            file=sys.stderr,
+            flush=True
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量入库目录中的PDF")
+    parser.add_argument("root", help="PDF所在的根目录，递归查找")
+    parser.add_argument("--checkpoint", help="检查点文件，缺省为向量库目录下的 bulk_ingest.checkpoint.json")
+    parser.add_argument("--embed-batch", type=int, default=settings.EMBED_BATCH_SIZE, help="每个embedding请求的分块数")
+    parser.add_argument("--embed-concurrency", type=int, default=max(1, settings.INGEST_EMBED_CONCURRENCY), help="并发的embedding请求数")
+    parser.add_argument("--commit-chunks", type=int, default=settings.SEGMENT_SMALL_VECTORS, help="每个分段的分块数")
+    parser.add_argument("--max-in-flight", type=int, default=settings.WORKERS * 2, help="同时解析的文件数上限")
+    parser.add_argument("--retry-failed", action="store_true", help="重新处理检查点中解析失败的文件")
+    parser.add_argument("--reset", action="store_true", help="忽略已有检查点，从头开始")
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or os.path.join(settings.VECTOR_DB_PATH, "bulk_ingest.checkpoint.json")
+    if args.reset and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    files = [
+        relpath for relpath in find_pdfs(args.root)
+        if relpath not in checkpoint.done and (args.retry_failed or relpath not in checkpoint.failed)
+    ]
+    print(f"共 {len(files)} 个待处理文件，检查点: {checkpoint_path}", file=sys.stderr, flush=True)
+
+    ingester = BulkIngester(
+        args.root, checkpoint, args.embed_batch, args.embed_concurrency,
+        args.commit_chunks, max(1, args.max_in_flight)
+    )
+    try:
+        report = asyncio.run(ingester.run(files))
+    except KeyboardInterrupt:
+        # 已提交的分段都已记录在检查点中，重新运行即可继续
+        print("已中断，重新运行同一命令将从检查点继续", file=sys.stderr)
+        sys.exit(130)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+文本分割吞吐对比
+
+在同一批页面上分别运行 RecursiveCharacterTextSplitter（CHUNK_SIZE/CHUNK_OVERLAP）和
+TokenTextChunker（CHUNK_TOKENS/CHUNK_OVERLAP_TOKENS），输出JSON格式的吞吐量、分块数、
+分块token数分布、超出token上限的分块比例，以及在句子边界结束的分块比例。
+默认生成中英文混排的合成页面，也可以指定PDF文件。
+
+用法:
+    python scripts/chunk_benchmark.py --pages 2000 --rounds 3
+    python scripts/chunk_benchmark.py --layout paragraphs
+    python scripts/chunk_benchmark.py --pdf manual.pdf --pdf spec.pdf
+    CONTEXT_TOKENIZER=/models/DeepSeek-R1-Distill-Qwen-7B python scripts/chunk_benchmark.py   # 按分词器统计token数
+"""
+import sys
+import os
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from core.text_chunker import TokenTextChunker
+from utils.token_counter import get_token_counter
+from config.config import settings
+import numpy as np
+import argparse
+import random
+import json
+import time
+import fitz
+
+_SENTENCE_ENDINGS = ("。", "！", "？", "；", ".", "!", "?", ";", "…", "”", "）", ")")
+
+
+def synthetic_pages(count: int, seed: int, layout: str = "lines") -> list:
+    """
+    生成中英文混排的页面：正文段落、规格条目，以及每页重复的页眉页脚
+
+    layout 为 lines 时每个段落一行；为 paragraphs 时整页没有换行，与很多中文PDF提取出的文本一致。
+    """
+    rng = random.Random(seed)
+    words = "泵 电机 额定 功率 扬程 流量 安装 维护 检查 压力 温度 管路 阀门 密封 轴承 叶轮 电缆 接地 保护 运行".split()
+    english = "the pump shall be installed on a level foundation and checked before first operation".split()
+    pages = []
+    for number in range(count):
+        lines = [f"某某水泵有限公司 使用说明书 第 {number + 1} 页"]
+        for _ in range(rng.randint(6, 12)):
+            sentences = []
+            for _ in range(rng.randint(2, 6)):
+                if rng.random() < 0.3:
+                    sentences.append(" ".join(rng.choices(english, k=rng.randint(8, 20))).capitalize() + ".")
+                else:
+                    sentences.append("".join(rng.choices(words, k=rng.randint(6, 20))) + rng.choice("。；！"))
+            lines.append("".join(sentences))
+            if rng.random() < 0.3:
+                lines.append(f"型号 QJ-{rng.randint(100, 999)}：额定功率 {rng.randint(1, 90)} kW，扬程 {rng.randint(10, 300)} m")
+        lines.append("本手册内容如有变更，恕不另行通知。")
+        text = "\n".join(lines) if layout == "lines" else "".join(lines)
+        pages.append(Document(page_content=text, metadata={"source": "synthetic.pdf", "page": number}))
+    return pages
+
+
+def pdf_pages(paths: list) -> list:
+    pages = []
+    for path in paths:
+        with fitz.open(path) as doc:
+            for number, page in enumerate(doc):
+                pages.append(Document(page_content=page.get_text(), metadata={"source": path, "page": number}))
+    return pages
+
+
+def measure(splitter, pages: list, rounds: int, token_counter) -> dict:
+    """多轮分割取最快一轮的耗时，再统计分块的token数"""
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        chunks = splitter.split_documents(pages)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    characters = sum(len(page.page_content) for page in pages)
+    tokens = np.asarray([token_counter.count(chunk.page_content) for chunk in chunks])
+    return {
+        "seconds": round(best, 4),
+        "pages_per_second": round(len(pages) / best, 1),
+        "mb_per_second": round(characters / best / 1e6, 2),
+        "chunks": len(chunks),
+        "tokens_mean": round(float(tokens.mean()), 1) if len(tokens) else 0,
+        "tokens_p95": int(np.percentile(tokens, 95)) if len(tokens) else 0,
+        "tokens_max": int(tokens.max()) if len(tokens) else 0,
+        "over_token_limit": round(float((tokens > settings.CHUNK_TOKENS).mean()), 4) if len(tokens) else 0,
+        "ends_at_sentence": round(
+            sum(chunk.page_content.rstrip().endswith(_SENTENCE_ENDINGS) for chunk in chunks) / max(1, len(chunks)), 4
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比文本分割器的吞吐量和分块质量")
+    parser.add_argument("--pdf", action="append", default=[], help="使用PDF文件的页面，可重复指定")
+    parser.add_argument("--pages", type=int, default=1000, help="合成页面数")
+    parser.add_argument("--layout", choices=("lines", "paragraphs"), default="lines", help="合成页面的排版")
+    parser.add_argument("--rounds", type=int, default=3, help="每个分割器的运行轮数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="把结果另存为JSON文件")
+    args = parser.parse_args()
+
+    pages = pdf_pages(args.pdf) if args.pdf else synthetic_pages(args.pages, args.seed, args.layout)
+    token_counter = get_token_counter()
+    splitters = {
+        "recursive": RecursiveCharacterTextSplitter(
+            chunk_size=settings.CHUNK_SIZE, chunk_overlap=settings.CHUNK_OVERLAP, add_start_index=True
+        ),
+        "token": TokenTextChunker(),
+    }
+    report = {
+        "config": {
+            "pages": len(pages),
+            "layout": None if args.pdf else args.layout,
+            "characters": sum(len(page.page_content) for page in pages),
+            "tokenizer": settings.CONTEXT_TOKENIZER if token_counter._tokenizer is not None else "estimate",
+            "CHUNK_SIZE": settings.CHUNK_SIZE,
+            "CHUNK_OVERLAP": settings.CHUNK_OVERLAP,
+            "CHUNK_TOKENS": settings.CHUNK_TOKENS,
+            "CHUNK_OVERLAP_TOKENS": settings.CHUNK_OVERLAP_TOKENS,
+        },
+        **{name: measure(splitter, pages, args.rounds, token_counter) for name, splitter in splitters.items()},
+    }
+    report["speedup"] = round(report["recursive"]["seconds"] / report["token"]["seconds"], 2)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
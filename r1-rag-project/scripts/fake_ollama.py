@@ -0,0 +1,281 @@
+"""
+本地Ollama替身服务
+
+实现 /api/chat（流式NDJSON与非流式）、/api/embed、/api/embeddings、/api/tags、/api/version，
+延迟、生成速度、预填充速度和并行度可配置；与最近请求共享的提示词前缀按复用KV缓存处理，不计预填充；
+向量由文本的词项哈希确定性生成，相同文本得到相同向量，
+词项重合越多的文本向量越相近，检索结果有意义。用于没有GPU和真实模型的机器上做基准测试。
+
+用法:
+    python scripts/fake_ollama.py --port 11435 --dim 768 --token-rate 50
+    OLLAMA_HOST=http://127.0.0.1:11435 python main.py
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import deque
+import numpy as np
+import argparse
+import hashlib
+import threading
+import json
+import time
+import os
+import re
+
+# 英文词和单个CJK字符作为词项
+_TERM_RE = re.compile(r"[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff]")
+
+
+class FakeOllamaConfig:
+    """替身服务的行为参数"""
+
+    def __init__(self, dim=768, chat_latency=0.05, embed_latency=0.005, embed_item_latency=0.0005,
+                 token_rate=50.0, answer_tokens=64, think_tokens=8, parallel=4, prefill_rate=0.0):
+        """
+        Args:
+            dim: 向量维度
+            chat_latency: 生成请求的首token前延迟(秒)，模拟预填充
+            embed_latency: 每个向量化请求的固定延迟(秒)
+            embed_item_latency: 向量化请求中每条文本的额外延迟(秒)
+            token_rate: 生成速度(tokens/s)
+            answer_tokens: 每个回答的可见token数
+            think_tokens: 回答前 <think> 思考过程的token数
+            parallel: 同时处理的请求数，超出的请求排队，模拟 OLLAMA_NUM_PARALLEL
+            prefill_rate: 预填充速度(tokens/s)，0表示不按提示词长度增加首token延迟
+        """
+        self.dim = dim
+        self.chat_latency = chat_latency
+        self.embed_latency = embed_latency
+        self.embed_item_latency = embed_item_latency
+        self.token_rate = token_rate
+        self.answer_tokens = answer_tokens
+        self.think_tokens = think_tokens
+        self.parallel = parallel
+        self.prefill_rate = prefill_rate
+
+
+def _term_vector(term: str, dim: int):
+    seed = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype("float32")
+
+
+def embed_text(text: str, dim: int) -> list:
+    """按词项哈希生成确定性的单位向量"""
+    vector = np.zeros(dim, dtype="float32")
+    for term in _TERM_RE.findall(text.lower()):
+        vector += _term_vector(term, dim)
+    norm = float(np.linalg.norm(vector))
+    if norm == 0:
+        vector = _term_vector(text, dim)
+        norm = float(np.linalg.norm(vector))
+    return (vector / norm).tolist()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 关闭Nagle算法，避免长连接上小响应被延迟确认拖慢
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self) -> FakeOllamaConfig:
+        return self.server.config
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": []})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        request = self._read_json()
+        with self.server.slots:
+            if self.path == "/api/embed":
+                self._embed(request)
+            elif self.path == "/api/embeddings":
+                vector = embed_text(request.get("prompt", ""), self.config.dim)
+                time.sleep(self.config.embed_latency)
+                self._send_json({"embedding": vector})
+            elif self.path == "/api/chat":
+                self._chat(request)
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+    def _embed(self, request: dict):
+        texts = request.get("input", "")
+        if isinstance(texts, str):
+            texts = [texts]
+        started = time.perf_counter()
+        vectors = [embed_text(text, self.config.dim) for text in texts]
+        delay = self.config.embed_latency + self.config.embed_item_latency * len(texts)
+        time.sleep(max(0.0, delay - (time.perf_counter() - started)))
+        self._send_json({
+            "model": request.get("model", ""),
+            "embeddings": vectors,
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+        })
+
+    def _tokens(self, request: dict) -> list:
+        """生成确定性的回答token：先是思考过程，再复述问题中的片段"""
+        messages = request.get("messages") or [{}]
+        seed = messages[-1].get("content", "")
+        words = _TERM_RE.findall(seed.lower()) or ["ok"]
+        tokens = ["<think>"] + ["思考"] * self.config.think_tokens + ["</think>", "\n\n"]
+        tokens += [words[i % len(words)] + " " for i in range(self.config.answer_tokens)]
+        return tokens
+
+    def _chunk(self, request: dict, content: str, done: bool, **extra) -> dict:
+        return {
+            "model": request.get("model", ""),
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+            **extra,
+        }
+
+    def _prefill(self, request: dict) -> dict:
+        """
+        模拟预填充
+
+        与最近 parallel 个请求中任一提示词共享的最长前缀视为命中KV缓存，只有其余token计入预填充，
+        与Ollama一样在 prompt_eval_count 中只报告实际计算的token数。
+        """
+        prompt = _TERM_RE.findall(json.dumps(request.get("messages") or [], ensure_ascii=False).lower())
+        with self.server.prompt_lock:
+            shared = max((len(os.path.commonprefix([prompt, cached])) for cached in self.server.prompts), default=0)
+            self.server.prompts.append(prompt)
+        prefill = len(prompt) - shared
+        delay = self.config.chat_latency
+        if self.config.prefill_rate > 0:
+            delay += prefill / self.config.prefill_rate
+        time.sleep(delay)
+        return {"prompt_eval_count": prefill, "prompt_eval_duration": int(delay * 1e9)}
+
+    def _chat(self, request: dict):
+        tokens = self._tokens(request)
+        interval = 1.0 / self.config.token_rate if self.config.token_rate > 0 else 0.0
+        prefill = self._prefill(request)
+        started = time.perf_counter()
+        stats = {"done_reason": "stop", "eval_count": len(tokens), **prefill}
+
+        if request.get("stream", True) is False:
+            time.sleep(interval * len(tokens))
+            stats["eval_duration"] = int((time.perf_counter() - started) * 1e9)
+            self._send_json(self._chunk(request, "".join(tokens), True, **stats))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for token in tokens:
+                time.sleep(interval)
+                self._write_chunk(self._chunk(request, token, False))
+            stats["eval_duration"] = int((time.perf_counter() - started) * 1e9)
+            self._write_chunk(self._chunk(request, "", True, **stats))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开
+            pass
+
+    def _write_chunk(self, payload: dict):
+        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, config: FakeOllamaConfig):
+        super().__init__((host, port), FakeOllamaHandler)
+        self.config = config
+        self.slots = threading.Semaphore(max(1, config.parallel))
+        # 最近请求的提示词，模拟每个并行槽位保留的KV缓存
+        self.prompts = deque(maxlen=max(1, config.parallel))
+        self.prompt_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def serve(host: str = "127.0.0.1", port: int = 11435, config: FakeOllamaConfig = None):
+    """启动替身服务并阻塞运行"""
+    server = FakeOllamaServer(host, port, config or FakeOllamaConfig())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def start_in_thread(host: str = "127.0.0.1", port: int = 0, config: FakeOllamaConfig = None):
+    """在后台线程中启动替身服务，port=0 时自动选择空闲端口，返回服务实例"""
+    server = FakeOllamaServer(host, port, config or FakeOllamaConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """注册替身服务的命令行参数，基准测试脚本复用"""
+    defaults = FakeOllamaConfig()
+    parser.add_argument("--dim", type=int, default=defaults.dim, help="向量维度")
+    parser.add_argument("--chat-latency", type=float, default=defaults.chat_latency, help="首token前延迟(秒)")
+    parser.add_argument("--embed-latency", type=float, default=defaults.embed_latency, help="向量化请求固定延迟(秒)")
+    parser.add_argument("--embed-item-latency", type=float, default=defaults.embed_item_latency, help="每条文本的向量化延迟(秒)")
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate, help="生成速度(tokens/s)")
+    parser.add_argument("--answer-tokens", type=int, default=defaults.answer_tokens, help="回答的token数")
+    parser.add_argument("--think-tokens", type=int, default=defaults.think_tokens, help="思考过程的token数")
+    parser.add_argument("--parallel", type=int, default=defaults.parallel, help="服务端并行处理的请求数")
+    parser.add_argument("--prefill-rate", type=float, default=defaults.prefill_rate, help="预填充速度(tokens/s)，0表示不模拟")
+
+
+def config_from_args(args) -> FakeOllamaConfig:
+    return FakeOllamaConfig(
+        dim=args.dim,
+        chat_latency=args.chat_latency,
+        embed_latency=args.embed_latency,
+        embed_item_latency=args.embed_item_latency,
+        token_rate=args.token_rate,
+        answer_tokens=args.answer_tokens,
+        think_tokens=args.think_tokens,
+        parallel=args.parallel,
+        prefill_rate=args.prefill_rate,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地Ollama替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"fake ollama listening on http://{args.host}:{args.port}", flush=True)
+    serve(args.host, args.port, config_from_args(args))
+
+
+if __name__ == "__main__":
+    main()
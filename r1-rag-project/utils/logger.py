@@ -1,103 +1,240 @@
 import logging
 import sys
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import os
-from datetime import datetime
+import copy
+import json
+import queue
+import atexit
+import random
+from datetime import date
 from config.config import settings
 
+
+def _truncate(text: str, limit: int) -> str:
+    """截断过长的文本，并注明被截掉的字符数"""
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(已截断 {len(text) - limit} 字符)"
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    后台日志队列处理器
+
+    业务线程只把日志记录放入内存队列，格式化和磁盘写入由 QueueListener 的后台线程完成，
+    事件循环中不再有阻塞的写文件操作。队列满时丢弃记录并计数，而不是阻塞调用方。
+    """
+
+    def __init__(self, log_queue, max_message_chars: int, max_field_chars: int, content_sample_rate: float):
+        super().__init__(log_queue)
+        self.max_message_chars = max_message_chars
+        self.max_field_chars = max_field_chars
+        self.content_sample_rate = content_sample_rate
+        self.content_fields = set(settings.LOG_CONTENT_FIELDS.split(","))
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _shape_fields(self, fields: dict) -> dict:
+        """截断结构化字段；问题、回答、上下文等大段内容按采样率保留，未采中时只记录长度"""
+        shaped = {}
+        sampled = random.random() < self.content_sample_rate
+        for key, value in fields.items():
+            if isinstance(value, str):
+                if key in self.content_fields and not sampled:
+                    value = f"<已省略 {len(value)} 字符>"
+                else:
+                    value = _truncate(value, self.max_field_chars)
+            shaped[key] = value
+        return shaped
+
+    def prepare(self, record):
+        """在调用线程中合并消息参数并截断，异常堆栈转为文本，便于跨线程传递"""
+        record = copy.copy(record)
+        record.message = _truncate(record.getMessage(), self.max_message_chars)
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.fields = self._shape_fields(fields)
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    """控制台文本格式，结构化字段以 key=value 附在消息后"""
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " | " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行JSON，便于日志系统检索和聚合"""
+
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record, settings.LOG_DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload["fields"] = fields
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class DailySizeRotatingFileHandler(RotatingFileHandler):
+    """
+    按天分文件、按大小轮转的文件处理器
+
+    日志写入 logs/YYYY-MM/ragchat_YYYY-MM-DD.log；单个文件超过 LOG_MAX_BYTES 时
+    轮转为 .1、.2 …，最多保留 LOG_BACKUP_COUNT 个；跨天后自动切换到新日期的文件。
+    """
+
+    def __init__(self, log_dir: str, max_bytes: int, backup_count: int):
+        self.log_dir = log_dir
+        self._day = date.today()
+        super().__init__(
+            self._path_for(self._day),
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True
+        )
+
+    def _path_for(self, day: date) -> str:
+        # 按年月创建子目录，格式为 YYYY-MM
+        month_dir = os.path.join(self.log_dir, day.strftime("%Y-%m"))
+        os.makedirs(month_dir, exist_ok=True)
+        return os.path.join(month_dir, f'ragchat_{day.strftime("%Y-%m-%d")}.log')
+
+    def shouldRollover(self, record):
+        if date.today() != self._day:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        today = date.today()
+        if today != self._day:
+            # 跨天：关闭当前文件，下次写入时打开新日期的文件
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            self._day = today
+            self.baseFilename = os.path.abspath(self._path_for(today))
+            return
+        super().doRollover()
+
+
 def setup_logging(
     log_dir: str = "logs",
     log_level: int = logging.INFO,
 ) -> logging.Logger:
     """
     设置日志配置
-    
+
+    业务代码通过队列处理器写日志，控制台和文件输出由后台线程完成。
+
     Args:
         log_dir: 日志文件目录
         log_level: 日志级别
-    
+
     Returns:
         logging.Logger: 配置好的日志记录器
     """
     try:
-        print(f"正在初始化日志系统，目录: {log_dir}")
-        
+        print(f"正在初始化日志系统，目录: {log_dir}", file=sys.stderr)
+
         # os.access() 是一个标准库函数，用于测试指定路径的访问权限。
         # os.W_OK 是一个常量，表示写入权限。
         if os.path.exists(log_dir) and not os.access(log_dir, os.W_OK):
             raise PermissionError(f"没有写入权限: {log_dir}")
-            
+
         # 创建主日志目录，exist_ok=True 表示如果目录已存在则不报错
         os.makedirs(log_dir, exist_ok=True)
-        
-        # 获取当前日期时间
-        today = datetime.now()
-        
-        # 按年月创建子目录，格式为 YYYY-MM
-        month_dir = os.path.join(log_dir, today.strftime('%Y-%m'))
-        
-        # 创建年月子目录，exist_ok=True 表示如果目录已存在则不报错
-        os.makedirs(month_dir, exist_ok=True)
-        
-        # 验证目录是否成功创建
-        if not os.path.exists(month_dir):
-            raise OSError(f"无法创建日志目录: {month_dir}")
-        
+
         # 创建logger对象
         logger = logging.getLogger('RAGChat')
         logger.setLevel(log_level)
-        
+
         # 避免重复日志输出
         if logger.handlers:
             for handler in logger.handlers[:]:
                 logger.removeHandler(handler)
-        
-        # 日志格式
-        formatter = logging.Formatter(
-            settings.LOG_FORMAT,
-            datefmt=settings.LOG_DATE_FORMAT
+                if getattr(handler, "listener", None) is not None:
+                    handler.listener.stop()
+
+        # 控制台输出文本格式，文件输出每行一条JSON；
+        # 控制台日志写到标准错误，脚本的标准输出只保留报告等结果
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_formatter = TextFormatter(settings.LOG_FORMAT, datefmt=settings.LOG_DATE_FORMAT)
+        console_handler.setFormatter(console_formatter)
+
+        # 按天分文件、按大小轮转的文件处理器
+        file_handler = DailySizeRotatingFileHandler(
+            log_dir,
+            settings.LOG_MAX_BYTES,
+            settings.LOG_BACKUP_COUNT
+        )
+        file_handler.setFormatter(
+            JsonFormatter() if settings.LOG_JSON else console_formatter
         )
 
-        # 创建一个新的日志处理器，将日志消息输出到标准输出控制台处理器
-        console_handler = logging.StreamHandler(sys.stdout)
-        # 为控制台处理器设置一个格式化器
-        console_handler.setFormatter(formatter)
-        # 添加处理器到日志记录器
-        logger.addHandler(console_handler)
-        
-        # 按天切割的文件处理器
-        log_file = os.path.join(month_dir, f'ragchat_{today.strftime("%Y-%m-%d")}.log')
-
-        # 创建一个按天切割的文件处理器
-        file_handler = TimedRotatingFileHandler(
-            log_file,
-            when='midnight',
-            interval=1,
-            encoding='utf-8'
+        # 业务线程只入队，后台线程负责格式化和写入
+        queue_handler = BackgroundQueueHandler(
+            queue.Queue(settings.LOG_QUEUE_SIZE),
+            settings.LOG_MAX_MESSAGE_CHARS,
+            settings.LOG_MAX_FIELD_CHARS,
+            settings.LOG_CONTENT_SAMPLE_RATE
         )
-        # 为文件处理器设置一个格式化器
-        file_handler.setFormatter(formatter)
-        # 添加处理器到日志记录器
-        logger.addHandler(file_handler)
-        
-        print(f"日志文件路径: {log_file}")  # 添加调试信息
-        
+        listener = QueueListener(
+            queue_handler.queue,
+            console_handler,
+            file_handler,
+            respect_handler_level=True
+        )
+        queue_handler.listener = listener
+        logger.addHandler(queue_handler)
+        listener.start()
+        # 进程退出前写完队列中剩余的日志
+        atexit.register(listener.stop)
+
+        log_file = file_handler.baseFilename
+        print(f"日志文件路径: {log_file}", file=sys.stderr)  # 添加调试信息
+
         # 记录日志系统初始化成功
         logger.info(f"日志系统初始化成功，日志文件: {log_file}")
         return logger
-        
+
     except Exception as e:
-        print(f"日志系统初始化失败: {str(e)}")
-        
+        print(f"日志系统初始化失败: {str(e)}", file=sys.stderr)
+
         # 创建一个后备的日志记录器，仅输出到控制台
         # 当主日志系统初始化失败时，确保程序仍然可以记录日志
         fallback_logger = logging.getLogger('RAGChat')
         # 设置日志级别与主日志系统相同
         fallback_logger.setLevel(log_level)
         # 创建一个控制台处理器用于输出日志
-        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler = logging.StreamHandler(sys.stderr)
         # 使用与主日志系统相同的格式
-        console_handler.setFormatter(logging.Formatter(settings.LOG_FORMAT))
+        console_handler.setFormatter(TextFormatter(settings.LOG_FORMAT))
         # 将处理器添加到后备日志记录器
         fallback_logger.addHandler(console_handler)
         # 返回后备日志记录器
@@ -111,4 +248,4 @@ logger = setup_logging(
 
 def get_logger() -> logging.Logger:
     """获取logger实例"""
-    return logger 
\ No newline at end of file
+    return logger
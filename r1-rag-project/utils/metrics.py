@@ -0,0 +1,393 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config.config import settings
+from utils.logger import logger
+from bisect import bisect_left
+import functools
+import threading
+import time
+
+# 阶段耗时直方图的桶边界(秒)，覆盖毫秒级检索到分钟级生成
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry, name: str, documentation: str, labels: tuple):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """
+    瞬时值
+
+    可以直接设置，也可以注册回调函数，在抓取时计算（如索引大小），不增加业务路径的开销。
+    """
+
+    kind = "gauge"
+
+    def __init__(self, registry, name: str, documentation: str, labels: tuple):
+        super().__init__(registry, name, documentation, labels)
+        self._callbacks = {}
+
+    def set(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """注册回调函数，抓取时调用以获得当前值"""
+        with self._lock:
+            self._callbacks[self._key(labels)] = function
+
+    def render(self) -> list:
+        with self._lock:
+            callbacks = list(self._callbacks.items())
+        for key, function in callbacks:
+            try:
+                value = float(function())
+            except Exception as e:
+                logger.debug(f"指标 {self.name} 回调失败: {str(e)}")
+                continue
+            with self._lock:
+                self._values[key] = value
+        return super().render()
+
+
+class Histogram(_Metric):
+    """按桶统计的分布，导出为Prometheus直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name: str, documentation: str, labels: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 各桶计数（非累计）、总和、总数
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+        self.registry.otel.record(self.name, value, dict(zip(self.label_names, key)))
+
+    def summary(self) -> dict:
+        """返回 {标签值: {"count", "mean_ms"}}，用于基准测试报告"""
+        with self._lock:
+            return {
+                key[0] if len(key) == 1 else key: {
+                    "count": state[2],
+                    "mean_ms": round(state[1] / state[2] * 1000, 3) if state[2] else None,
+                }
+                for key, state in self._values.items()
+            }
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class _NoopSpan:
+    """关闭指标时使用的空上下文，避免任何计时开销"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    """计时上下文：退出时把耗时记入阶段直方图，并在启用OTLP时生成对应的追踪span"""
+
+    __slots__ = ("registry", "stage", "attributes", "started", "otel_span")
+
+    def __init__(self, registry, stage: str, attributes: dict):
+        self.registry = registry
+        self.stage = stage
+        self.attributes = attributes
+        self.otel_span = None
+
+    def __enter__(self):
+        self.otel_span = self.registry.otel.start_span(self.stage, self.attributes)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        self.registry.stage_seconds.observe(elapsed, stage=self.stage)
+        if exc_type is not None:
+            self.registry.stage_errors.inc(stage=self.stage)
+        self.registry.otel.end_span(self.otel_span, exc)
+        return False
+
+
+class _OpenTelemetryBridge:
+    """
+    可选的OTLP导出
+
+    配置 OTLP_ENDPOINT 且安装了OpenTelemetry SDK时，计时span导出为追踪span，
+    直方图观测值同步记录到OTel直方图；否则所有方法都是空操作。
+    """
+
+    def __init__(self):
+        self.tracer = None
+        self.meter = None
+        self._instruments = {}
+        self._lock = threading.Lock()
+
+    def setup(self, endpoint: str, service_name: str):
+        try:
+            from opentelemetry import trace, metrics as otel_metrics
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+            from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
+        except ImportError as e:
+            logger.warning(f"未安装OpenTelemetry，跳过OTLP导出: {str(e)}")
+            return
+
+        resource = Resource.create({"service.name": service_name})
+        tracer_provider = TracerProvider(resource=resource)
+        tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+        trace.set_tracer_provider(tracer_provider)
+        meter_provider = MeterProvider(
+            resource=resource,
+            metric_readers=[PeriodicExportingMetricReader(OTLPMetricExporter(endpoint=endpoint))]
+        )
+        otel_metrics.set_meter_provider(meter_provider)
+        self.tracer = trace.get_tracer(service_name)
+        self.meter = otel_metrics.get_meter(service_name)
+        logger.info(f"已启用OTLP导出: {endpoint}")
+
+    def start_span(self, name: str, attributes: dict):
+        if self.tracer is None:
+            return None
+        return self.tracer.start_span(name, attributes=attributes or None)
+
+    @staticmethod
+    def end_span(span, exc):
+        if span is None:
+            return
+        if exc is not None:
+            span.record_exception(exc)
+        span.end()
+
+    def record(self, name: str, value: float, attributes: dict):
+        if self.meter is None:
+            return
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            with self._lock:
+                instrument = self._instruments.get(name)
+                if instrument is None:
+                    instrument = self._instruments[name] = self.meter.create_histogram(name, unit="s")
+        instrument.record(value, attributes)
+
+
+class MetricsRegistry:
+    """
+    指标注册表
+
+    关闭时 span() 返回共享的空上下文，observe/inc/set 直接返回，几乎没有额外开销。
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.otel = _OpenTelemetryBridge()
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.stage_seconds = self.histogram(
+            "rag_stage_seconds", "各处理阶段耗时(秒)", ["stage"]
+        )
+        self.stage_errors = self.counter(
+            "rag_stage_errors_total", "各处理阶段失败次数", ["stage"]
+        )
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self._register(Counter, name, documentation, tuple(labels))
+
+    def gauge(self, name: str, documentation: str, labels=()) -> Gauge:
+        return self._register(Gauge, name, documentation, tuple(labels))
+
+    def histogram(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, tuple(labels), buckets)
+
+    def span(self, stage: str, **attributes):
+        """
+        阶段计时
+
+        用法:
+            with metrics.span("embed", kind="documents"):
+                ...
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, stage, attributes)
+
+    def timed(self, stage: str):
+        """同步函数的阶段计时装饰器"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, stage, {}):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe_stage(self, stage: str, seconds: float):
+        """记录在别处测得的阶段耗时，如TTFT"""
+        self.stage_seconds.observe(seconds, stage=stage)
+
+    def render(self) -> str:
+        """导出为Prometheus文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/ready":
+            # 启动预热完成前返回503，供编排系统的就绪探针使用
+            ready = self.server.ready is None or self.server.ready()
+            self._send(200 if ready else 503, b"ready\n" if ready else b"starting\n", "text/plain")
+        elif path == "/metrics" and metrics.enabled:
+            self._send(200, metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self.send_error(404)
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(host: str = None, port: int = None, ready=None):
+    """
+    在后台线程中提供 /metrics 端点，供Prometheus抓取
+
+    关闭指标采集(METRICS_ENABLED=false)时仍然启动，只提供 /ready 就绪探针；端口为0时不启动。
+
+    Args:
+        host: 监听地址
+        port: 端口
+        ready: 可选的就绪检查函数，提供时 /ready 端点按其结果返回200或503
+    """
+    port = settings.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host or settings.HOST, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.ready = ready
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = "metrics" if metrics.enabled else "ready"
+    logger.info(f"指标端点已启动: http://{host or settings.HOST}:{port}/{endpoint}")
+    return server
+
+
+# 全局指标注册表
+metrics = MetricsRegistry(settings.METRICS_ENABLED)
+if metrics.enabled and settings.OTLP_ENDPOINT:
+    metrics.otel.setup(settings.OTLP_ENDPOINT, settings.OTLP_SERVICE_NAME)
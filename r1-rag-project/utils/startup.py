@@ -0,0 +1,44 @@
+from contextlib import contextmanager
+from utils.logger import logger
+from utils.metrics import metrics
+import time
+
+STARTUP_PHASE_SECONDS = metrics.gauge("rag_startup_phase_seconds", "启动各阶段耗时(秒)", labels=("phase",))
+READY = metrics.gauge("rag_ready", "服务是否已完成启动预热")
+
+
+class StartupTracker:
+    """
+    启动阶段计时
+
+    记录导入、预热、索引加载等各阶段的耗时；全部阶段完成后才标记为就绪，
+    /ready 端点据此返回 200，滚动发布时流量只会切到已经预热好的实例。
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = {}
+        self.ready = False
+        READY.set(0)
+
+    @contextmanager
+    def phase(self, name: str):
+        """记录一个启动阶段的耗时；并发执行的阶段各自计时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = round(elapsed, 3)
+            STARTUP_PHASE_SECONDS.set(elapsed, phase=name)
+            logger.info(f"启动阶段 {name} 完成，耗时 {elapsed:.2f} 秒")
+
+    def mark_ready(self):
+        self.ready = True
+        READY.set(1)
+        total = time.perf_counter() - self.started_at
+        STARTUP_PHASE_SECONDS.set(total, phase="total")
+        logger.info(f"服务已就绪，启动总耗时 {total:.2f} 秒，各阶段: {self.phases}")
+
+    def is_ready(self) -> bool:
+        return self.ready
@@ -0,0 +1,90 @@
+from config.config import settings
+from utils.logger import logger
+from functools import lru_cache
+import numpy as np
+import re
+
+# CJK字符，在中文模型的分词器中大致一个字对应一个token
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]")
+# 按码点查表判断是否为CJK字符，区间与 _CJK_RE 相同
+_CJK_TABLE = np.zeros(0x110000, dtype=np.uint8)
+for _start, _end in ((0x3400, 0x4dbf), (0x4e00, 0x9fff), (0xf900, 0xfaff), (0x3040, 0x30ff), (0xac00, 0xd7af)):
+    _CJK_TABLE[_start:_end + 1] = 1
+
+
+class TokenCounter:
+    """
+    按目标模型的分词器统计token数
+
+    分词器来自 CONTEXT_TOKENIZER 指定的本地目录或已缓存的 HuggingFace 模型，只从本地加载，
+    不在启动和分块工作进程中联网下载；无法加载时（未缓存、未配置）退回按字符估算。
+    """
+
+    def __init__(self, tokenizer_name: str):
+        self._tokenizer = None
+        if tokenizer_name:
+            try:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, local_files_only=True)
+                logger.info(f"已加载分词器: {tokenizer_name}")
+            except Exception as e:
+                logger.warning(f"加载分词器失败，改为按字符估算token数: {str(e)}")
+
+    @staticmethod
+    def estimate(text: str) -> int:
+        """估算token数：CJK字符每字约1个token，其余字符约4个一个token"""
+        cjk = len(_CJK_RE.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def count(self, text: str) -> int:
+        """统计文本的token数"""
+        if not text:
+            return 0
+        if self._tokenizer is None:
+            return self.estimate(text)
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+    def count_segments(self, text: str, boundaries: list) -> np.ndarray:
+        """
+        批量统计 text 中相邻边界之间各区间的token数
+
+        按字符估算时把整页文本一次转为码点数组，用前缀和得到各区间的CJK字符数，不复制子串；
+        使用分词器时一次批量编码。
+
+        Args:
+            text: 原文
+            boundaries: 递增的位置 [b0, b1, ..., bn]，统计 [b0, b1)、[b1, b2) ... 共n个区间
+        """
+        if len(boundaries) < 2:
+            return np.zeros(0, dtype=np.int64)
+        if self._tokenizer is None:
+            codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+            prefix = np.zeros(len(codes) + 1, dtype=np.int64)
+            np.cumsum(_CJK_TABLE[codes], out=prefix[1:])
+            positions = np.asarray(boundaries, dtype=np.int64)
+            cjk = prefix[positions]
+            cjk = cjk[1:] - cjk[:-1]
+            return cjk + (positions[1:] - positions[:-1] - cjk + 3) // 4
+        encoded = self._tokenizer(
+            [text[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])], add_special_tokens=False
+        )
+        return np.asarray([len(ids) for ids in encoded["input_ids"]], dtype=np.int64)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断文本使其不超过max_tokens，按字符二分查找截断点"""
+        if self.count(text) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
+
+
+@lru_cache(maxsize=1)
+def get_token_counter() -> TokenCounter:
+    """获取全局TokenCounter实例，分词器只加载一次"""
+    return TokenCounter(settings.CONTEXT_TOKENIZER)